@@ -1,45 +1,182 @@
 #!/usr/bin/env python3
 
-from collections import OrderedDict
-import fileinput
-import sys
+"""Builds a vocabulary dictionary for each input file.
+
+For each FILE, the dictionary is written to FILE.json. It maps <EOS>, <GO>,
+and <UNK> to 0, 1, and 2, followed by the words of FILE in order of
+decreasing frequency (words with equal frequency are ordered by their first
+occurrence in the file, so the result is deterministic).
 
-import numpy
+Large files are split into byte ranges, which can be counted by several
+processes in parallel (--workers).
+"""
+
+import argparse
+from collections import Counter, OrderedDict
+import itertools
 import json
+import multiprocessing
+import operator
+import os
+import sys
+
+
+# Size of the byte ranges that are counted in one step.
+CHUNK_SIZE = 2**26
+
+_split_words = operator.methodcaller('split', ' ')
+
+
+def count_lines(lines, counts):
+    """Adds the word counts of the lines to counts (a Counter).
+
+    As in earlier versions of this script, lines are split at single spaces
+    after stripping leading and trailing whitespace.
+    """
+    counts.update(itertools.chain.from_iterable(
+        map(_split_words, map(str.strip, lines))))
+
+
+def find_chunks(filename, chunk_size):
+    """Returns (start, end) byte ranges of about chunk_size bytes that cover
+    the file. Lines are assigned to the range that contains their first byte.
+    """
+    size = os.path.getsize(filename)
+    num_chunks = max(1, (size + chunk_size - 1) // chunk_size)
+    return [(size * i // num_chunks, size * (i+1) // num_chunks)
+            for i in range(num_chunks)]
+
+
+def count_chunk(args):
+    """Returns a Counter with the word counts of the lines that start in the
+    byte range [start, end) of the file."""
+    filename, start, end = args
+    with open(filename, 'rb') as f:
+        if start > 0:
+            # Skip the line that started in the previous range.
+            f.seek(start - 1)
+            f.readline()
+        pos = f.tell()
+        data = f.read(max(0, end - pos))
+        if data and not data.endswith(b'\n'):
+            data += f.readline()
+    text = data.decode('utf-8')
+    # Newline translation as in text mode.
+    if '\r' in text:
+        text = text.replace('\r\n', '\n').replace('\r', '\n')
+    lines = text.split('\n')
+    if lines[-1] == '':
+        lines.pop()
+    counts = Counter()
+    count_lines(lines, counts)
+    return counts
+
+
+def count_words(filename, pool=None, chunk_size=CHUNK_SIZE):
+    """Returns a Counter with the word counts of a file, whose keys are in
+    order of first occurrence."""
+    tasks = [(filename, start, end)
+             for start, end in find_chunks(filename, chunk_size)]
+    if pool is None:
+        results = map(count_chunk, tasks)
+    else:
+        results = pool.imap(count_chunk, tasks)
+    # The chunks are merged in file order, which keeps the keys in order of
+    # first occurrence.
+    word_freqs = Counter()
+    for counts in results:
+        word_freqs.update(counts)
+    return word_freqs
+
+
+def build_dictionary(word_freqs, max_vocab=None, min_freq=1):
+    """Returns the dictionary for a Counter of words.
+
+    Args:
+        word_freqs: Counter, whose keys are in order of first occurrence.
+        max_vocab: if not None, maximum size of the dictionary (including the
+            special symbols).
+        min_freq: minimum frequency of the words that are included.
+
+    Returns:
+        An OrderedDict mapping words to IDs.
+    """
+    # sorted() is stable, so equally frequent words stay in order of first
+    # occurrence.
+    sorted_words = [w for w, freq in sorted(word_freqs.items(),
+                                            key=lambda item: -item[1])
+                    if freq >= min_freq]
+
+    worddict = OrderedDict()
+    worddict['<EOS>'] = 0
+    worddict['<GO>'] = 1
+    worddict['<UNK>'] = 2
+    if max_vocab is not None:
+        sorted_words = sorted_words[:max(0, max_vocab - len(worddict))]
+    # FIXME We shouldn't assume <EOS>, <GO>, and <UNK> aren't BPE subwords.
+    for ii, ww in enumerate(sorted_words):
+        worddict[ww] = ii+3
+    return worddict
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('files', metavar='FILE', nargs='+',
+                        help='training corpus file')
+    parser.add_argument('--workers', type=int, default=1, metavar='INT',
+                        help='number of processes used for counting '
+                             '(default: %(default)s)')
+    parser.add_argument('--max_vocab', type=int, default=None, metavar='INT',
+                        help='maximum size of the dictionary, including '
+                             '<EOS>, <GO>, and <UNK> (default: no limit)')
+    parser.add_argument('--min_freq', type=int, default=1, metavar='INT',
+                        help='minimum frequency of the words in the '
+                             'dictionary (default: %(default)s)')
+    parser.add_argument('--binary', action='store_true',
+                        help='also write the dictionary in the compiled form '
+                             'loaded by Nematus (FILE.json.vocab.npz)')
+    args = parser.parse_args()
+    if args.workers < 1:
+        parser.error('--workers must be at least 1')
+    return args
 
 
 def main():
-    for filename in sys.argv[1:]:
-        print('Processing', filename)
-        word_freqs = OrderedDict()
-        with open(filename, 'r', encoding='utf-8') as f:
-            for line in f:
-                words_in = line.strip().split(' ')
-                for w in words_in:
-                    if w not in word_freqs:
-                        word_freqs[w] = 0
-                    word_freqs[w] += 1
-        words = list(word_freqs.keys())
-        freqs = list(word_freqs.values())
-
-        sorted_idx = numpy.argsort(freqs)
-        sorted_words = [words[ii] for ii in sorted_idx[::-1]]
-
-        worddict = OrderedDict()
-        worddict['<EOS>'] = 0
-        worddict['<GO>'] = 1
-        worddict['<UNK>'] = 2
-        # FIXME We shouldn't assume <EOS>, <GO>, and <UNK> aren't BPE subwords.
-        for ii, ww in enumerate(sorted_words):
-            worddict[ww] = ii+3
-
-        # The JSON RFC requires that JSON text be represented using either
-        # UTF-8, UTF-16, or UTF-32, with UTF-8 being recommended.
-        # We use UTF-8 regardless of the user's locale settings.
-        with open('%s.json'%filename, 'w', encoding='utf-8') as f:
-            json.dump(worddict, f, indent=2, ensure_ascii=False)
-
-        print('Done')
+    args = parse_args()
+
+    if args.binary:
+        sys.path.append(os.path.join(os.path.dirname(
+            os.path.abspath(__file__)), '..', 'nematus'))
+        import vocab
+
+    pool = None
+    if args.workers > 1:
+        pool = multiprocessing.Pool(args.workers)
+    try:
+        for filename in args.files:
+            print('Processing', filename)
+            word_freqs = count_words(filename, pool)
+            worddict = build_dictionary(word_freqs, args.max_vocab,
+                                        args.min_freq)
+
+            # The JSON RFC requires that JSON text be represented using either
+            # UTF-8, UTF-16, or UTF-32, with UTF-8 being recommended.
+            # We use UTF-8 regardless of the user's locale settings.
+            with open('%s.json'%filename, 'w', encoding='utf-8') as f:
+                json.dump(worddict, f, indent=2, ensure_ascii=False)
+
+            if args.binary:
+                # Written after the JSON file, so that it is not out of date.
+                vocabulary = vocab.Vocabulary(list(worddict.keys()),
+                                              list(worddict.values()))
+                vocabulary.save('%s.json%s' % (filename,
+                                               vocab.COMPILED_SUFFIX))
+
+            print('Done')
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,87 @@
+#!/usr/bin/env python3
+
+"""Builds a lexical shortlist from a parallel corpus.
+
+For each source word, the target words with the highest translation
+probability p(target | source) are kept as its candidates. The probabilities
+are estimated from word alignments (one line of i-j pairs per sentence pair,
+as written by fast_align) if --alignment is given, and otherwise from
+sentence-level co-occurrence counts. The most frequent target words are
+candidates for every sentence.
+
+The shortlist is written as JSON and can be used for decoding with
+translate.py --shortlist.
+"""
+
+import argparse
+from collections import Counter, defaultdict
+import json
+import sys
+
+
+def read_pairs(source_file, target_file, alignment_file):
+    """Yields the (source word, target word) pairs of each sentence pair,
+    together with the target words."""
+    if alignment_file is None:
+        alignment_file = iter(lambda: None, 0)
+    for source, target, alignment in zip(source_file, target_file,
+                                         alignment_file):
+        source_words = source.split()
+        target_words = target.split()
+        if alignment is None:
+            pairs = set((s, t) for s in set(source_words)
+                        for t in set(target_words))
+        else:
+            pairs = []
+            for link in alignment.split():
+                i, j = link.split('-')
+                pairs.append((source_words[int(i)], target_words[int(j)]))
+        yield pairs, target_words
+
+
+def build_shortlist(source_file, target_file, alignment_file, num_candidates,
+                    num_frequent):
+    target_counts = Counter()
+    pair_counts = defaultdict(Counter)
+    for pairs, target_words in read_pairs(source_file, target_file,
+                                          alignment_file):
+        target_counts.update(target_words)
+        for s, t in pairs:
+            pair_counts[s][t] += 1
+
+    candidates = {}
+    for s, counts in pair_counts.items():
+        # p(t | s) = count(s, t) / count(s); count(s) is the same for all t.
+        candidates[s] = [t for t, _ in counts.most_common(num_candidates)]
+    frequent = [t for t, _ in target_counts.most_common(num_frequent)]
+    return {'frequent': frequent, 'candidates': candidates}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('source', type=argparse.FileType('r'),
+                        help='source side of the corpus')
+    parser.add_argument('target', type=argparse.FileType('r'),
+                        help='target side of the corpus')
+    parser.add_argument('-a', '--alignment', type=argparse.FileType('r'),
+                        help='word alignment of the corpus (i-j pairs)')
+    parser.add_argument('-k', '--candidates', type=int, default=100,
+                        metavar='INT',
+                        help='number of candidates per source word '
+                             '(default: %(default)s)')
+    parser.add_argument('-f', '--frequent', type=int, default=1000,
+                        metavar='INT',
+                        help='number of frequent target words that are '
+                             'always candidates (default: %(default)s)')
+    parser.add_argument('-o', '--output', type=argparse.FileType('w'),
+                        default=sys.stdout,
+                        help='output file (default: standard output)')
+    args = parser.parse_args()
+
+    shortlist = build_shortlist(args.source, args.target, args.alignment,
+                                args.candidates, args.frequent)
+    json.dump(shortlist, args.output, ensure_ascii=False)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,5 +1,8 @@
 #!/usr/bin/env python3
 
+import contextlib
+import io
+import itertools
 import math
 import os
 import random
@@ -8,7 +11,7 @@ import tempfile
 
 
 # TODO Make CHUNK_SIZE user configurable?
-CHUNK_SIZE = 10000000  # Number of lines.
+CHUNK_SIZE = 10000000  # Expected number of lines per bucket.
 
 def jointly_shuffle_files(files, temporary=False):
     """Randomly shuffle the given files, applying the same permutation to each.
@@ -24,7 +27,13 @@ def jointly_shuffle_files(files, temporary=False):
     removed from each line.
 
     In order to handle large files, the input files are not read into memory
-    in full, but instead are read in chunks of size CHUNK_SIZE.
+    in full. Instead, a two-pass external shuffle is used: first, each line
+    (or rather, each tuple of parallel lines) is written to one of B
+    temporary bucket files, chosen uniformly at random, where B is chosen
+    so that a bucket holds CHUNK_SIZE lines on average. Then each bucket is
+    read into memory in turn, shuffled, and appended to the output. This
+    produces a uniformly random permutation, takes time linear in the size
+    of the input, and the memory use is bounded by the size of a bucket.
 
     Args:
         files: a list of strings specifying the paths of the input files.
@@ -34,74 +43,78 @@ def jointly_shuffle_files(files, temporary=False):
         A list containing a file object for each shuffled file, in the same
         order as the input files. Each file object is open and positioned at
         the start of the file.
+
+    Raises:
+        ValueError: if the input files have different numbers of lines.
     """
 
     # Determine the number of lines (should be the same for all files).
     total_lines = 0
-    for _ in open(files[0]):
-        total_lines += 1
-
-    # Randomly permute the list of line numbers.
-    perm = list(range(total_lines))
-    random.shuffle(perm)
-
-    # Convert the list of line numbers to a list of chunk indices and offsets.
-    ordering = [(i // CHUNK_SIZE, i % CHUNK_SIZE) for i in perm]
-
-    # Sort each file according to the generated ordering.
-    return [_sort_file(path, ordering, temporary) for path in files]
-
-
-def _sort_file(path, ordering, temporary):
-
-    # Open a temporary file for each chunk.
-
-    num_chunks = math.ceil(len(ordering) / CHUNK_SIZE)
-    dirname, filename = os.path.split(os.path.realpath(path))
-    chunk_files = [tempfile.TemporaryFile(prefix=filename+'.chunk'+str(i),
-                                          dir=dirname, mode='w+',
-                                          encoding="UTF-8")
-                   for i in range(num_chunks)]
-
-    # Read one chunk at a time from path and write the lines to the temporary
-    # files in the order specified by ordering.
-
-    def _write_chunk_in_order(chunk, chunk_num, out_file):
-        for i, j in ordering:
-            if i == chunk_num:
-                out_file.write(chunk[j] + '\n')
-
-    chunk = []
-    chunk_num = 0
-    for i, line in enumerate(open(path)):
-        if i > 0 and (i % CHUNK_SIZE) == 0:
-            _write_chunk_in_order(chunk, chunk_num, chunk_files[chunk_num])
-            chunk = []
-            chunk_num += 1
-        chunk.append(line.strip())
-    if chunk:
-        _write_chunk_in_order(chunk, chunk_num, chunk_files[chunk_num])
-
-    # Open the output file.
-    if temporary:
-        out_file = tempfile.TemporaryFile(prefix=filename+'.shuf', dir=dirname,
-                                          mode='w+', encoding='UTF-8')
-    else:
-        out_file = open(path+'.shuf', mode='w', encoding='UTF-8')
-
-    # Seek to the start of the chunk files.
-    for chunk_file in chunk_files:
-        chunk_file.seek(0)
-
-    # Write the output.
-    for i, _ in ordering:
-        line = chunk_files[i].readline()
-        out_file.write(line)
-
-    # Seek to the start so that the file object is ready for reading.
-    out_file.seek(0)
-
-    return out_file
+    with open(files[0], 'rb') as f:
+        for _ in f:
+            total_lines += 1
+    num_buckets = max(1, math.ceil(total_lines / CHUNK_SIZE))
+
+    with contextlib.ExitStack() as stack:
+        # Open a temporary file for each bucket and input file. They are
+        # closed (and deleted) when the stack is left, also on errors.
+        bucket_files = []
+        for path in files:
+            dirname, filename = os.path.split(os.path.realpath(path))
+            bucket_files.append([
+                stack.enter_context(tempfile.TemporaryFile(
+                    prefix=filename+'.chunk'+str(i), dir=dirname,
+                    mode='w+b'))
+                for i in range(num_buckets)])
+
+        # Scatter the lines to randomly chosen buckets. Parallel lines are
+        # always sent to the same bucket.
+        with contextlib.ExitStack() as in_stack:
+            in_files = [in_stack.enter_context(open(path, 'rb'))
+                        for path in files]
+            for n, lines in enumerate(itertools.zip_longest(*in_files)):
+                if None in lines:
+                    short = [path for path, line in zip(files, lines)
+                             if line is None]
+                    raise ValueError(
+                        'Cannot shuffle files with different numbers of '
+                        'lines: {0} ended after {1} lines'.format(
+                            ', '.join(short), n))
+                i = random.randrange(num_buckets)
+                for line, buckets in zip(lines, bucket_files):
+                    buckets[i].write(line.strip() + b'\n')
+
+        # Open the output files. They are only closed if an error occurs.
+        with contextlib.ExitStack() as out_stack:
+            out_files = []
+            for path in files:
+                dirname, filename = os.path.split(os.path.realpath(path))
+                if temporary:
+                    out_file = tempfile.TemporaryFile(
+                        prefix=filename+'.shuf', dir=dirname, mode='w+b')
+                else:
+                    out_file = open(path+'.shuf', mode='w+b')
+                out_files.append(out_stack.enter_context(out_file))
+
+            # Shuffle each bucket in memory and append it to the output.
+            for i in range(num_buckets):
+                bucket_lines = []
+                for buckets in bucket_files:
+                    buckets[i].seek(0)
+                    bucket_lines.append(buckets[i].readlines())
+                    buckets[i].close()
+                perm = list(range(len(bucket_lines[0])))
+                random.shuffle(perm)
+                for lines, out_file in zip(bucket_lines, out_files):
+                    out_file.writelines(lines[j] for j in perm)
+
+            # Seek to the start so that the file objects are ready for
+            # reading.
+            for out_file in out_files:
+                out_file.seek(0)
+            out_stack.pop_all()
+
+    return [io.TextIOWrapper(f, encoding='UTF-8') for f in out_files]
 
 
 if __name__ == '__main__':
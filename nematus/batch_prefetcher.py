@@ -0,0 +1,117 @@
+"""Prepares training minibatches in a background thread.
+
+The training loop spends most of its time in session.run(), which releases
+the GIL, so reading, sorting, and padding the next minibatches on a separate
+thread lets the input pipeline overlap with the model update.
+"""
+
+import queue
+import sys
+import threading
+import time
+
+# ModuleNotFoundError is new in 3.6; older versions will throw SystemError
+if sys.version_info < (3, 6):
+    ModuleNotFoundError = SystemError
+
+try:
+    from . import exception
+    from . import util
+except (ModuleNotFoundError, ImportError) as e:
+    import exception
+    import util
+
+
+# Queue items that mark the end of an epoch or a failure in the producer.
+_END_OF_EPOCH = 'end_of_epoch'
+
+
+class _ProducerError(object):
+    def __init__(self, exc_info):
+        self.exc_info = exc_info
+
+
+class BatchPrefetcher(object):
+    """Iterates over the padded (x, x_mask, y, y_mask) minibatches of a
+    TextIterator, one epoch per call to iter().
+
+    If queue_size is greater than zero, a daemon thread keeps up to
+    queue_size ready minibatches in a bounded queue. If it is zero, the
+    minibatches are prepared on demand in the calling thread (i.e. there is
+    no prefetching).
+
+    The number of times the consumer had to wait for a minibatch (and the
+    total waiting time) is accumulated in num_stalls and stall_time; call
+    reset_stats() to start counting again.
+    """
+
+    def __init__(self, text_iterator, factors, queue_size):
+        """Initializes the prefetcher.
+
+        Args:
+            text_iterator: a TextIterator.
+            factors: number of source factors expected in the training data.
+            queue_size: maximum number of prepared minibatches (0 to disable
+                prefetching).
+        """
+        self._text_iterator = text_iterator
+        self._factors = factors
+        self._queue_size = queue_size
+        # A batch stays in use until the consumer requests the next one, so
+        # at most queue_size + 2 batches exist at any time (one held by the
+        # consumer, queue_size in the queue and one being built).
+        self._batch_builder = util.BatchBuilder(
+            factors, num_buffers=max(1, queue_size + 2))
+        self._queue = None
+        self._thread = None
+        self.reset_stats()
+
+    def reset_stats(self):
+        self.num_stalls = 0
+        self.stall_time = 0.0
+
+    def __iter__(self):
+        if self._queue_size <= 0:
+            return self._iterate_epoch()
+        if self._thread is None:
+            self._queue = queue.Queue(maxsize=self._queue_size)
+            self._thread = threading.Thread(target=self._produce, daemon=True)
+            self._thread.start()
+        return self._consume_epoch()
+
+    def _consume_epoch(self):
+        while True:
+            if self._queue.empty():
+                start = time.time()
+                item = self._queue.get()
+                self.num_stalls += 1
+                self.stall_time += time.time() - start
+            else:
+                item = self._queue.get()
+            if item is _END_OF_EPOCH:
+                return
+            if isinstance(item, _ProducerError):
+                self._thread = None
+                _, value, traceback = item.exc_info
+                raise value.with_traceback(traceback)
+            yield item
+
+    def _produce(self):
+        # The producer runs ahead into the next epoch; it blocks on the full
+        # queue when training finishes and is discarded at exit.
+        try:
+            while True:
+                for batch in self._iterate_epoch():
+                    self._queue.put(batch)
+                self._queue.put(_END_OF_EPOCH)
+        except:
+            self._queue.put(_ProducerError(sys.exc_info()))
+
+    def _iterate_epoch(self):
+        for source_sents, target_sents in self._text_iterator:
+            if len(source_sents[0][0]) != self._factors:
+                raise exception.Error(
+                    'Mismatch between number of factors in settings ({0}), '
+                    'and number in training corpus ({1})'.format(
+                        self._factors, len(source_sents[0][0])))
+            yield self._batch_builder.from_lists(source_sents, target_sents)
@@ -0,0 +1,406 @@
+#!/usr/bin/env python3
+
+"""Merges the sentences of concurrent server requests into batches and
+routes the batches to the worker processes (used by server_translator.py)."""
+
+import collections
+import logging
+import threading
+import time
+
+from queue import Empty
+
+import exception
+
+
+# Length classes, in order of priority. A sentence's class is the first one
+# whose length limit (in source tokens) it does not exceed; the last class
+# has no limit.
+LENGTH_CLASSES = ['short', 'medium', 'long']
+
+
+class QueueItem(object):
+    """
+    Models items in a queue.
+    """
+    def __init__(self, **kwargs):
+        self.__dict__.update(kwargs)
+
+class PendingRequest(object):
+    """
+    Collects the translations of a request's sentences, which may be
+    translated in several batches (together with other requests' sentences).
+
+    If an asyncio event loop is given, the beams can also be awaited with
+    wait_async(); the future is completed on that loop.
+    """
+    def __init__(self, num_sents, loop=None):
+        self.beams = [None] * num_sents
+        self.error = None
+        self._num_pending = num_sents
+        self._done = threading.Event()
+        self._loop = loop
+        self._future = None if loop is None else loop.create_future()
+        if num_sents == 0:
+            self._finish()
+
+    def add(self, pos, beam):
+        self.beams[pos] = beam
+        self._num_pending -= 1
+        if self._num_pending == 0:
+            self._finish()
+
+    def fail(self, error):
+        self.error = error
+        self._finish()
+
+    def _finish(self):
+        self._done.set()
+        if self._future is not None:
+            self._loop.call_soon_threadsafe(self._complete_future)
+
+    def _complete_future(self):
+        if self._future.done():
+            return # the awaiting coroutine was cancelled
+        if self.error is not None:
+            self._future.set_exception(self.error)
+        else:
+            self._future.set_result(self.beams)
+
+    async def wait_async(self):
+        """
+        Waits until all sentences are translated; returns their beams.
+        """
+        return await self._future
+
+    def wait(self):
+        """
+        Blocks until all sentences are translated; returns their beams.
+        """
+        self._done.wait()
+        if self.error is not None:
+            raise self.error
+        return self.beams
+
+
+def assign_workers(class_workers, num_workers):
+    """
+    Checks the worker IDs given for each length class (None: all workers
+    serve all classes) and returns them as a list of lists.
+    """
+    if class_workers is None:
+        return [list(range(num_workers)) for _ in LENGTH_CLASSES]
+    if len(class_workers) != len(LENGTH_CLASSES):
+        raise exception.Error('Expected worker IDs for {} length classes, '
+                              'got {}'.format(len(LENGTH_CLASSES),
+                                              len(class_workers)))
+    for name, workers in zip(LENGTH_CLASSES, class_workers):
+        if not workers:
+            raise exception.Error('No workers for length class '
+                                  '\'{}\''.format(name))
+        for worker in workers:
+            if not 0 <= worker < num_workers:
+                raise exception.Error('Invalid worker ID {} for length class '
+                                      '\'{}\' (there are {} workers)'.format(
+                                          worker, name, num_workers))
+    return [sorted(set(workers)) for workers in class_workers]
+
+
+class _ClassStats(object):
+    """
+    Counts the batches of a length class and the time that its sentences
+    waited before being sent to a worker.
+    """
+    def __init__(self, max_waits=1000):
+        self.batches = 0
+        self.sentences = 0
+        self.waits = collections.deque(maxlen=max_waits)
+
+    def add(self, arrival_times, now):
+        self.batches += 1
+        self.sentences += len(arrival_times)
+        self.waits.extend(now - t for t in arrival_times)
+
+    def wait_ms(self):
+        """
+        Returns the mean, median and 99th percentile of the recent waits.
+        """
+        if not self.waits:
+            return None
+        waits = sorted(self.waits)
+        percentile = lambda p: waits[min(len(waits)-1, int(p * len(waits)))]
+        return {'mean': 1000 * sum(waits) / len(waits),
+                'p50': 1000 * percentile(0.5),
+                'p99': 1000 * percentile(0.99)}
+
+
+class BatchScheduler(object):
+    """
+    Merges the sentences of concurrent requests into batches for the worker
+    processes.
+
+    Sentences are queued by length class (see LENGTH_CLASSES and
+    length_limits), beam size and normalization alpha, since these are set
+    per batch. A queue is ready to be sent as a batch once it is full
+    (batch_size sentences, or token_batch_size source tokens times beam size
+    if that is non-zero), or once its oldest sentence has waited for
+    max_wait seconds.
+
+    Each worker has its own input queue and has at most max_in_flight
+    batches sent to it at a time: one to translate and the next ones
+    already waiting in its queue, so that the worker does not go idle
+    between batches. Further batches wait here, where they can be
+    reordered, rather than behind a long batch in a worker's queue. When a
+    worker has room, the ready batches are considered shortest class first
+    (and oldest first within a class), and each goes to the least busy
+    worker that serves its class (see class_workers), preferring workers
+    that serve fewer classes. Reserving a worker for short sentences thus
+    keeps their latency low while long documents are being translated. A
+    collector thread hands the translations back to the requests.
+
+    If a worker process dies, its in-flight batches fail and no further
+    batches are routed to it; queued sentences whose length class has no
+    live workers left fail as well.
+
+    If create_shared_batch is given, batches and beams are passed through
+    shared memory (see shm_transport.py) rather than pickled: it is called
+    with the sentences and beam size of each batch and returns a
+    SharedBatch.
+    """
+    def __init__(self, input_queues, output_queue, processes, batch_size,
+                 token_batch_size, max_wait, length_limits,
+                 class_workers=None, create_shared_batch=None,
+                 max_in_flight=2, timeout=5):
+        self._input_queues = input_queues
+        self._output_queue = output_queue
+        self._processes = processes
+        self._batch_size = batch_size
+        self._token_batch_size = token_batch_size
+        self._max_wait = max_wait
+        self._length_limits = list(length_limits)
+        self._class_workers = assign_workers(class_workers, len(input_queues))
+        # worker -> number of classes that it serves
+        self._num_classes = collections.Counter(
+            worker for workers in self._class_workers for worker in workers)
+        self._create_shared_batch = create_shared_batch
+        self._max_in_flight = max_in_flight
+        self._timeout = timeout
+        self._cond = threading.Condition()
+        # (class, beam size, alpha) -> list of (request, position, ids,
+        # arrival time)
+        self._pending = {}
+        # batch ID -> (list of (request, position), SharedBatch or None,
+        # worker, class)
+        self._in_flight = {}
+        # worker -> number of batches in flight
+        self._load = [0] * len(input_queues)
+        # workers whose process has died
+        self._dead = set()
+        self._stats = [_ClassStats() for _ in LENGTH_CLASSES]
+        self._next_batch_id = 0
+        for target in [self._dispatch, self._collect]:
+            threading.Thread(target=target, daemon=True).start()
+
+    def submit(self, sentences, k, normalization_alpha, loop=None):
+        """
+        Queues a request's sentences (lists of source IDs) for translation
+        and returns a PendingRequest (see there for loop).
+        """
+        request = PendingRequest(len(sentences), loop)
+        now = time.time()
+        with self._cond:
+            for pos, ids in enumerate(sentences):
+                key = (self._length_class(ids), k, normalization_alpha)
+                items = self._pending.setdefault(key, [])
+                items.append((request, pos, ids, now))
+            self._cond.notify()
+        return request
+
+    def stats(self):
+        """
+        Returns the queue depth and wait times of each length class.
+        """
+        now = time.time()
+        with self._cond:
+            stats = {}
+            for cls, name in enumerate(LENGTH_CLASSES):
+                queued = [items for key, items in self._pending.items()
+                          if key[0] == cls]
+                stats[name] = {
+                    'max_length': (self._length_limits[cls]
+                                   if cls < len(self._length_limits)
+                                   else None),
+                    'workers': self._class_workers[cls],
+                    'queued_sentences': sum(len(items) for items in queued),
+                    'oldest_wait_ms': max([1000 * (now - items[0][3])
+                                           for items in queued], default=0),
+                    'in_flight_batches': sum(
+                        1 for _, _, _, c in self._in_flight.values()
+                        if c == cls),
+                    'batches': self._stats[cls].batches,
+                    'sentences': self._stats[cls].sentences,
+                    'wait_ms': self._stats[cls].wait_ms()}
+            return stats
+
+    def _length_class(self, ids):
+        for cls, limit in enumerate(self._length_limits):
+            if len(ids) <= limit:
+                return cls
+        return len(self._length_limits)
+
+    def _batch_length(self, items, k):
+        """
+        Returns the number of leading items that go into the next batch and
+        whether that batch is full.
+        """
+        if self._token_batch_size:
+            longest = 0
+            for n, (_, _, ids, _) in enumerate(items):
+                longest = max(longest, len(ids))
+                cost = (n+1) * (longest+1) * k
+                if n > 0 and cost > self._token_batch_size:
+                    return n, True
+            return len(items), False
+        n = min(len(items), self._batch_size)
+        return n, n == self._batch_size
+
+    def _dispatch(self):
+        with self._cond:
+            while True:
+                sent, timeout = self._dispatch_one(time.time())
+                if not sent:
+                    self._cond.wait(timeout)
+
+    def _dispatch_one(self, now):
+        """
+        Sends the first ready batch that a worker has room for. Returns
+        whether a batch was sent and, if not, how long to wait until the
+        next queue becomes ready (None: until notified).
+        """
+        for request, msg in self._take_unroutable():
+            request.fail(exception.Error(msg))
+        timeout = None
+        ready = []
+        for key, items in self._pending.items():
+            _, full = self._batch_length(items, key[1])
+            deadline = items[0][3] + self._max_wait
+            if full or now >= deadline:
+                ready.append((key[0], items[0][3], key))
+            else:
+                wait = deadline - now
+                timeout = wait if timeout is None else min(timeout, wait)
+        for cls, _, key in sorted(ready):
+            workers = [w for w in self._class_workers[cls]
+                       if w not in self._dead
+                       and self._load[w] < self._max_in_flight]
+            if not workers:
+                continue
+            worker = min(workers,
+                         key=lambda w: (self._load[w], self._num_classes[w]))
+            items = self._pending[key]
+            n, _ = self._batch_length(items, key[1])
+            self._send(key, items[:n], worker, now)
+            del items[:n]
+            if not items:
+                del self._pending[key]
+            return True, None
+        return False, timeout
+
+    def _send(self, key, items, worker, now):
+        cls, k, normalization_alpha = key
+        batch_id = self._next_batch_id
+        self._next_batch_id += 1
+        targets = [(request, pos) for request, pos, _, _ in items]
+        sentences = [ids for _, _, ids, _ in items]
+        if self._create_shared_batch is None:
+            shared_batch = None
+            input_item = QueueItem(k=k,
+                                   normalization_alpha=normalization_alpha,
+                                   batch=sentences,
+                                   shared_batch=None,
+                                   idx=batch_id)
+        else:
+            shared_batch = self._create_shared_batch(sentences, k)
+            input_item = QueueItem(k=k,
+                                   normalization_alpha=normalization_alpha,
+                                   batch=None,
+                                   shared_batch=shared_batch.descriptor,
+                                   idx=batch_id)
+        self._in_flight[batch_id] = (targets, shared_batch, worker, cls)
+        self._load[worker] += 1
+        self._stats[cls].add([arrival for _, _, _, arrival in items], now)
+        self._input_queues[worker].put(input_item)
+
+    def _collect(self):
+        # The processes are also checked while other workers keep returning
+        # translations, so that a dead worker is noticed under load.
+        last_check = time.time()
+        while True:
+            try:
+                batch_id, beams = self._output_queue.get(True, self._timeout)
+            except Empty:
+                batch_id = None
+            if time.time() - last_check >= self._timeout:
+                self._check_processes()
+                last_check = time.time()
+            if batch_id is None:
+                continue
+            with self._cond:
+                entry = self._in_flight.pop(batch_id, None)
+                if entry is None:
+                    # the batch was failed after its worker died
+                    continue
+                targets, shared_batch, worker, _ = entry
+                self._load[worker] -= 1
+                self._cond.notify()
+            if shared_batch is not None:
+                beams = shared_batch.read_beams()
+                shared_batch.release()
+            for (request, pos), beam in zip(targets, beams):
+                request.add(pos, beam)
+
+    def _check_processes(self):
+        """
+        Fails the in-flight batches of workers whose process has died and
+        stops routing batches to them.
+        """
+        failed = []
+        with self._cond:
+            for worker, process in enumerate(self._processes):
+                if worker in self._dead or process.is_alive() \
+                        or process.exitcode == 0:
+                    continue
+                msg = "Translate worker process {0} crashed with " \
+                      "exitcode {1}".format(process.pid, process.exitcode)
+                logging.error(msg)
+                self._dead.add(worker)
+                self._input_queues[worker].cancel_join_thread()
+                for batch_id, (targets, shared_batch, w, _) in \
+                        list(self._in_flight.items()):
+                    if w != worker:
+                        continue
+                    del self._in_flight[batch_id]
+                    if shared_batch is not None:
+                        shared_batch.release()
+                    failed += [(request, msg) for request, _ in targets]
+            if failed:
+                failed += self._take_unroutable()
+                self._cond.notify()
+        for request, msg in failed:
+            request.fail(exception.Error(msg))
+
+    def _take_unroutable(self):
+        """
+        Removes the queued sentences of length classes that have no live
+        workers left and returns their (request, error message) pairs. Must
+        be called with self._cond held.
+        """
+        failed = []
+        for key in list(self._pending):
+            cls = key[0]
+            if all(w in self._dead for w in self._class_workers[cls]):
+                msg = "No live worker processes for length class " \
+                      "'{0}'".format(LENGTH_CLASSES[cls])
+                failed += [(request, msg)
+                           for request, _, _, _ in self._pending.pop(key)]
+        return failed
@@ -43,22 +43,40 @@ class BeamSearchSampler:
     scores contains floats representing the length-normalized log
     probabilities. It has the shape (batch_size_x, beam_size).
 
-    TODO Make beam_size a placeholder?
+    If a shortlist (see shortlist.py) is given, the output layer is only
+    evaluated for the candidate target IDs in self.inputs.shortlist, which
+    must be fed with the candidates for each batch.
+
+    If compact_batch is True, each input sentence is removed from the batch as
+    soon as its own search has terminated, so that the remaining decoding
+    steps only run over the sentences that are still unfinished. This is
+    only supported for Transformer models.
+
+    If stack_models is True, the decoding steps of Transformer models with
+    the same decoder structure are run as one, with their weights stacked
+    (see transformer_inference.EnsembleModelAdapter).
 
     See also: RandomSampler.
     """
 
-    def __init__(self, models, configs, beam_size):
+    def __init__(self, models, configs, beam_size, compact_batch=False,
+                 shortlist=None, stack_models=False):
         """Sets some things up then calls _beam_search() to do the real work.
 
         Args:
             models: a sequence of RNN or Transformer objects.
             configs: a sequence of model configs (argparse.Namespace objects).
-            beam_size: an integer specifying the beam width.
+            beam_size: an integer specifying the default beam width. The
+                width is fed via self.inputs.beam_size, so the same sampler
+                can be run with any beam size.
+            compact_batch: remove sentences from the batch as they finish.
+            shortlist: a Shortlist object or None.
+            stack_models: run structurally identical Transformers together.
         """
         self._models = models
         self._configs = configs
         self._beam_size = beam_size
+        self._shortlist = shortlist
 
         with tf.compat.v1.name_scope('beam_search'):
 
@@ -79,22 +97,33 @@ class BeamSearchSampler:
                             model, config, scope)
                     model_adapters.append(adapter)
 
+            if stack_models:
+                model_adapters = _stack_model_adapters(model_adapters,
+                                                       configs)
+
             # Check that individual models are compatible with each other.
             vocab_sizes = [a.target_vocab_size for a in model_adapters]
             if len(set(vocab_sizes)) > 1:
                 raise exception.Error('Cannot ensemble models with different '
                                       'target vocabulary sizes')
             target_vocab_size = vocab_sizes[0]
+            if compact_batch and any(config.model_type != 'transformer'
+                                     for config in configs):
+                raise exception.Error('Batch compaction is only supported '
+                                      'for Transformer models')
 
             # Build the graph to do the actual work.
             sequences, scores = _beam_search(
                 model_adapters=model_adapters,
-                beam_size=beam_size,
+                beam_size=self.inputs.beam_size,
                 batch_size_x=self.inputs.batch_size_x,
                 max_translation_len=self.inputs.max_translation_len,
                 normalization_alpha=self.inputs.normalization_alpha,
                 vocab_size=target_vocab_size,
-                eos_id=0)
+                eos_id=0,
+                compact_batch=compact_batch,
+                output_ids=(None if shortlist is None
+                            else self.inputs.shortlist))
 
             self._outputs = sequences, scores
 
@@ -114,20 +143,55 @@ class BeamSearchSampler:
     def beam_size(self):
         return self._beam_size
 
+    @property
+    def shortlist(self):
+        return self._shortlist
+
+
+def _stack_model_adapters(model_adapters, configs):
+    """Replaces Transformer adapters with the same decoder structure by one
+    EnsembleModelAdapter.
+
+    Returns:
+        A list of model adapters.
+    """
+    groups = {}
+    for i, (adapter, config) in enumerate(zip(model_adapters, configs)):
+        if config.model_type == 'transformer':
+            key = transformer_inference.decoder_structure(config)
+        else:
+            key = i
+        groups.setdefault(key, []).append(adapter)
+    stacked_adapters = []
+    for adapters in groups.values():
+        if len(adapters) == 1:
+            stacked_adapters.append(adapters[0])
+            continue
+        scope_name = 'ensemble_adapter_{}'.format(len(stacked_adapters))
+        with tf.compat.v1.name_scope(scope_name) as scope:
+            stacked_adapters.append(
+                transformer_inference.EnsembleModelAdapter(adapters, scope))
+    return stacked_adapters
+
 
 def _beam_search(model_adapters, beam_size, batch_size_x, max_translation_len,
-                 normalization_alpha, vocab_size, eos_id):
+                 normalization_alpha, vocab_size, eos_id, compact_batch=False,
+                 output_ids=None):
     """See description of BeamSearchSampler above.
 
     Args:
         model_adapters: sequence of ModelAdapter objects.
-        beam_size: integer specifying beam width.
+        beam_size: tf.int32 scalar specifying beam width.
         batch_size_x: tf.int32 scalar specifying number of input sentences.
         max_translation_len: tf.int32 scalar specifying max translation length.
         normalization_alpha: tf.float32 scalar specifying alpha parameter for
             length normalization.
         vocab_size: float specifying the target vocabulary size.
         eos_id: integer specifying the vocabulary ID of the EOS symbol.
+        compact_batch: if True, remove sentences from the batch as soon as
+            their search has terminated.
+        output_ids: optional tf.int32 vector of the target vocabulary IDs
+            that can be output (including eos_id).
 
     Returns:
         A pair of tensors: (sequences, scores). sequences contains vocabulary
@@ -137,12 +201,20 @@ def _beam_search(model_adapters, beam_size, batch_size_x, max_translation_len,
     """
 
     # Encode the input and generate a 1-step decoding function for each model.
+    encoder_outputs = []
     decoding_functions = []
     for adapter in model_adapters:
         encoder_output = adapter.encode()
-        func = adapter.generate_decoding_function(encoder_output)
+        func = adapter.generate_decoding_function(encoder_output, output_ids)
+        encoder_outputs.append(encoder_output)
         decoding_functions.append(func)
 
+    # With a shortlist, the log probabilities are computed over output_ids
+    # only, and positions in output_ids are mapped back to vocabulary IDs
+    # after selecting the top-k extensions.
+    if output_ids is not None:
+        vocab_size = tf.size(input=output_ids)
+
     # Initialize the timestep counter.
     current_time_step = tf.constant(1)
 
@@ -160,7 +232,8 @@ def _beam_search(model_adapters, beam_size, batch_size_x, max_translation_len,
     finished_eos_flags = tf.fill([batch_size_x, beam_size], False)
 
     # Initialize memories (i.e. states carried over from the last timestep).
-    alive_memories = [ma.generate_initial_memories(batch_size_x, beam_size)
+    alive_memories = [ma.generate_initial_memories(batch_size_x, beam_size,
+                                                   max_translation_len)
                       for ma in model_adapters]
 
     # Generate the conditional and body functions for the beam search loop.
@@ -170,9 +243,53 @@ def _beam_search(model_adapters, beam_size, batch_size_x, max_translation_len,
     loop_body = _generate_while_loop_body_func(model_adapters,
                                                decoding_functions,
                                                max_translation_len,
-                                               batch_size_x, beam_size,
+                                               beam_size,
                                                vocab_size, eos_id,
-                                               normalization_alpha)
+                                               normalization_alpha,
+                                               output_ids)
+
+    if compact_batch:
+        finished_sequences, finished_scores = _compact_while_loop(
+            model_adapters, loop_body, encoder_outputs, max_translation_len,
+            batch_size_x, beam_size, current_time_step, alive_sequences,
+            alive_scores, finished_sequences, finished_scores,
+            finished_eos_flags, alive_memories)
+    else:
+        finished_sequences, finished_scores = _while_loop(
+            model_adapters, loop_cond, loop_body, current_time_step, alive_sequences, alive_scores,
+            finished_sequences, finished_scores, finished_eos_flags,
+            alive_memories)
+
+    # Truncate finished sequences to remove initial <GO>.
+    finished_sequences = finished_sequences[:, :, 1:]
+
+    # Normalize scores. Note that we include the <EOS> token when calculating
+    # sequence length.
+    seq_len = tf.shape(input=finished_sequences)[2]
+    indices = tf.range(seq_len, dtype=tf.int32)
+    indices = tf.reshape(indices, [1, 1, seq_len])
+    indices = tf.tile(indices, [batch_size_x, beam_size, 1])
+    seq_lens = tf.reshape(seq_len, [1, 1, 1])
+    seq_lens = tf.tile(seq_lens, [batch_size_x, beam_size, seq_len])
+    eos_indices = tf.compat.v1.where(tf.equal(finished_sequences, eos_id),
+                           indices, seq_lens)
+    lengths = tf.reduce_min(input_tensor=eos_indices+1, axis=2)
+    float_lengths = tf.cast(lengths, dtype=tf.float32)
+    length_penalties = float_lengths ** normalization_alpha
+    finished_scores = finished_scores / length_penalties
+
+    return finished_sequences, finished_scores
+
+
+def _while_loop(model_adapters, loop_cond, loop_body, current_time_step,
+                alive_sequences, alive_scores, finished_sequences,
+                finished_scores, finished_eos_flags, alive_memories):
+    """Runs the beam search loop until every sentence has terminated.
+
+    Returns:
+        A pair of tensors (finished_sequences, finished_scores) with shapes
+        (batch_size_x, beam_size, len) and (batch_size_x, beam_size).
+    """
 
     loop_vars = [current_time_step,
                  alive_sequences,
@@ -203,9 +320,6 @@ def _beam_search(model_adapters, beam_size, batch_size_x, max_translation_len,
                 parallel_iterations=10,
                 swap_memory=False))
 
-    alive_sequences.set_shape((None, beam_size, None))
-    finished_sequences.set_shape((None, beam_size, None))
-
     # Account for the case in which no translations terminate in <EOS> for a
     # particular input sentence. In that case, copy the contents of the alive
     # beam for that sentence into the finished beam (sequence + score).
@@ -215,25 +329,165 @@ def _beam_search(model_adapters, beam_size, batch_size_x, max_translation_len,
     finished_scores = tf.compat.v1.where(tf.reduce_any(input_tensor=finished_eos_flags, axis=1),
                                finished_scores, alive_scores)
 
-    # Truncate finished sequences to remove initial <GO>.
-    finished_sequences = finished_sequences[:, :, 1:]
+    return finished_sequences, finished_scores
 
-    # Normalize scores. Note that we include the <EOS> token when calculating
-    # sequence length.
+
+def _compact_while_loop(model_adapters, loop_body, encoder_outputs,
+                        max_translation_len, batch_size_x, beam_size,
+                        current_time_step, alive_sequences, alive_scores,
+                        finished_sequences, finished_scores,
+                        finished_eos_flags, alive_memories):
+    """Runs the beam search loop, removing sentences as they terminate.
+
+    The loop state (including the memories and encoder outputs) only covers
+    the active sentences, whose indices into the input batch are tracked in
+    active_ids. Whenever a sentence's search terminates, its finished
+    sequences and scores are written to full-size output tensors and its rows
+    are gathered out of the loop state.
+
+    Returns:
+        A pair of tensors (finished_sequences, finished_scores) with shapes
+        (batch_size_x, beam_size, len) and (batch_size_x, beam_size).
+    """
+
+    def remove_sentences(done, active_ids, alive_sequences, alive_scores,
+                         finished_sequences, finished_scores,
+                         finished_eos_flags, alive_memories, encoder_outputs,
+                         output_sequences, output_scores):
+        """Writes out the sentences flagged in done and drops them."""
+        done_ids = tf.cast(tf.compat.v1.where(done)[:, 0], dtype=INT_DTYPE)
+        keep_ids = tf.cast(tf.compat.v1.where(tf.logical_not(done))[:, 0],
+                           dtype=INT_DTYPE)
+
+        # Write the results for the terminated sentences to the outputs,
+        # padding the sequences to the maximum translation length.
+        output_indices = tf.expand_dims(tf.gather(active_ids, done_ids), 1)
+        seq_len = tf.shape(input=finished_sequences)[2]
+        done_sequences = tf.pad(
+            tensor=tf.gather(finished_sequences, done_ids),
+            paddings=[[0, 0], [0, 0], [0, max_translation_len - seq_len]])
+        output_sequences = tf.tensor_scatter_nd_update(
+            output_sequences, output_indices, done_sequences)
+        output_scores = tf.tensor_scatter_nd_update(
+            output_scores, output_indices,
+            tf.gather(finished_scores, done_ids))
+
+        # Gather the remaining sentences' rows from the loop state.
+        num_keep = tf.shape(input=keep_ids)[0]
+        gather_coordinates = tf.stack(
+            [tf.tile(tf.expand_dims(keep_ids, 1), [1, beam_size]),
+             tf.tile(tf.expand_dims(tf.range(beam_size), 0), [num_keep, 1])],
+            axis=2)
+        alive_memories = [
+            adapter.gather_memories(memories, gather_coordinates)
+            for adapter, memories in zip(model_adapters, alive_memories)]
+        encoder_outputs = tf.nest.map_structure(
+            lambda t: tf.gather(t, keep_ids), encoder_outputs)
+
+        return (tf.gather(active_ids, keep_ids),
+                tf.gather(alive_sequences, keep_ids),
+                tf.gather(alive_scores, keep_ids),
+                tf.gather(finished_sequences, keep_ids),
+                tf.gather(finished_scores, keep_ids),
+                tf.gather(finished_eos_flags, keep_ids),
+                alive_memories, encoder_outputs,
+                output_sequences, output_scores)
+
+    def loop_cond(current_time_step, active_ids, *args):
+        return tf.logical_and(tf.less(current_time_step, max_translation_len),
+                              tf.greater(tf.size(input=active_ids), 0))
+
+    def compact_loop_body(current_time_step, active_ids, alive_sequences,
+                          alive_scores, finished_sequences, finished_scores,
+                          finished_eos_flags, alive_memories,
+                          encoder_outputs, output_sequences, output_scores):
+        current_time_step, alive_sequences, alive_scores, \
+            finished_sequences, finished_scores, finished_eos_flags, \
+            alive_memories = loop_body(current_time_step, alive_sequences,
+                                       alive_scores, finished_sequences,
+                                       finished_scores, finished_eos_flags,
+                                       alive_memories, encoder_outputs)
+
+        state = (active_ids, alive_sequences, alive_scores,
+                 finished_sequences, finished_scores, finished_eos_flags,
+                 alive_memories, encoder_outputs, output_sequences,
+                 output_scores)
+
+        # Only compact the state at time steps where a sentence terminates.
+        done = _sentences_done(alive_scores, finished_scores,
+                               finished_eos_flags)
+        state = tf.cond(pred=tf.reduce_any(input_tensor=done),
+                        true_fn=lambda: remove_sentences(done, *state),
+                        false_fn=lambda: state)
+
+        return (current_time_step,) + tuple(state)
+
+    active_ids = tf.range(batch_size_x)
+    output_sequences = tf.zeros([batch_size_x, beam_size, max_translation_len],
+                                dtype=INT_DTYPE)
+    output_scores = tf.zeros([batch_size_x, beam_size])
+
+    loop_vars = (current_time_step,
+                 active_ids,
+                 alive_sequences,
+                 alive_scores,
+                 finished_sequences,
+                 finished_scores,
+                 finished_eos_flags,
+                 alive_memories,
+                 encoder_outputs,
+                 output_sequences,
+                 output_scores)
+
+    shape_invariants = (
+        tf.TensorShape([]),                       # timestep
+        tf.TensorShape([None]),                   # active sentence IDs
+        tf.TensorShape([None, None, None]),       # alive sequences
+        tf.TensorShape([None, None]),             # alive scores
+        tf.TensorShape([None, None, None]),       # finished sequences
+        tf.TensorShape([None, None]),             # finished scores
+        tf.TensorShape([None, None]),             # finished EOS flags
+        [adapter.get_memory_invariants(memories)  # alive memories
+         for adapter, memories in zip(model_adapters, alive_memories)],
+        tf.nest.map_structure(                    # encoder outputs
+            lambda t: tf.TensorShape([None] * t.get_shape().rank),
+            encoder_outputs),
+        output_sequences.get_shape(),             # output sequences
+        output_scores.get_shape())                # output scores
+
+    _, active_ids, alive_sequences, alive_scores, finished_sequences, \
+        finished_scores, finished_eos_flags, _, _, output_sequences, \
+        output_scores = \
+            tf.nest.map_structure(tf.stop_gradient, tf.while_loop(
+                cond=loop_cond,
+                body=compact_loop_body,
+                loop_vars=loop_vars,
+                shape_invariants=shape_invariants,
+                parallel_iterations=10,
+                swap_memory=False))
+
+    # Write out the sentences that were still active when the maximum
+    # translation length was reached. As in _while_loop(), fall back to the
+    # alive beam for sentences without any finished translation.
+    any_finished = tf.reduce_any(input_tensor=finished_eos_flags, axis=1)
+    finished_sequences = tf.compat.v1.where(any_finished, finished_sequences,
+                                            alive_sequences)
+    finished_scores = tf.compat.v1.where(any_finished, finished_scores,
+                                         alive_scores)
     seq_len = tf.shape(input=finished_sequences)[2]
-    indices = tf.range(seq_len, dtype=tf.int32)
-    indices = tf.reshape(indices, [1, 1, seq_len])
-    indices = tf.tile(indices, [batch_size_x, beam_size, 1])
-    seq_lens = tf.reshape(seq_len, [1, 1, 1])
-    seq_lens = tf.tile(seq_lens, [batch_size_x, beam_size, seq_len])
-    eos_indices = tf.compat.v1.where(tf.equal(finished_sequences, eos_id),
-                           indices, seq_lens)
-    lengths = tf.reduce_min(input_tensor=eos_indices+1, axis=2)
-    float_lengths = tf.cast(lengths, dtype=tf.float32)
-    length_penalties = float_lengths ** normalization_alpha
-    finished_scores = finished_scores / length_penalties
+    output_indices = tf.expand_dims(active_ids, 1)
+    finished_sequences = tf.pad(
+        tensor=finished_sequences,
+        paddings=[[0, 0], [0, 0], [0, max_translation_len - seq_len]])
+    output_sequences = tf.tensor_scatter_nd_update(
+        output_sequences, output_indices, finished_sequences)
+    output_scores = tf.tensor_scatter_nd_update(
+        output_scores, output_indices, finished_scores)
 
-    return finished_sequences, finished_scores
+    # Truncate to the number of decoding steps that were actually run.
+    output_sequences = output_sequences[:, :, :seq_len]
+
+    return output_sequences, output_scores
 
 
 def _compute_batch_indices(batch_size_x, beam_size):
@@ -247,10 +501,13 @@ def _compute_batch_indices(batch_size_x, beam_size):
     return batch_index_matrix
 
 
-def _gather_top_sequences(model_adapters, all_sequences, all_scores,
-                          all_scores_to_gather, all_eos_flags, all_memories,
-                          beam_size, batch_size_x, prefix):
-    """Selects the top-k sequences from a sequence set."""
+def _gather_top_sequences(all_sequences, all_scores, all_scores_to_gather,
+                          all_eos_flags, beam_size, batch_size_x, prefix):
+    """Selects the top-k sequences from a sequence set.
+
+    Returns the gathered sequences, scores and EOS flags, together with the
+    gather coordinates (shape [batch_size_x, beam_size, 2]).
+    """
 
     # Obtain indices of the top-k scores within the scores tensor.
     _, top_indices = tf.nn.top_k(all_scores, k=beam_size)
@@ -270,14 +527,8 @@ def _gather_top_sequences(model_adapters, all_sequences, all_scores,
     gathered_eos_flags = tf.gather_nd(all_eos_flags, gather_coordinates,
                                       name='{:s}_eos_flags'.format(prefix))
 
-    gathered_memories = None
-    if all_memories is not None:
-        gathered_memories = [
-            adapter.gather_memories(memories, gather_coordinates)
-            for adapter, memories in zip(model_adapters, all_memories)]
-
     return gathered_sequences, gathered_scores, gathered_eos_flags, \
-           gathered_memories
+           gather_coordinates
 
 
 def _generate_while_loop_cond_func(max_translation_len):
@@ -290,54 +541,62 @@ def _generate_while_loop_cond_func(max_translation_len):
         # Check maximum prediction length has not been reached.
         length_criterion = tf.less(curr_time_step, max_translation_len)
 
-        # Otherwise, check if the most likely alive hypothesis is less likely
-        # than the least probable completed sequence.
+        # Otherwise, check if the search has terminated for all sentences.
+        likelihood_criterion = tf.logical_not(tf.reduce_all(
+            input_tensor=_sentences_done(alive_scores, finished_scores,
+                                         finished_eos_flags)))
 
-        # Calculate the best possible score of the most probable sequence
-        # currently alive.
-        highest_alive_score = alive_scores[:, 0]
+        # Decide whether to continue the decoding process.
+        return tf.logical_and(length_criterion, likelihood_criterion)
 
-        # Calculate the score of the least likely sequence currently finished.
-        lowest_finished_score = tf.reduce_min(
-            input_tensor=finished_scores * tf.cast(finished_eos_flags, FLOAT_DTYPE), axis=1)
+    return continue_decoding
 
-        # Account for the case in which none of the sequences in 'finished'
-        # have terminated so far; In that case, each of the unfinished
-        # sequences is assigned a high negative probability, so that the
-        # termination condition is not met.
-        tmp = tf.reduce_any(input_tensor=finished_eos_flags, axis=1)
-        mask_unfinished = (1. - tf.cast(tmp, dtype=tf.float32)) * (-1. * 1e7)
-        lowest_finished_score += mask_unfinished
 
-        # Check is the current highest alive score is lower than the current
-        # lowest finished score.
-        likelihood_criterion = \
-            tf.logical_not(
-                tf.reduce_all(
-                  input_tensor=tf.greater(lowest_finished_score, highest_alive_score)))
+def _sentences_done(alive_scores, finished_scores, finished_eos_flags):
+    """Determines for which sentences the search has terminated.
 
-        # Decide whether to continue the decoding process.
-        return tf.logical_and(length_criterion, likelihood_criterion)
+    The search for a sentence has terminated once its most likely alive
+    hypothesis is less likely than its least probable completed sequence.
 
-    return continue_decoding
+    Returns:
+        A boolean Tensor with shape (batch_size_x).
+    """
+
+    # Calculate the best possible score of the most probable sequence
+    # currently alive.
+    highest_alive_score = alive_scores[:, 0]
+
+    # Calculate the score of the least likely sequence currently finished.
+    lowest_finished_score = tf.reduce_min(
+        input_tensor=finished_scores * tf.cast(finished_eos_flags, FLOAT_DTYPE), axis=1)
+
+    # Account for the case in which none of the sequences in 'finished'
+    # have terminated so far; In that case, each of the unfinished
+    # sequences is assigned a high negative probability, so that the
+    # termination condition is not met.
+    tmp = tf.reduce_any(input_tensor=finished_eos_flags, axis=1)
+    mask_unfinished = (1. - tf.cast(tmp, dtype=tf.float32)) * (-1. * 1e7)
+    lowest_finished_score += mask_unfinished
+
+    # Check is the current highest alive score is lower than the current
+    # lowest finished score.
+    return tf.greater(lowest_finished_score, highest_alive_score)
 
 
 def _generate_while_loop_body_func(model_adapters, decoding_functions,
-                                   max_translation_len, batch_size_x, beam_size,
-                                   vocab_size, eos_id, normalization_alpha):
+                                   max_translation_len, beam_size,
+                                   vocab_size, eos_id, normalization_alpha,
+                                   output_ids):
 
-    # Construct an alternate set of 'log probabilities' to use when extending
-    # sequences beyond EOS. The value is set very low to ensure that these
-    # overgrown sequences are never chosen over incomplete or just-finished
-    # sequences.
-    tmp = tf.constant(tf.float32.min, shape=[1, 1], dtype=tf.float32)
-    eos_log_probs = tf.tile(tmp,
-                            multiples=[batch_size_x*beam_size, vocab_size])
+    # The number of input sentences is read from the loop state, since it
+    # shrinks during decoding if the batch is compacted.
 
     def extend_hypotheses(current_time_step, alive_sequences, alive_scores,
-                          alive_memories):
+                          alive_memories, encoder_outputs):
         """Generates top-k extensions of the alive beam candidates."""
 
+        batch_size_x = tf.shape(input=alive_scores)[0]
+
         # Get the vocab IDs for this timestep in the order of the model inputs.
         next_ids = alive_sequences[:, :, -1]      # [batch_size_x, beam_size]
         next_ids = tf.transpose(a=next_ids, perm=[1, 0]) # [beam_size, batch_size_x]
@@ -349,12 +608,21 @@ def _generate_while_loop_body_func(model_adapters, decoding_functions,
         for i in range(len(decoding_functions)):
 
             # Get logits.
-            step_logits, alive_memories[i] = decoding_functions[i](
-                next_ids, current_time_step, alive_memories[i])
+            if encoder_outputs is None:
+                step_logits, alive_memories[i] = decoding_functions[i](
+                    next_ids, current_time_step, alive_memories[i])
+            else:
+                step_logits, alive_memories[i] = decoding_functions[i](
+                    next_ids, current_time_step, alive_memories[i],
+                    encoder_outputs[i])
 
             # Calculate the scores for all possible extensions of alive
-            # hypotheses.
+            # hypotheses. An EnsembleModelAdapter returns the logits of all
+            # its models at once.
             log_probs = tf.nn.log_softmax(step_logits, axis=-1)
+            if isinstance(model_adapters[i],
+                          transformer_inference.EnsembleModelAdapter):
+                log_probs = tf.reduce_sum(input_tensor=log_probs, axis=0)
 
             # Add to the log probs from other models.
             if sum_log_probs is None:
@@ -366,7 +634,11 @@ def _generate_while_loop_body_func(model_adapters, decoding_functions,
         # sequences that are actually finished. When extending these, we don't
         # care what gets added beyond the EOS, only that the resulting sequence
         # gets a very low score. We give every possible extension the lowest
-        # possible probability.
+        # possible probability. The value is set very low to ensure that these
+        # overgrown sequences are never chosen over incomplete or
+        # just-finished sequences.
+        eos_log_probs = tf.fill([batch_size_x*beam_size, vocab_size],
+                                tf.float32.min)
         sum_log_probs = tf.compat.v1.where(tf.equal(next_ids, eos_id),
                                  eos_log_probs,
                                  sum_log_probs)
@@ -392,6 +664,8 @@ def _generate_while_loop_body_func(model_adapters, decoding_functions,
         # their identity (i.e. token-ID).
         top_beam_indices = top_ids // vocab_size
         top_ids %= vocab_size
+        if output_ids is not None:
+            top_ids = tf.gather(output_ids, top_ids)
 
         # Determine the location of top candidates.
         # [batch_size_x, beam_size]
@@ -406,19 +680,25 @@ def _generate_while_loop_body_func(model_adapters, decoding_functions,
                                    tf.expand_dims(top_ids, axis=2)],
                                   axis=2)
 
-        # Extract top memories for each model.
-        top_memories = [adapter.gather_memories(memories, top_coordinates)
-                        for adapter, memories in zip(model_adapters,
-                                                     alive_memories)]
-
         # Check how many of the top sequences have terminated.
         top_eos_flags = tf.equal(top_ids, eos_id)  # [batch_size_x, beam_size]
 
-        return (top_sequences, top_scores, top_eos_flags, top_memories)
+        # The memories are not gathered here, but only once the new alive
+        # beam has been selected (see update_alive()).
+        return (top_sequences, top_scores, top_eos_flags, top_beam_indices,
+                alive_memories)
 
     # Define a function to update alive set (part of tf.while_loop body)
-    def update_alive(top_sequences, top_scores, top_eos_flags, top_memories):
-        """Assembles an updated set of unfinished beam candidates."""
+    def update_alive(top_sequences, top_scores, top_eos_flags,
+                     top_beam_indices, step_memories):
+        """Assembles an updated set of unfinished beam candidates.
+
+        step_memories are the memories of the previous alive beam after this
+        time step's decoding step; each model's memories are gathered once,
+        from the beam entries that the new alive hypotheses extend.
+        """
+
+        batch_size_x = tf.shape(input=top_scores)[0]
 
         # Exclude completed sequences from the alive beam by setting their
         # scores to a large negative value.
@@ -426,17 +706,26 @@ def _generate_while_loop_body_func(model_adapters, decoding_functions,
 
         # Update the alive beam.
         updated_alive_sequences, updated_alive_scores, \
-            updated_alive_eos_flags, updated_alive_memories = \
-                _gather_top_sequences(model_adapters,
-                                      top_sequences,
+            updated_alive_eos_flags, gather_coordinates = \
+                _gather_top_sequences(top_sequences,
                                       selection_scores,
                                       top_scores,
                                       top_eos_flags,
-                                      top_memories,
                                       beam_size,
                                       batch_size_x,
                                       'alive')
 
+        # Look up the previous beam entry of each new alive hypothesis and
+        # gather the memories from there.
+        origin_beam_indices = tf.gather_nd(top_beam_indices,
+                                           gather_coordinates)
+        batch_index_matrix = _compute_batch_indices(batch_size_x, beam_size)
+        memory_coordinates = tf.stack([batch_index_matrix,
+                                       origin_beam_indices], axis=2)
+        updated_alive_memories = [
+            adapter.gather_memories(memories, memory_coordinates)
+            for adapter, memories in zip(model_adapters, step_memories)]
+
         return updated_alive_sequences, updated_alive_scores, \
                updated_alive_eos_flags, updated_alive_memories
 
@@ -446,6 +735,8 @@ def _generate_while_loop_body_func(model_adapters, decoding_functions,
                         top_eos_flags):
         """Updates the list of completed translation hypotheses."""
 
+        batch_size_x = tf.shape(input=top_scores)[0]
+
         # Match the length of the 'finished sequences' tensor with the length
         # of the 'finished scores' tensor
         zero_padding = tf.zeros([batch_size_x, beam_size, 1], dtype=INT_DTYPE)
@@ -470,12 +761,10 @@ def _generate_while_loop_body_func(model_adapters, decoding_functions,
         # Update the finished beam
         updated_finished_sequences, updated_finished_scores, \
             updated_finished_eos_flags, _ = \
-                _gather_top_sequences(model_adapters,
-                                     top_finished_sequences,
+                _gather_top_sequences(top_finished_sequences,
                                      top_finished_scores,
                                      top_finished_scores,
                                      top_finished_eos_flags,
-                                     None,
                                      beam_size,
                                      batch_size_x,
                                      'finished')
@@ -485,22 +774,29 @@ def _generate_while_loop_body_func(model_adapters, decoding_functions,
 
     def decoding_step(current_time_step, alive_sequences, alive_scores,
                       finished_sequences, finished_scores, finished_eos_flags,
-                      alive_memories):
-        """Defines a single step of the while loop."""
+                      alive_memories, encoder_outputs=None):
+        """Defines a single step of the while loop.
+
+        encoder_outputs is only given if the batch is compacted, in which case
+        it replaces the encoder outputs that the decoding functions were
+        generated with.
+        """
 
         # 1. Get the top sequences/ scores/ flags for the current time step
-        top_sequences, top_scores, top_eos_flags, top_memories = \
-            extend_hypotheses(current_time_step,
-                              alive_sequences,
-                              alive_scores,
-                              alive_memories)
+        top_sequences, top_scores, top_eos_flags, top_beam_indices, \
+            step_memories = extend_hypotheses(current_time_step,
+                                              alive_sequences,
+                                              alive_scores,
+                                              alive_memories,
+                                              encoder_outputs)
 
         # 2. Update the alive beam
         alive_sequences, alive_scores, alive_eos_flags, alive_memories = \
             update_alive(top_sequences,
                          top_scores,
                          top_eos_flags,
-                         top_memories)
+                         top_beam_indices,
+                         step_memories)
 
         # 3. Update the finished beam
         finished_sequences, finished_scores, finished_eos_flags = \
@@ -0,0 +1,156 @@
+#!/usr/bin/env python3
+
+"""Converts a parallel training corpus into flat arrays of vocabulary IDs.
+
+The binarized corpus can be read by TextIterator (see the --binarized_data
+option of train.py). For each input file PATH, two files are written:
+
+    PATH.ids.npy      int32 array containing the vocabulary IDs of every token
+                      in the file, in order. For the source side the array has
+                      shape (num_tokens, num_factors); for the target side it
+                      has shape (num_tokens,).
+    PATH.offsets.npy  int64 array of shape (num_lines+1,). Line i consists of
+                      the tokens ids[offsets[i]:offsets[i+1]].
+
+Tokens that are not in the vocabulary are mapped to the UNK ID. Vocabulary
+size limits (--source_vocab_sizes / --target_vocab_size) are not applied here,
+but by TextIterator at load time, so the same binarized corpus can be used
+with different vocabulary sizes. If the vocabulary files change, the corpus
+must be binarized again.
+"""
+
+import argparse
+import array
+import logging
+import sys
+
+import numpy
+
+# ModuleNotFoundError is new in 3.6; older versions will throw SystemError
+if sys.version_info < (3, 6):
+    ModuleNotFoundError = SystemError
+
+try:
+    from .data_iterator import fopen, determine_unk_val, \
+                               IDS_SUFFIX, OFFSETS_SUFFIX
+    from . import exception
+    from .util import load_dict
+except (ModuleNotFoundError, ImportError) as e:
+    from data_iterator import fopen, determine_unk_val, \
+                              IDS_SUFFIX, OFFSETS_SUFFIX
+    import exception
+    from util import load_dict
+
+
+def binarize_file(path, dicts):
+    """Maps every token in a text file to its vocabulary ID(s).
+
+    Args:
+        path: path of the (possibly gzipped) text file.
+        dicts: list of vocabulary dictionaries, one per factor.
+
+    Returns:
+        A pair (ids, offsets) of numpy arrays. ids has shape
+        (num_tokens, num_factors) and offsets has shape (num_lines+1,).
+    """
+    num_factors = len(dicts)
+    unk_vals = [determine_unk_val(d) for d in dicts]
+    ids = array.array('i')
+    offsets = array.array('q', [0])
+    num_tokens = 0
+    with fopen(path, 'r') as f:
+        for line_num, line in enumerate(f):
+            words = line.split()
+            for w in words:
+                if num_factors == 1:
+                    ids.append(dicts[0].get(w, unk_vals[0]))
+                    continue
+                factors = w.split('|')
+                if len(factors) != num_factors:
+                    raise exception.Error(
+                        '{0}, line {1}: expected {2} factors, but input word '
+                        'has {3}'.format(path, line_num+1, num_factors,
+                                         len(factors)))
+                for i, f in enumerate(factors):
+                    ids.append(dicts[i].get(f, unk_vals[i]))
+            num_tokens += len(words)
+            offsets.append(num_tokens)
+    ids = numpy.frombuffer(ids, dtype=numpy.int32)
+    ids = ids.reshape([num_tokens, num_factors])
+    offsets = numpy.frombuffer(offsets, dtype=numpy.int64)
+    return ids, offsets
+
+
+def save_binarized(path, ids, offsets):
+    numpy.save(path + IDS_SUFFIX, ids)
+    numpy.save(path + OFFSETS_SUFFIX, offsets)
+
+
+def binarize_corpus(source, target, source_dicts, target_dict, model_type):
+    """Binarizes a parallel corpus (see module description).
+
+    Args:
+        source: path of the source-side text file.
+        target: path of the target-side text file.
+        source_dicts: list of paths of source vocabularies (one per factor).
+        target_dict: path of the target vocabulary.
+        model_type: 'rnn' or 'transformer' (used to check the vocabularies).
+    """
+    source_dicts = [load_dict(d, model_type) for d in source_dicts]
+    target_dict = load_dict(target_dict, model_type)
+
+    logging.info('Binarizing {}...'.format(source))
+    source_ids, source_offsets = binarize_file(source, source_dicts)
+    logging.info('Binarizing {}...'.format(target))
+    target_ids, target_offsets = binarize_file(target, [target_dict])
+    target_ids = target_ids.reshape([-1])
+
+    if len(source_offsets) != len(target_offsets):
+        raise exception.Error(
+            'Source and target files have different numbers of lines '
+            '({0} vs {1})'.format(len(source_offsets)-1,
+                                  len(target_offsets)-1))
+
+    save_binarized(source, source_ids, source_offsets)
+    save_binarized(target, target_ids, target_offsets)
+    logging.info('Wrote {0} sentence pairs ({1} source tokens, {2} target '
+                 'tokens)'.format(len(source_offsets)-1, len(source_ids),
+                                  len(target_ids)))
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description='Converts a parallel corpus into the binarized format '
+                    'used by train.py --binarized_data')
+    parser.add_argument(
+        '--source_dataset', type=str, required=True, metavar='PATH',
+        help='parallel training corpus (source)')
+    parser.add_argument(
+        '--target_dataset', type=str, required=True, metavar='PATH',
+        help='parallel training corpus (target)')
+    parser.add_argument(
+        '--dictionaries', type=str, required=True, metavar='PATH', nargs='+',
+        help='network vocabularies (one per source factor, plus target '
+             'vocabulary)')
+    parser.add_argument(
+        '--model_type', type=str, default='rnn',
+        choices=['rnn', 'transformer'],
+        help='model type (default: %(default)s)')
+    args = parser.parse_args()
+    if len(args.dictionaries) < 2:
+        parser.error('--dictionaries must specify at least one source and '
+                     'one target vocabulary')
+    return args
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO,
+                        format='%(levelname)s: %(message)s')
+    args = parse_args()
+    try:
+        binarize_corpus(args.source_dataset, args.target_dataset,
+                        args.dictionaries[:-1], args.dictionaries[-1],
+                        args.model_type)
+    except exception.Error as x:
+        logging.error(x.msg)
+        sys.exit(1)
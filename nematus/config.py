@@ -725,6 +725,49 @@ class ConfigSpecification:
             action='store_true',
             help='Keep training dataset lines stores in RAM during training'))
 
+        group.append(ParameterSpecification(
+            name='binarized_data', default=False,
+            visible_arg_names=['--binarized_data'],
+            action='store_true',
+            help='read the training corpus from the memory-mapped token ID '
+                 'files written by binarize.py for --source_dataset and '
+                 '--target_dataset (instead of the text files)'))
+
+        group.append(ParameterSpecification(
+            name='indexed_train_set', default=False,
+            visible_arg_names=['--indexed_train_set'],
+            action='store_true',
+            help='read training corpus lines through a memory-mapped line '
+                 'offset index (cached as FILE.lineidx.npy), so that '
+                 'shuffling needs neither temporary files nor keeping the '
+                 'lines in RAM (ignored for compressed files)'))
+
+        group.append(ParameterSpecification(
+            name='length_bucketing', default=False,
+            visible_arg_names=['--length_bucketing'],
+            action='store_true',
+            help='form minibatches from global buckets of sentence pairs with '
+                 'the same length (instead of sorting maxibatches); requires '
+                 '--binarized_data, --indexed_train_set or '
+                 '--keep_train_set_in_memory'))
+
+        group.append(ParameterSpecification(
+            name='data_workers', default=0,
+            visible_arg_names=['--data_workers'],
+            type=int, metavar='INT',
+            help='map training corpus tokens to vocabulary IDs in INT worker '
+                 'processes (0 to do this in the training process; not used '
+                 'with --binarized_data) (default: %(default)s)'))
+
+        group.append(ParameterSpecification(
+            name='prefetch_batches', default=0,
+            visible_arg_names=['--prefetch_batches'],
+            type=int, metavar='INT',
+            help='prepare up to INT minibatches in a background thread while '
+                 'the model is being updated; the number of updates that had '
+                 'to wait for data is reported every --disp_freq updates '
+                 '(0 to disable) (default: %(default)s)'))
+
         group.append(ParameterSpecification(
             name='max_epochs', default=5000,
             visible_arg_names=['--max_epochs'],
@@ -874,6 +917,13 @@ class ConfigSpecification:
             help='Maximum length of translation output sentence (default: '
                  '%(default)s)'))
 
+        group.append(ParameterSpecification(
+            name='preallocate_kv_cache', default=False,
+            visible_arg_names=['--preallocate_kv_cache'],
+            action='store_true',
+            help='decode Transformer models with self-attention memories '
+                 'preallocated to the maximum translation length'))
+
         group.append(ParameterSpecification(
             name='translation_strategy', default='beam_search',
             visible_arg_names=['--translation_strategy'],
@@ -1295,6 +1345,21 @@ def _check_config_consistency(spec, config, set_by_user):
             arg_names_string(max_tokens_param))
         error_messages.append(msg)
 
+    if config.binarized_data and config.preprocess_script is not None:
+        msg = '--binarized_data cannot be used with --preprocess_script'
+        error_messages.append(msg)
+
+    if config.binarized_data and config.indexed_train_set:
+        msg = '--binarized_data cannot be used with --indexed_train_set'
+        error_messages.append(msg)
+
+    if config.length_bucketing and not (config.binarized_data
+                                        or config.indexed_train_set
+                                        or config.keep_train_set_in_memory):
+        msg = '--length_bucketing requires --binarized_data, ' \
+              '--indexed_train_set or --keep_train_set_in_memory'
+        error_messages.append(msg)
+
     # softmax_mixture_size and lexical_model are currently mutually exclusive:
     if config.softmax_mixture_size > 1 and config.rnn_lexical_model:
        error_messages.append('behavior of --rnn_lexical_model is undefined if softmax_mixture_size > 1')
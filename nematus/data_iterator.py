@@ -3,30 +3,109 @@ import numpy
 import logging
 
 import gzip
+import itertools
+import mmap
+import multiprocessing
+import os
+import tempfile
 
 import subprocess
+import weakref
 
 # ModuleNotFoundError is new in 3.6; older versions will throw SystemError
 if sys.version_info < (3, 6):
     ModuleNotFoundError = SystemError
 
 try:
+    from . import exception
     from .util import load_dict
     from . import shuffle
+    from .streaming_reader import StreamingReader, is_compressed
 except (ModuleNotFoundError, ImportError) as e:
+    import exception
     from util import load_dict
     import shuffle
+    from streaming_reader import StreamingReader, is_compressed
+
+# Suffixes of the files written by binarize.py.
+IDS_SUFFIX = '.ids.npy'
+OFFSETS_SUFFIX = '.offsets.npy'
+
+# Suffixes of the line index and line length files written by IndexedFile.
+LINE_INDEX_SUFFIX = '.lineidx.npy'
+LINE_LENGTHS_SUFFIX = '.linelen.npy'
 
 def fopen(filename, mode='r'):
+    if mode == 'r' and is_compressed(filename):
+        return StreamingReader(filename, encoding="UTF-8")
     if filename.endswith('.gz'):
         return gzip.open(filename, mode, encoding="UTF-8")
     return open(filename, mode, encoding="UTF-8")
 
+def determine_unk_val(d):
+    # The UNK value depends on which version of build_dictionary.py was used.
+    if '<UNK>' in d and d['<UNK>'] == 2:
+        return 2
+    return 1
+
+# Per-process state of the worker processes used by TextIterator to map
+# tokens to IDs (see _init_worker and _encode_lines).
+_worker_state = None
+
+def _split_factors(word, num_factors):
+    factors = word.split('|')
+    if len(factors) != num_factors:
+        raise exception.Error(
+            'Expected {0} factors, but input word has {1}\n'.format(
+                num_factors, len(factors)))
+    return factors
+
+def _init_worker(state):
+    global _worker_state
+    _worker_state = state
+
+def _encode_lines(line_pairs):
+    """Maps (source line, target line) pairs to packed arrays of token IDs.
+
+    This runs in a worker process. Pairs that are empty (if skip_empty) or
+    longer than maxlen are dropped, as in TextIterator.
+
+    Returns:
+        A tuple (source_ids, source_lengths, target_ids, target_lengths) of
+        int32 arrays; source_ids has shape (num_source_tokens, num_factors).
+    """
+    (source_dicts, source_unk_vals, target_dict, target_unk_val,
+     use_factor, maxlen, skip_empty) = _worker_state
+    source_ids, source_lengths = [], []
+    target_ids, target_lengths = [], []
+    for ss, tt in line_pairs:
+        ss = ss.split()
+        tt = tt.split()
+        if skip_empty and (len(ss) == 0 or len(tt) == 0):
+            continue
+        if len(ss) > maxlen or len(tt) > maxlen:
+            continue
+        for w in ss:
+            if use_factor:
+                for (i, f) in enumerate(_split_factors(w, len(source_dicts))):
+                    source_ids.append(source_dicts[i].get(f,
+                                                          source_unk_vals[i]))
+            else:
+                source_ids.append(source_dicts[0].get(w, source_unk_vals[0]))
+        target_ids.extend(target_dict.get(w, target_unk_val) for w in tt)
+        source_lengths.append(len(ss))
+        target_lengths.append(len(tt))
+    source_ids = numpy.array(source_ids, dtype=numpy.int32)
+    return (source_ids.reshape([-1, len(source_dicts)]),
+            numpy.array(source_lengths, dtype=numpy.int32),
+            numpy.array(target_ids, dtype=numpy.int32),
+            numpy.array(target_lengths, dtype=numpy.int32))
+
 class FileWrapper(object):
     def __init__(self, fname):
         self.pos = 0
         self.lines = fopen(fname).readlines()
-        self.lines = numpy.array(self.lines, dtype=numpy.object)
+        self.lines = numpy.array(self.lines, dtype=object)
     def __iter__(self):
         return self
     def __next__(self):
@@ -47,6 +126,222 @@ class FileWrapper(object):
         self.pos = 0
     def __len__(self):
         return len(self.lines)
+    def get_line(self, i):
+        return self.lines[i]
+    def line_lengths(self):
+        return numpy.fromiter((len(l.split()) for l in self.lines),
+                              dtype=numpy.int32, count=len(self.lines))
+
+class IndexedFile(object):
+    """Line-by-line access to a (non-compressed) text file via mmap.
+
+    Provides the same interface as FileWrapper, but instead of keeping the
+    lines in memory, it only keeps an array of line start offsets. The index
+    is built on first use and cached next to the file (in
+    fname + LINE_INDEX_SUFFIX), so subsequent runs can load it directly.
+    Shuffling permutes an array of line numbers.
+    """
+    # Files are scanned for newlines in blocks of this many bytes.
+    BLOCK_SIZE = 2**26
+
+    def __init__(self, fname):
+        self.fname = fname
+        self.file = open(fname, 'rb')
+        size = os.fstat(self.file.fileno()).st_size
+        # mmap cannot map empty files.
+        self.data = (mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+                     if size > 0 else b'')
+        self.offsets = self._load_or_build_index(size)
+        self.order = None
+        self.pos = 0
+
+    def _load_or_build_index(self, size):
+        return self._load_or_build_cache(
+            LINE_INDEX_SUFFIX, 'line index',
+            lambda offsets: len(offsets) > 0 and offsets[-1] == size,
+            lambda: self._build_index(size))
+
+    def _load_or_build_cache(self, suffix, description, is_valid, build):
+        cache_path = self.fname + suffix
+        try:
+            if os.path.getmtime(cache_path) >= os.path.getmtime(self.fname):
+                array = numpy.load(cache_path)
+                if is_valid(array):
+                    return array
+        except (OSError, ValueError):
+            pass
+        logging.info('Building {0} for {1}...'.format(description,
+                                                      self.fname))
+        array = build()
+        try:
+            # Write to a temporary file first, so that concurrent runs never
+            # see a partially written file.
+            dirname = os.path.dirname(os.path.abspath(cache_path))
+            with tempfile.NamedTemporaryFile(dir=dirname, suffix='.npy',
+                                             delete=False) as f:
+                numpy.save(f, array)
+            os.replace(f.name, cache_path)
+        except OSError as e:
+            logging.warning('Could not save {0} {1}: {2}'.format(
+                description, cache_path, e))
+        return array
+
+    def _build_index(self, size):
+        starts = [numpy.zeros(1, dtype=numpy.int64)]
+        for block_start in range(0, size, self.BLOCK_SIZE):
+            block = numpy.frombuffer(
+                self.data[block_start:block_start+self.BLOCK_SIZE],
+                dtype=numpy.uint8)
+            newlines = numpy.flatnonzero(block == ord('\n'))
+            starts.append(newlines.astype(numpy.int64) + (block_start + 1))
+        offsets = numpy.concatenate(starts)
+        if offsets[-1] != size:
+            # The last line has no trailing newline.
+            offsets = numpy.append(offsets, size)
+        return offsets
+
+    def __iter__(self):
+        return self
+    def __next__(self):
+        if self.pos >= len(self):
+            raise StopIteration
+        i = self.pos if self.order is None else self.order[self.pos]
+        self.pos += 1
+        return self.get_line(i)
+    def reset(self):
+        self.pos = 0
+    def seek(self, pos):
+        assert pos == 0
+        self.pos = 0
+    def readline(self):
+        return next(self)
+    def shuffle_lines(self, perm):
+        self.order = perm
+        self.pos = 0
+    def __len__(self):
+        return len(self.offsets) - 1
+    def get_line(self, i):
+        return self.data[self.offsets[i]:self.offsets[i+1]].decode('UTF-8')
+    def close(self):
+        if isinstance(self.data, mmap.mmap):
+            self.data.close()
+        self.file.close()
+    def line_lengths(self):
+        """Returns the number of tokens in each line (cached on disk)."""
+        def count():
+            return numpy.fromiter(
+                (len(self.get_line(i).split()) for i in range(len(self))),
+                dtype=numpy.int32, count=len(self))
+        return self._load_or_build_cache(
+            LINE_LENGTHS_SUFFIX, 'line lengths',
+            lambda lengths: len(lengths) == len(self), count)
+
+class BinarizedCorpus(object):
+    """Memory-mapped parallel corpus in the format written by binarize.py.
+
+    Sentence pairs are read by line number, so no per-line Python objects are
+    kept in memory and shuffling only permutes an array of line numbers.
+    """
+    def __init__(self, source, target):
+        self.source_ids, self.source_offsets = self._load(source)
+        self.target_ids, self.target_offsets = self._load(target)
+        if len(self.source_offsets) != len(self.target_offsets):
+            raise exception.Error(
+                'Binarized source and target corpora have different numbers '
+                'of lines ({0} vs {1})'.format(len(self.source_offsets)-1,
+                                               len(self.target_offsets)-1))
+        self.source_lengths = numpy.diff(self.source_offsets)
+        self.target_lengths = numpy.diff(self.target_offsets)
+        dtype = numpy.uint32 if len(self) < 2**32 else numpy.int64
+        self.order = numpy.arange(len(self), dtype=dtype)
+        self.pos = 0
+
+    @staticmethod
+    def _load(path):
+        ids = numpy.load(path + IDS_SUFFIX, mmap_mode='r')
+        offsets = numpy.load(path + OFFSETS_SUFFIX, mmap_mode='r')
+        return ids, offsets
+
+    def __len__(self):
+        return len(self.source_lengths)
+
+    def seek(self, pos):
+        assert pos == 0
+        self.pos = 0
+
+    def shuffle_lines(self):
+        numpy.random.shuffle(self.order)
+        self.pos = 0
+
+    def next_indices(self, n):
+        """Returns the line numbers of (up to) the next n sentence pairs."""
+        idxs = self.order[self.pos:self.pos+n]
+        self.pos += len(idxs)
+        return idxs
+
+    def get_pair(self, i):
+        """Returns the source and target ID arrays for line i.
+
+        The source array has shape (length, factors) and the target array has
+        shape (length,).
+        """
+        ss = self.source_ids[self.source_offsets[i]:self.source_offsets[i+1]]
+        tt = self.target_ids[self.target_offsets[i]:self.target_offsets[i+1]]
+        return ss, tt
+
+class LengthBucketSampler(object):
+    """Groups the sentence pairs of a corpus into minibatches by length.
+
+    Sentence pairs are put into buckets according to max(source length,
+    target length), so a minibatch contains only pairs from one bucket and
+    needs hardly any padding. Unlike the maxibatch sorting done by
+    TextIterator, this uses the lengths of the whole corpus, which are held
+    in a compact array. If shuffle is True, the pairs within each bucket and
+    the order of the minibatches are randomized for every epoch.
+    """
+    def __init__(self, source_lengths, target_lengths, batch_size,
+                 token_batch_size, maxlen, skip_empty, shuffle):
+        keep = (source_lengths <= maxlen) & (target_lengths <= maxlen)
+        if skip_empty:
+            keep &= (source_lengths > 0) & (target_lengths > 0)
+        lengths = numpy.maximum(source_lengths, target_lengths)[keep]
+        indices = numpy.flatnonzero(keep)
+        # Line numbers sorted by length, plus the bucket boundaries.
+        order = numpy.argsort(lengths, kind='stable')
+        self.sorted_indices = indices[order]
+        bucket_lengths, starts = numpy.unique(lengths[order],
+                                              return_index=True)
+        ends = numpy.append(starts[1:], len(order))
+        self.buckets = []
+        for length, start, end in zip(bucket_lengths, starts, ends):
+            if token_batch_size:
+                size = max(1, token_batch_size // max(1, length))
+            else:
+                size = batch_size
+            self.buckets.append((start, end, size))
+        self.shuffle = shuffle
+        self.new_epoch()
+
+    def new_epoch(self):
+        self.batches = []
+        for start, end, size in self.buckets:
+            bucket = self.sorted_indices[start:end]
+            if self.shuffle:
+                bucket = numpy.random.permutation(bucket)
+            self.batches += [bucket[i:i+size]
+                             for i in range(0, len(bucket), size)]
+        if self.shuffle:
+            perm = numpy.random.permutation(len(self.batches))
+            self.batches = [self.batches[i] for i in perm]
+        self.pos = 0
+
+    def next_batch(self):
+        """Returns the line numbers of the next minibatch (None at the end of
+        the epoch)."""
+        if self.pos >= len(self.batches):
+            return None
+        self.pos += 1
+        return self.batches[self.pos-1]
 
 class TextIterator:
     """Simple Bitext iterator."""
@@ -64,18 +359,36 @@ class TextIterator:
                  maxibatch_size=20,
                  token_batch_size=0,
                  keep_data_in_memory=False,
-                 preprocess_script=None):
+                 preprocess_script=None,
+                 binarized=False,
+                 indexed=False,
+                 length_bucketing=False,
+                 num_workers=0):
         self.preprocess_script = preprocess_script
         self.source_orig = source
         self.target_orig = target
+        self.binarized = binarized
+        self.keep_data_in_memory = keep_data_in_memory
+        self.indexed = indexed
+        # Whether the corpus is accessed by line number via a
+        # LengthBucketSampler (only for binarized or random-access corpora).
+        self.length_bucketing = length_bucketing
+        assert not length_bucketing or binarized or indexed or \
+            keep_data_in_memory
         if self.preprocess_script:
             logging.info("Executing external preprocessing script...")
             proc = subprocess.Popen(self.preprocess_script)
             proc.wait()
             logging.info("done")
-        if keep_data_in_memory:
-            self.source, self.target = FileWrapper(source), FileWrapper(target)
-            if shuffle_each_epoch:
+        if binarized:
+            # source and target are the paths that were passed to binarize.py
+            assert not preprocess_script
+            self.corpus = BinarizedCorpus(source, target)
+            if shuffle_each_epoch and not length_bucketing:
+                self.corpus.shuffle_lines()
+        elif keep_data_in_memory or indexed:
+            self.source, self.target = self._open_random_access()
+            if shuffle_each_epoch and not length_bucketing:
                 r = numpy.random.permutation(len(self.source))
                 self.source.shuffle_lines(r)
                 self.target.shuffle_lines(r)
@@ -90,20 +403,12 @@ class TextIterator:
             self.source_dicts.append(load_dict(source_dict, model_type))
         self.target_dict = load_dict(target_dict, model_type)
 
-        # Determine the UNK value for each dictionary (the value depends on
-        # which version of build_dictionary.py was used).
-
-        def determine_unk_val(d):
-            if '<UNK>' in d and d['<UNK>'] == 2:
-                return 2
-            return 1
-
+        # Determine the UNK value for each dictionary.
         self.source_unk_vals = [determine_unk_val(d)
                                 for d in self.source_dicts]
         self.target_unk_val = determine_unk_val(self.target_dict)
 
 
-        self.keep_data_in_memory = keep_data_in_memory
         self.batch_size = batch_size
         self.maxlen = maxlen
         self.skip_empty = skip_empty
@@ -127,12 +432,52 @@ class TextIterator:
                 if idx >= self.target_vocab_size:
                     del self.target_dict[key]
 
+        if self.binarized:
+            # Binarized corpora contain IDs from the full vocabularies, so
+            # vocabulary size limits are applied when sentences are read.
+            no_limit = numpy.iinfo(numpy.int32).max
+            sizes = self.source_vocab_sizes or [None] * len(self.source_dicts)
+            self.source_id_limits = numpy.array(
+                [no_limit if s == None or s <= 0 else s for s in sizes])
+            self.source_unk_array = numpy.array(self.source_unk_vals)
+            if (self.target_vocab_size != None
+                and self.target_vocab_size > 0):
+                self.target_id_limit = self.target_vocab_size
+            else:
+                self.target_id_limit = no_limit
+            if self.corpus.source_ids.shape[1] != len(self.source_dicts):
+                raise exception.Error(
+                    'Binarized corpus has {0} source factors, but {1} source '
+                    'dictionaries were given'.format(
+                        self.corpus.source_ids.shape[1],
+                        len(self.source_dicts)))
+
         self.shuffle = shuffle_each_epoch
         self.sort_by_length = sort_by_length
 
         self.source_buffer = []
         self.target_buffer = []
         self.k = batch_size * maxibatch_size
+
+        if self.length_bucketing:
+            self.sampler = self._build_sampler()
+
+        # Optionally, map tokens to IDs in worker processes. The pool's map()
+        # preserves the order of the input, so the minibatches are the same as
+        # with num_workers=0.
+        self.pool = None
+        if num_workers > 0 and not self.binarized:
+            state = (self.source_dicts, self.source_unk_vals,
+                     self.target_dict, self.target_unk_val,
+                     self.use_factor, self.maxlen, self.skip_empty)
+            self.pool = multiprocessing.Pool(num_workers,
+                                             initializer=_init_worker,
+                                             initargs=(state,))
+            self.num_chunks = 4 * num_workers
+            # Stop the workers if the iterator is not closed explicitly.
+            self._finalize_pool = weakref.finalize(self, self.pool.terminate)
+        self.pending_source = []
+        self.pending_target = []
         
 
         self.end_of_data = False
@@ -140,30 +485,91 @@ class TextIterator:
     def __iter__(self):
         return self
 
+    def close(self):
+        """Stops the worker processes (if any) and closes the input files."""
+        if self.pool is not None:
+            self._finalize_pool()
+            self.pool.join()
+            self.pool = None
+        if not self.binarized:
+            self._close_files()
+
+    def _close_files(self):
+        # FileWrapper keeps all lines in memory and has nothing to close.
+        for f in (self.source, self.target):
+            if hasattr(f, 'close'):
+                f.close()
+
     def reset(self):
+        if self.length_bucketing:
+            if self.preprocess_script:
+                self._close_files()
+                logging.info("Executing external preprocessing script...")
+                proc = subprocess.Popen(self.preprocess_script)
+                proc.wait()
+                logging.info("done")
+                self.source, self.target = self._open_random_access()
+                self.sampler = self._build_sampler()
+            else:
+                self.sampler.new_epoch()
+            return
+        if self.binarized:
+            if self.shuffle:
+                self.corpus.shuffle_lines()
+            else:
+                self.corpus.seek(0)
+            return
         if self.preprocess_script:
+            self._close_files()
             logging.info("Executing external preprocessing script...")
             proc = subprocess.Popen(self.preprocess_script)
             proc.wait()
             logging.info("done")
-            if self.keep_data_in_memory:
-                self.source, self.target = FileWrapper(self.source_orig), FileWrapper(self.target_orig)
+            if self.keep_data_in_memory or self.indexed:
+                self.source, self.target = self._open_random_access()
             else:
                 self.source = fopen(self.source_orig, 'r')
                 self.target = fopen(self.target_orig, 'r')
         if self.shuffle:
-            if self.keep_data_in_memory:
+            if self.keep_data_in_memory or self.indexed:
                 r = numpy.random.permutation(len(self.source))
                 self.source.shuffle_lines(r)
                 self.target.shuffle_lines(r)
             else:
+                self._close_files()
                 self.source, self.target = shuffle.jointly_shuffle_files(
                     [self.source_orig, self.target_orig], temporary=True)
         else:
             self.source.seek(0)
             self.target.seek(0)
 
+    def _open_random_access(self):
+        files = []
+        for path in (self.source_orig, self.target_orig):
+            if self.indexed and not is_compressed(path):
+                files.append(IndexedFile(path))
+            else:
+                files.append(FileWrapper(path))
+        return files
+
+    def _build_sampler(self):
+        if self.binarized:
+            source_lengths = self.corpus.source_lengths
+            target_lengths = self.corpus.target_lengths
+        else:
+            source_lengths = self.source.line_lengths()
+            target_lengths = self.target.line_lengths()
+        return LengthBucketSampler(source_lengths, target_lengths,
+                                   batch_size=self.batch_size,
+                                   token_batch_size=self.token_batch_size,
+                                   maxlen=self.maxlen,
+                                   skip_empty=self.skip_empty,
+                                   shuffle=self.shuffle)
+
     def __next__(self):
+        if self.length_bucketing:
+            return self._next_bucketed_batch()
+
         if self.end_of_data:
             self.end_of_data = False
             self.reset()
@@ -179,19 +585,12 @@ class TextIterator:
         assert len(self.source_buffer) == len(self.target_buffer), 'Buffer size mismatch!'
 
         if len(self.source_buffer) == 0:
-            for ss in self.source:
-                ss = ss.split()
-                tt = self.target.readline().split()
-                
-                if self.skip_empty and (len(ss) == 0 or len(tt) == 0):
-                    continue
-                if len(ss) > self.maxlen or len(tt) > self.maxlen:
-                    continue
-
-                self.source_buffer.append(ss)
-                self.target_buffer.append(tt)
-                if len(self.source_buffer) == self.k:
-                    break
+            if self.binarized:
+                self._fill_buffers_from_corpus()
+            elif self.pool:
+                self._fill_buffers_in_parallel()
+            else:
+                self._fill_buffers_from_text()
 
             if len(self.source_buffer) == 0 or len(self.target_buffer) == 0:
                 self.end_of_data = False
@@ -213,9 +612,6 @@ class TextIterator:
                 self.source_buffer.reverse()
                 self.target_buffer.reverse()
 
-        def lookup_token(t, d, unk_val):
-            return d[t] if t in d else unk_val
-
         try:
             # actual work here
             while True:
@@ -225,26 +621,13 @@ class TextIterator:
                     ss = self.source_buffer.pop()
                 except IndexError:
                     break
-                tmp = []
-                for w in ss:
-                    if self.use_factor:
-                        w = [lookup_token(f, self.source_dicts[i],
-                                          self.source_unk_vals[i])
-                             for (i, f) in enumerate(w.split('|'))]
-                    else:
-                        w = [lookup_token(w, self.source_dicts[0],
-                                          self.source_unk_vals[0])]
-                    tmp.append(w)
-                ss_indices = tmp
-
-                # read from source file and map to word index
                 tt = self.target_buffer.pop()
-                tt_indices = [lookup_token(w, self.target_dict,
-                                           self.target_unk_val) for w in tt]
-                if self.target_vocab_size != None:
-                    tt_indices = [w if w < self.target_vocab_size
-                                    else self.target_unk_val
-                                  for w in tt_indices]
+                if self.binarized or self.pool:
+                    # the buffers already contain word indices
+                    ss_indices = ss
+                    tt_indices = tt
+                else:
+                    ss_indices, tt_indices = self._map_to_indices(ss, tt)
 
                 source.append(ss_indices)
                 target.append(tt_indices)
@@ -270,3 +653,127 @@ class TextIterator:
             self.end_of_data = True
 
         return source, target
+
+    def _map_to_indices(self, ss, tt):
+        def lookup_token(t, d, unk_val):
+            return d[t] if t in d else unk_val
+
+        tmp = []
+        for w in ss:
+            if self.use_factor:
+                factors = _split_factors(w, len(self.source_dicts))
+                w = [lookup_token(f, self.source_dicts[i],
+                                  self.source_unk_vals[i])
+                     for (i, f) in enumerate(factors)]
+            else:
+                w = [lookup_token(w, self.source_dicts[0],
+                                  self.source_unk_vals[0])]
+            tmp.append(w)
+        ss_indices = tmp
+
+        # map target words to word index
+        tt_indices = [lookup_token(w, self.target_dict, self.target_unk_val)
+                      for w in tt]
+        if self.target_vocab_size != None:
+            tt_indices = [w if w < self.target_vocab_size
+                            else self.target_unk_val
+                          for w in tt_indices]
+        return ss_indices, tt_indices
+
+    def _limit_ids(self, ss, tt):
+        # Applies the vocabulary size limits to binarized ID arrays.
+        ss = numpy.where(ss < self.source_id_limits, ss,
+                         self.source_unk_array)
+        tt = numpy.where(tt < self.target_id_limit, tt, self.target_unk_val)
+        return ss.tolist(), tt.tolist()
+
+    def _next_bucketed_batch(self):
+        idxs = self.sampler.next_batch()
+        if idxs is None:
+            self.reset()
+            raise StopIteration
+        if self.pool:
+            line_pairs = [(self.source.get_line(i), self.target.get_line(i))
+                          for i in idxs]
+            return self._encode_in_parallel(line_pairs)
+        source = []
+        target = []
+        for i in idxs:
+            if self.binarized:
+                ss, tt = self._limit_ids(*self.corpus.get_pair(i))
+            else:
+                ss, tt = self._map_to_indices(
+                    self.source.get_line(i).split(),
+                    self.target.get_line(i).split())
+            source.append(ss)
+            target.append(tt)
+        return source, target
+
+    def _encode_in_parallel(self, line_pairs):
+        # Maps a list of line pairs to the TextIterator minibatch format,
+        # using the worker pool.
+        chunk_size = -(-len(line_pairs) // self.num_chunks)
+        chunks = [line_pairs[i:i+chunk_size]
+                  for i in range(0, len(line_pairs), chunk_size)]
+        source, target = [], []
+        for (source_ids, source_lengths,
+             target_ids, target_lengths) in self.pool.map(_encode_lines,
+                                                          chunks):
+            if len(source_lengths) == 0:
+                continue
+            source += [a.tolist() for a in numpy.split(
+                source_ids, numpy.cumsum(source_lengths)[:-1])]
+            target += [a.tolist() for a in numpy.split(
+                target_ids, numpy.cumsum(target_lengths)[:-1])]
+        return source, target
+
+    def _fill_buffers_in_parallel(self):
+        # Reads the next k line pairs at a time, but only adds as many
+        # (length-filtered) pairs to the buffers as would be added by
+        # _fill_buffers_from_text; the rest is kept for the next call.
+        while len(self.source_buffer) < self.k:
+            if not self.pending_source:
+                line_pairs = list(itertools.islice(
+                    zip(self.source, self.target), self.k))
+                if not line_pairs:
+                    break
+                self.pending_source, self.pending_target = \
+                    self._encode_in_parallel(line_pairs)
+            n = self.k - len(self.source_buffer)
+            self.source_buffer += self.pending_source[:n]
+            self.target_buffer += self.pending_target[:n]
+            del self.pending_source[:n]
+            del self.pending_target[:n]
+
+    def _fill_buffers_from_text(self):
+        for ss in self.source:
+            ss = ss.split()
+            tt = self.target.readline().split()
+
+            if self.skip_empty and (len(ss) == 0 or len(tt) == 0):
+                continue
+            if len(ss) > self.maxlen or len(tt) > self.maxlen:
+                continue
+
+            self.source_buffer.append(ss)
+            self.target_buffer.append(tt)
+            if len(self.source_buffer) == self.k:
+                break
+
+    def _fill_buffers_from_corpus(self):
+        # Length filtering is done on the precomputed length arrays; only the
+        # selected sentence pairs are read from the memory-mapped corpus.
+        while len(self.source_buffer) < self.k:
+            idxs = self.corpus.next_indices(self.k - len(self.source_buffer))
+            if len(idxs) == 0:
+                break
+            source_lengths = self.corpus.source_lengths[idxs]
+            target_lengths = self.corpus.target_lengths[idxs]
+            keep = (source_lengths <= self.maxlen) & \
+                   (target_lengths <= self.maxlen)
+            if self.skip_empty:
+                keep &= (source_lengths > 0) & (target_lengths > 0)
+            for i in idxs[keep]:
+                ss, tt = self._limit_ids(*self.corpus.get_pair(i))
+                self.source_buffer.append(ss)
+                self.target_buffer.append(tt)
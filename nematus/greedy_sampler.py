@@ -0,0 +1,225 @@
+import sys
+import tensorflow as tf
+
+# ModuleNotFoundError is new in 3.6; older versions will throw SystemError
+if sys.version_info < (3, 6):
+    ModuleNotFoundError = SystemError
+
+try:
+    from . import exception
+    from . import rnn_inference
+    from . import sampler_inputs
+    from .transformer import INT_DTYPE, FLOAT_DTYPE
+    from . import transformer_inference
+except (ModuleNotFoundError, ImportError) as e:
+    import exception
+    import rnn_inference
+    import sampler_inputs
+    from transformer import INT_DTYPE, FLOAT_DTYPE
+    import transformer_inference
+
+
+class GreedySampler:
+    """Implements greedy decoding with one or more models.
+
+    At each timestep, the most probable token is appended to each translation
+    (if there are multiple models, according to the sum of the models' log
+    probabilities). This is equivalent to beam search with a beam size of 1,
+    but needs none of the bookkeeping for alive and finished hypotheses: the
+    memories are never reordered, and translations that have produced <EOS>
+    are simply extended with further <EOS> tokens until all are finished.
+
+    GreedySampler has the same interface as BeamSearchSampler (with a fixed
+    beam_size of 1): prior to running the sampler, the placeholders in
+    self.inputs must be fed appropriate values (see the SamplerInputs class)
+    and the resulting sample can be accessed via the outputs() property.
+
+    See also: BeamSearchSampler, RandomSampler.
+    """
+
+    def __init__(self, models, configs, shortlist=None):
+        """Sets some things up then calls _greedy_decode() to do the real work.
+
+        Args:
+            models: a sequence of RNN or Transformer objects.
+            configs: a sequence of model configs (argparse.Namespace objects).
+            shortlist: a Shortlist object or None (see BeamSearchSampler).
+        """
+        self._models = models
+        self._configs = configs
+        self._shortlist = shortlist
+
+        with tf.compat.v1.name_scope('greedy_sampler'):
+
+            # Define placeholders.
+            self.inputs = sampler_inputs.SamplerInputs()
+
+            # Create model adapters to get a consistent interface to
+            # Transformer and RNN models.
+            model_adapters = []
+            for i, (model, config) in enumerate(zip(models, configs)):
+                with tf.compat.v1.name_scope('model_adapter_{}'.format(i)) as scope:
+                    if config.model_type == 'transformer':
+                        adapter = transformer_inference.ModelAdapter(
+                            model, config, scope)
+                    else:
+                        assert config.model_type == 'rnn'
+                        adapter = rnn_inference.ModelAdapter(
+                            model, config, scope)
+                    model_adapters.append(adapter)
+
+            # Check that individual models are compatible with each other.
+            vocab_sizes = [a.target_vocab_size for a in model_adapters]
+            if len(set(vocab_sizes)) > 1:
+                raise exception.Error('Cannot ensemble models with different '
+                                      'target vocabulary sizes')
+
+            # Build the graph to do the actual work.
+            sequences, scores = _greedy_decode(
+                model_adapters=model_adapters,
+                batch_size_x=self.inputs.batch_size_x,
+                max_translation_len=self.inputs.max_translation_len,
+                normalization_alpha=self.inputs.normalization_alpha,
+                eos_id=0,
+                output_ids=(None if shortlist is None
+                            else self.inputs.shortlist))
+
+            self._outputs = sequences, scores
+
+    @property
+    def outputs(self):
+        return self._outputs
+
+    @property
+    def models(self):
+        return self._models
+
+    @property
+    def configs(self):
+        return self._configs
+
+    @property
+    def beam_size(self):
+        return 1
+
+    @property
+    def shortlist(self):
+        return self._shortlist
+
+
+def _greedy_decode(model_adapters, batch_size_x, max_translation_len,
+                   normalization_alpha, eos_id, output_ids=None):
+    """See description of GreedySampler above.
+
+    Args:
+        model_adapters: sequence of ModelAdapter objects.
+        batch_size_x: tf.int32 scalar specifying number of input sentences.
+        max_translation_len: tf.int32 scalar specifying max translation length.
+        normalization_alpha: tf.float32 scalar specifying alpha parameter for
+            length normalization.
+        eos_id: integer specifying the vocabulary ID of the EOS symbol.
+        output_ids: optional tf.int32 vector of the target vocabulary IDs
+            that can be output (including eos_id).
+
+    Returns:
+        A pair of tensors: (sequences, scores). sequences contains vocabulary
+        IDs. It has shape (batch_size_x, 1, len), where len <=
+        max_translation_len is the length of the longest translation in the
+        batch. scores contains the (optionally length-normalized) sequence
+        log probabilities and has shape (batch_size_x, 1).
+    """
+
+    # Encode the input and generate a 1-step decoding function for each model.
+    decoding_functions = []
+    for adapter in model_adapters:
+        encoder_output = adapter.encode()
+        func = adapter.generate_decoding_function(encoder_output, output_ids)
+        decoding_functions.append(func)
+
+    # Initialize the timestep counter.
+    current_time_step = tf.constant(1)
+
+    # Initialize sequences with <GO>.
+    sequences = tf.ones([batch_size_x, 1], dtype=INT_DTYPE)
+
+    # Initialize sequence scores and lengths (including <EOS>).
+    scores = tf.zeros([batch_size_x], dtype=FLOAT_DTYPE)
+    lengths = tf.zeros([batch_size_x], dtype=INT_DTYPE)
+
+    # Flags indicating which sequences are finished.
+    finished = tf.fill([batch_size_x], False)
+
+    # Initialize memories (i.e. states carried over from last timestep).
+    memories = [ma.generate_initial_memories(batch_size_x, 1,
+                                             max_translation_len)
+                for ma in model_adapters]
+
+    def loop_cond(current_time_step, sequences, scores, lengths, memories,
+                  finished):
+        return tf.logical_and(tf.less(current_time_step, max_translation_len),
+                              tf.logical_not(tf.reduce_all(input_tensor=finished)))
+
+    def loop_body(current_time_step, sequences, scores, lengths, memories,
+                  finished):
+
+        # Calculate next token log probs for each model and sum them.
+        step_ids = sequences[:, -1]
+        sum_log_probs = None
+        for i in range(len(decoding_functions)):
+            step_logits, memories[i] = decoding_functions[i](
+                step_ids, current_time_step, memories[i])
+            log_probs = tf.nn.log_softmax(step_logits, axis=-1)
+            if sum_log_probs is None:
+                sum_log_probs = log_probs
+            else:
+                sum_log_probs += log_probs
+
+        # Pick the most probable token and its log probability.
+        best = tf.argmax(input=sum_log_probs, axis=-1, output_type=INT_DTYPE)
+        increments = tf.reduce_max(input_tensor=sum_log_probs, axis=-1)
+        next_ids = best if output_ids is None else tf.gather(output_ids, best)
+
+        # Finished sequences are padded with <EOS> and keep their score.
+        next_ids = tf.compat.v1.where(finished,
+                                      tf.fill([batch_size_x], eos_id),
+                                      next_ids)
+        scores += tf.compat.v1.where(finished, tf.zeros_like(increments),
+                                     increments)
+        lengths += tf.cast(tf.logical_not(finished), INT_DTYPE)
+
+        sequences = tf.concat([sequences, tf.expand_dims(next_ids, 1)], 1)
+        finished |= tf.equal(next_ids, eos_id)
+
+        return current_time_step+1, sequences, scores, lengths, memories, \
+               finished
+
+    loop_vars = [current_time_step, sequences, scores, lengths, memories,
+                 finished]
+
+    shape_invariants=[
+        tf.TensorShape([]),                             # timestep
+        tf.TensorShape([None, None]),                   # sequences
+        tf.TensorShape([None]),                         # scores
+        tf.TensorShape([None]),                         # lengths
+        [adapter.get_memory_invariants(mems)            # memories
+         for adapter, mems in zip(model_adapters, memories)],
+        tf.TensorShape([None])]                         # finished
+
+    _, sequences, scores, lengths, _, _ = \
+        tf.nest.map_structure(tf.stop_gradient, tf.while_loop(cond=loop_cond,
+                      body=loop_body,
+                      loop_vars=loop_vars,
+                      shape_invariants=shape_invariants,
+                      parallel_iterations=10,
+                      swap_memory=False))
+
+    # Truncate sequences to remove leading <GO> tokens.
+    sequences = sequences[:, 1:]
+
+    # Normalize scores.
+    float_lengths = tf.cast(tf.maximum(lengths, 1), dtype=tf.float32)
+    length_penalties = float_lengths ** normalization_alpha
+    scores = scores / length_penalties
+
+    # Add the beam dimension.
+    return tf.expand_dims(sequences, 1), tf.expand_dims(scores, 1)
@@ -85,12 +85,19 @@ class FeedForwardLayer(object):
             self.dropout_mask = dropout_input(ones)
 
 
-    def forward(self, x, input_is_3d=False):
+    def forward(self, x, input_is_3d=False, output_ids=None):
+        """Computes the layer output, or only the outputs with indices
+        output_ids (if given)."""
         x = apply_dropout_mask(x, self.dropout_mask, input_is_3d)
+        W, b = self.W, self.b
+        if output_ids is not None:
+            assert not self.use_layer_norm
+            W = tf.gather(W, output_ids, axis=1)
+            b = tf.gather(b, output_ids)
         if input_is_3d:
-            y = matmul3d(x, self.W) + self.b
+            y = matmul3d(x, W) + b
         else:
-            y = tf.matmul(x, self.W) + self.b
+            y = tf.matmul(x, W) + b
         if self.use_layer_norm:
             y = self.layer_norm.forward(y)
         y = self.non_linearity(y)
@@ -43,8 +43,6 @@ class RandomSampler:
     scores contains floats representing the length-normalized log
     probabilities. It has the shape (batch_size_x, beam_size).
 
-    TODO Make beam_size a placeholder?
-
     See also: BeamSearchSampler.
     """
 
@@ -54,7 +52,9 @@ class RandomSampler:
         Args:
             models: a sequence of RNN or Transformer objects.
             configs: a sequence of model configs (argparse.Namespace objects).
-            beam_size: integer specifying the beam width.
+            beam_size: integer specifying the default beam width. The width
+                is fed via self.inputs.beam_size, so the same sampler can be
+                run with any beam size.
         """
         self._models = models
         self._configs = configs
@@ -82,7 +82,7 @@ class RandomSampler:
             # Build the graph to do the actual work.
             sequences, scores = _random_sample(
                 model_adapters=model_adapters,
-                beam_size=beam_size,
+                beam_size=self.inputs.beam_size,
                 batch_size_x=self.inputs.batch_size_x,
                 max_translation_len=self.inputs.max_translation_len,
                 normalization_alpha=self.inputs.normalization_alpha,
@@ -106,6 +106,10 @@ class RandomSampler:
     def beam_size(self):
         return self._beam_size
 
+    @property
+    def shortlist(self):
+        return None
+
 
 def _random_sample(model_adapters, beam_size, batch_size_x,
                    max_translation_len, normalization_alpha, eos_id):
@@ -113,7 +117,7 @@ def _random_sample(model_adapters, beam_size, batch_size_x,
 
     Args:
         model_adapters: sequence of ModelAdapter objects.
-        beam_size: integer specifying beam width.
+        beam_size: tf.int32 scalar specifying beam width.
         batch_size_x: tf.int32 scalar specifying number of input sentences.
         max_translation_len: tf.int32 scalar specifying max translation length.
         normalization_alpha: tf.float32 scalar specifying alpha parameter for
@@ -147,7 +151,8 @@ def _random_sample(model_adapters, beam_size, batch_size_x,
     finished = tf.fill([batch_size_x*beam_size], False)
 
     # Initialize memories (i.e. states carried over from last timestep.
-    memories = [ma.generate_initial_memories(batch_size_x, beam_size)
+    memories = [ma.generate_initial_memories(batch_size_x, beam_size,
+                                             max_translation_len)
                 for ma in model_adapters]
 
     # Generate the conditional and body functions for the sampling loop.
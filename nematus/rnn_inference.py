@@ -43,7 +43,12 @@ class ModelAdapter:
     def encode(self):
         return None
 
-    def generate_decoding_function(self, encoder_output):
+    def generate_decoding_function(self, encoder_output, output_ids=None):
+        """Returns a single-step decoding function.
+
+        If output_ids (a 1-D Tensor of target vocabulary IDs) is given, the
+        decoding function only returns the logits for those IDs.
+        """
 
         def _decoding_function_outer(step_target_ids, current_time_step,
                                      memories):
@@ -117,13 +122,14 @@ class ModelAdapter:
 
             logits = d.predictor.get_logits(
                 embeddings, stack_output, att_ctx, lexical_state,
-                multi_step=False)
+                multi_step=False, output_ids=output_ids)
 
             return logits, base_states, high_states
 
         return _decoding_function_outer
 
-    def generate_initial_memories(self, batch_size, beam_size):
+    def generate_initial_memories(self, batch_size, beam_size,
+                                  max_translation_len):
         with tf.compat.v1.name_scope(self._scope):
             d = self._model.decoder
 
@@ -346,7 +346,9 @@ class Predictor(object):
                                 non_linearity=lambda y: y,
                                 dropout_input=dropout_embedding)
 
-    def get_logits(self, y_embs, states, attended_states, lexical_states, multi_step=True):
+    def get_logits(self, y_embs, states, attended_states, lexical_states, multi_step=True, output_ids=None):
+        """Computes the output logits, or only those for the target IDs
+        output_ids (if given)."""
         with tf.compat.v1.variable_scope("prev_emb_to_hidden"):
             hidden_emb = self.prev_emb_to_hidden.forward(y_embs, input_is_3d=multi_step)
 
@@ -370,11 +372,13 @@ class Predictor(object):
 
         if self.config.softmax_mixture_size == 1:
             with tf.compat.v1.variable_scope("hidden_to_logits"):
-                logits = self.hidden_to_logits.forward(hidden, input_is_3d=multi_step)
+                logits = self.hidden_to_logits.forward(hidden, input_is_3d=multi_step,
+                                                       output_ids=output_ids)
 
             if self.config.rnn_lexical_model:
                 with tf.compat.v1.variable_scope("lexical_to_logits"):
-                    logits += self.lexical_to_logits.forward(lexical_states, input_is_3d=multi_step)
+                    logits += self.lexical_to_logits.forward(lexical_states, input_is_3d=multi_step,
+                                                             output_ids=output_ids)
 
         else:
             assert self.config.softmax_mixture_size > 1
@@ -386,7 +390,7 @@ class Predictor(object):
                 hidden_k = self.hidden_to_mos_hidden[k].forward(hidden,
                     input_is_3d=multi_step)
                 logits_k = self.hidden_to_logits.forward(hidden_k,
-                    input_is_3d=multi_step)
+                    input_is_3d=multi_step, output_ids=output_ids)
                 probs_k = tf.nn.softmax(logits_k)
                 weight = pi[..., k:k+1]
                 if k == 0:
@@ -16,6 +16,21 @@ class SamplerInputs:
             shape=(),
             dtype=tf.int32)
 
+        # Beam width (or number of samples per sentence for RandomSampler).
+        # This is an input, rather than being fixed when the graph is built,
+        # so that one sampler can serve requests with different beam sizes.
+        self.beam_size = tf.compat.v1.placeholder(
+            name='beam_size',
+            shape=(),
+            dtype=tf.int32)
+
+        # Candidate target vocabulary IDs (sorted) when decoding with a
+        # shortlist.
+        self.shortlist = tf.compat.v1.placeholder(
+            name='shortlist',
+            shape=(None,),
+            dtype=tf.int32)
+
         # Maximum translation length.
         self.max_translation_len = tf.compat.v1.placeholder(
             name='max_translation_len',
@@ -10,10 +10,13 @@ import logging
 
 from bottle import Bottle, request, response
 from bottle_log import LoggingPlugin
+import tornado.ioloop
+import tornado.web
 
 from server.response import TranslationResponse
 from server.api.provider import request_provider, response_provider
 
+import exception
 from settings import ServerSettings
 from server_translator import Translator
 
@@ -38,6 +41,7 @@ class NematusServer(object):
         self._debug = server_settings.verbose
         self._models = server_settings.models
         self._num_processes = server_settings.num_processes
+        self._asyncio = server_settings.asyncio
         self._status = self.STATUS_LOADING
         # start webserver
         self._server = Bottle()
@@ -54,14 +58,8 @@ class NematusServer(object):
         """
         Reports on the status of this translation server.
         """
-        response_data = {
-            'status': self._status,
-            'models': self._models,
-            'version': pkg_resources.require("nematus")[0].version,
-            'service': 'nematus',
-        }
         response.content_type = "application/json"
-        return json.dumps(response_data)
+        return self._status_body()
 
     def translate(self):
         """
@@ -70,28 +68,76 @@ class NematusServer(object):
         translation_request = request_provider(self._style, request)
         logging.debug("REQUEST - " + repr(translation_request))
 
-        translations = self._translator.translate(
-            translation_request.segments,
-            translation_request.settings
-        )
+        try:
+            translations = self._translator.translate(
+                translation_request.segments,
+                translation_request.settings
+            )
+        except exception.Error:
+            response.status = 500
+            translation_response = self._error_response()
+        else:
+            translation_response = self._translation_response(translations)
+
+        response.content_type = translation_response.get_content_type()
+        return repr(translation_response)
+
+    def _status_body(self):
+        response_data = {
+            'status': self._status,
+            'models': self._models,
+            'version': pkg_resources.require("nematus")[0].version,
+            'service': 'nematus',
+        }
+        cache_stats = self._translator.cache_stats()
+        if cache_stats is not None:
+            response_data['cache'] = cache_stats
+        response_data['scheduler'] = self._translator.scheduler_stats()
+        return json.dumps(response_data)
+
+    def _translation_response(self, translations):
         response_data = {
             'status': TranslationResponse.STATUS_OK,
             'segments': [translation.target_words for translation in translations],
         }
         translation_response = response_provider(self._style, **response_data)
         logging.debug("RESPONSE - " + repr(translation_response))
+        return translation_response
 
-        response.content_type = translation_response.get_content_type()
-        return repr(translation_response)
+    def _error_response(self):
+        translation_response = response_provider(
+            self._style, status=TranslationResponse.STATUS_ERROR, segments=[])
+        logging.debug("RESPONSE - " + repr(translation_response))
+        return translation_response
 
     def start(self):
         """
         Starts the webserver.
         """
-        self._route()
-        self._server.run(host=self._host, port=self._port, debug=self._debug, server='tornado', threads=self._threads)
+        if self._asyncio:
+            self._start_asyncio()
+        else:
+            self._route()
+            self._server.run(host=self._host, port=self._port, debug=self._debug, server='tornado', threads=self._threads)
         self._cleanup()
 
+    def _start_asyncio(self):
+        """
+        Serves requests from a single asyncio (Tornado) event loop. Each
+        request awaits its translations, which are handed back by the
+        translator's collector thread, so no thread is held per request.
+        """
+        app = tornado.web.Application([
+            (r'/status', _StatusHandler, dict(server=self)),
+            (r'/translate', _TranslateHandler, dict(server=self)),
+        ], debug=self._debug)
+        app.listen(self._port, address=self._host)
+        logging.info("Listening on {0}:{1}".format(self._host, self._port))
+        try:
+            tornado.ioloop.IOLoop.current().start()
+        except KeyboardInterrupt:
+            pass
+
     def _cleanup(self):
         """
         Graceful exit for components.
@@ -106,6 +152,49 @@ class NematusServer(object):
         self._server.route('/translate', method="POST", callback=self.translate)
 
 
+class _JsonRequest(object):
+    """
+    Exposes a request body like a Bottle request, for request_provider.
+    """
+    def __init__(self, body):
+        self.json = json.loads(body)
+
+
+class _StatusHandler(tornado.web.RequestHandler):
+    def initialize(self, server):
+        self._server = server
+
+    def get(self):
+        self.set_header('Content-Type', 'application/json')
+        self.write(self._server._status_body())
+
+
+class _TranslateHandler(tornado.web.RequestHandler):
+    def initialize(self, server):
+        self._server = server
+
+    async def post(self):
+        translation_request = request_provider(
+            self._server._style, _JsonRequest(self.request.body))
+        logging.debug("REQUEST - " + repr(translation_request))
+
+        try:
+            translations = await self._server._translator.translate_async(
+                translation_request.segments,
+                translation_request.settings
+            )
+        except exception.Error:
+            self.set_status(500)
+            translation_response = self._server._error_response()
+        else:
+            translation_response = self._server._translation_response(
+                translations)
+
+        self.set_header('Content-Type',
+                        translation_response.get_content_type())
+        self.write(repr(translation_response))
+
+
 if __name__ == "__main__":
     # parse console arguments
     server_settings = ServerSettings(from_console_arguments=True)
@@ -2,22 +2,23 @@
 
 """Translation code used by server.py."""
 
+import asyncio
 import logging
-import sys
 import time
 
 from multiprocessing import Process, Queue
-from collections import defaultdict
-from queue import Empty
 
 import numpy
 
+from batch_scheduler import BatchScheduler, assign_workers
 from beam_search_sampler import BeamSearchSampler
 from config import load_config_from_json_file
 import exception
+from greedy_sampler import GreedySampler
 import model_loader
 import rnn_model
 from transformer import Transformer as TransformerModel
+from translation_cache import TranslationCache
 import translate_utils
 import util
 
@@ -34,13 +35,6 @@ class Translation(object):
         self.hypothesis_id = hypothesis_id
 
 
-class QueueItem(object):
-    """
-    Models items in a queue.
-    """
-    def __init__(self, **kwargs):
-        self.__dict__.update(kwargs)
-
 class Translator(object):
 
     def __init__(self, settings):
@@ -50,8 +44,21 @@ class Translator(object):
         self._models = settings.models
         self._num_processes = settings.num_processes
         self._verbose = settings.verbose
-        self._retrieved_translations = defaultdict(dict)
         self._batch_size = settings.minibatch_size
+        # check the worker IDs before starting the workers
+        self._class_workers = assign_workers(settings.class_workers,
+                                             self._num_processes)
+        self._cache = None
+        if settings.cache_size > 0:
+            self._cache = TranslationCache(settings.models,
+                                           settings.cache_size,
+                                           settings.cache_path)
+        # shared memory blocks for batches (created before the workers, so
+        # that they know whether to expect them)
+        self._block_pool = None
+        if settings.shared_memory:
+            from shm_transport import BlockPool
+            self._block_pool = BlockPool()
 
         # load model options
         self._load_model_options()
@@ -59,6 +66,30 @@ class Translator(object):
         self._init_queues()
         # init worker processes
         self._init_processes()
+        # merge concurrent requests into batches
+        self._scheduler = BatchScheduler(
+            self._input_queues, self._output_queue, self._processes,
+            batch_size=self._batch_size,
+            token_batch_size=settings.token_batch_size,
+            max_wait=settings.max_batch_wait / 1000.0,
+            length_limits=settings.length_classes,
+            class_workers=self._class_workers,
+            create_shared_batch=self._shared_batch_factory())
+
+    def _shared_batch_factory(self):
+        """
+        Returns a function that creates a SharedBatch (see BatchScheduler),
+        or None if batches are not sent through shared memory.
+        """
+        if self._block_pool is None:
+            return None
+        from shm_transport import SharedBatch
+        factors = self._options[0].factors
+        max_translation_len = self._options[0].translation_maxlen
+        def create_shared_batch(sentences, beam_size):
+            return SharedBatch.create(self._block_pool, sentences, factors,
+                                      beam_size, max_translation_len)
+        return create_shared_batch
 
     def _load_model_options(self):
         """
@@ -71,13 +102,14 @@ class Translator(object):
             setattr(config, 'reload', model)
             self._options.append(config)
 
-        _, _, _, self._num_to_target = util.load_dictionaries(self._options[0])
+        self._target_vocab = util.load_target_vocabulary(self._options[0])
 
     def _init_queues(self):
         """
         Sets up shared queues for inter-process communication.
         """
-        self._input_queue = Queue()
+        # one input queue per worker, so that the scheduler can route batches
+        self._input_queues = [Queue() for _ in range(self._num_processes)]
         self._output_queue = Queue()
 
     def shutdown(self):
@@ -85,8 +117,12 @@ class Translator(object):
         Executed from parent process to terminate workers,
         method: "poison pill".
         """
-        for process in self._processes:
-            self._input_queue.put(None)
+        for input_queue in self._input_queues:
+            input_queue.put(None)
+        if self._cache is not None:
+            self._cache.close()
+        if self._block_pool is not None:
+            self._block_pool.close()
 
     def _init_processes(self):
         """
@@ -141,148 +177,176 @@ class Translator(object):
         sess = tf.compat.v1.Session(config=tf_config)
         models = self._load_models(process_id, sess)
 
-        samplers = {}
-
-        def get_sampler(beam_size):
-            # FIXME In practice, the beam size is probably the same for all
-            # input items, but if it gets changed a lot, then constructing a
-            # new beam search graph for each combination isn't great. Can it
-            # be turned into a placeholder?
-            if beam_size not in samplers:
-                samplers[beam_size] = BeamSearchSampler(models, self._options,
-                                                        beam_size)
-            return samplers[beam_size]
+        # The beam size is fed at run time, so a single sampler serves all
+        # requests (the value given here is only a default). Requests with
+        # a beam size of 1 are decoded greedily.
+        beam_search_sampler = BeamSearchSampler(models, self._options,
+                                                beam_size=5)
+        greedy_sampler = GreedySampler(models, self._options)
+        self._batch_builder = util.BatchBuilder(self._options[0].factors)
+        if self._block_pool is not None:
+            from shm_transport import BlockCache
+            self._block_cache = BlockCache()
 
         # listen to queue in while loop, translate items
         while True:
-            input_item = self._input_queue.get()
+            input_item = self._input_queues[process_id].get()
 
             if input_item is None:
                 break
             idx = input_item.idx
-            request_id = input_item.request_id
 
-            output_item = self._translate(process_id, input_item, get_sampler,
+            if input_item.k == 1:
+                sampler = greedy_sampler
+            else:
+                sampler = beam_search_sampler
+            output_item = self._translate(process_id, input_item, sampler,
                                           sess)
-            self._output_queue.put((request_id, idx, output_item))
+            self._output_queue.put((idx, output_item))
 
         return
 
-    def _translate(self, process_id, input_item, get_sampler, sess):
+    def _translate(self, process_id, input_item, sampler, sess):
         """
         Actual translation (model sampling).
         """
 
         # unpack input item attributes
         k = input_item.k
-        x = input_item.batch
         alpha = input_item.normalization_alpha
         #max_ratio = input_item.max_ratio
 
-        y_dummy = numpy.zeros(shape=(len(x),1))
-        x, x_mask, _, _ = util.prepare_data(x, y_dummy,
-                                            self._options[0].factors,
-                                            maxlen=None)
+        if input_item.shared_batch is None:
+            x = input_item.batch
+            y_dummy = numpy.zeros(shape=(len(x),1))
+            x, x_mask, _, _ = util.prepare_data(x, y_dummy,
+                                                self._options[0].factors,
+                                                maxlen=None)
+        else:
+            from shm_transport import SharedBatch
+            shared_batch = SharedBatch.attach(self._block_cache,
+                                              input_item.shared_batch)
+            x_ids, x_lengths = shared_batch.sentences()
+            # BatchBuilder copies the IDs, so x does not refer to the block.
+            x, x_mask, _, _ = self._batch_builder(
+                x_ids, x_lengths, numpy.zeros(0, dtype=numpy.int32),
+                numpy.zeros(len(x_lengths), dtype=numpy.int32))
+            del x_ids, x_lengths
 
         sample = translate_utils.translate_batch(
             session=sess,
-            sampler=get_sampler(k),
+            sampler=sampler,
             x=x,
             x_mask=x_mask,
             max_translation_len=self._options[0].translation_maxlen,
-            normalization_alpha=alpha)
+            normalization_alpha=alpha,
+            beam_size=k)
+
+        if input_item.shared_batch is None:
+            return sample
 
-        return sample
+        # Return the beams through shared memory.
+        shared_batch.write_beams(sample)
+        shared_batch.close()
+        return None
 
 
-    ### WRITING TO AND READING FROM QUEUES ###
+    ### EXPOSED TRANSLATION FUNCTIONS ###
 
-    def _send_jobs(self, input_, translation_settings):
+    def translate(self, source_segments, translation_settings):
         """
+        Returns the translation of @param source_segments.
         """
-        source_batches = []
+        start_time = time.time()
+        beams, keys, request, positions = self._submit(source_segments,
+                                                       translation_settings)
+        self._merge(beams, keys, positions, request.wait())
+        return self._make_translations(source_segments, translation_settings,
+                                       beams, start_time)
 
-        try:
-            batches, idxs = util.read_all_lines(self._options[0], input_,
-                                                self._batch_size)
-        except exception.Error as x:
-            logging.error(x.msg)
-            for process in self._processes:
-                process.terminate()
-            sys.exit(1)
-
-        for idx, batch in enumerate(batches):
-
-            input_item = QueueItem(verbose=self._verbose,
-                                   k=translation_settings.beam_size,
-                                   normalization_alpha=translation_settings.normalization_alpha,
-                                   nbest=translation_settings.n_best,
-                                   batch=batch,
-                                   idx=idx,
-                                   request_id=translation_settings.request_id)
-
-            self._input_queue.put(input_item)
-            source_batches.append(batch)
-        return idx+1, source_batches, idxs
-
-    def _retrieve_jobs(self, num_samples, request_id, timeout=5):
-        """
-        """
-        while len(self._retrieved_translations[request_id]) < num_samples:
-            resp = None
-            while resp is None:
-                try:
-                    resp = self._output_queue.get(True, timeout)
-                # if queue is empty after 5s, check if processes are still alive
-                except Empty:
-                    for midx in range(self._num_processes):
-                        if not self._processes[midx].is_alive() and self._processes[midx].exitcode != 0:
-                            # kill all other processes and raise exception if one dies
-                            self._input_queue.cancel_join_thread()
-                            self._output_queue.cancel_join_thread()
-                            for idx in range(self._num_processes):
-                                self._processes[idx].terminate()
-                            logging.error("Translate worker process {0} crashed with exitcode {1}".format(self._processes[midx].pid, self._processes[midx].exitcode))
-                            sys.exit(1)
-            request_id, idx, output_item = resp
-            self._retrieved_translations[request_id][idx] = output_item
-            #print self._retrieved_translations
-
-        for idx in range(num_samples):
-            yield self._retrieved_translations[request_id][idx]
-
-        # then remove all entries with this request ID from the dictionary
-        del self._retrieved_translations[request_id]
+    async def translate_async(self, source_segments, translation_settings):
+        """
+        Returns the translation of @param source_segments. The calling
+        coroutine is suspended (rather than blocking the event loop) until
+        the workers have translated all segments.
+        """
+        start_time = time.time()
+        beams, keys, request, positions = self._submit(
+            source_segments, translation_settings,
+            loop=asyncio.get_event_loop())
+        self._merge(beams, keys, positions, await request.wait_async())
+        return self._make_translations(source_segments, translation_settings,
+                                       beams, start_time)
 
-    ### EXPOSED TRANSLATION FUNCTIONS ###
+    def cache_stats(self):
+        """
+        Returns the cache statistics (or None if there is no cache).
+        """
+        return None if self._cache is None else self._cache.stats()
 
-    def translate(self, source_segments, translation_settings):
+    def scheduler_stats(self):
         """
-        Returns the translation of @param source_segments.
+        Returns the queue depth and wait times of each length class.
         """
+        return self._scheduler.stats()
 
+    def _submit(self, source_segments, translation_settings, loop=None):
+        """
+        Looks up @param source_segments in the cache and passes the misses to
+        the batch scheduler. Returns the list of cached beams (None for
+        misses), the cache keys (or None), the PendingRequest for the misses
+        and the position of each of its beams in the list.
+        """
         logging.info('Translating {0} segments...\n'.format(len(source_segments)))
-        start_time = time.time()
-        n_batches, source_batches, idxs = self._send_jobs(source_segments, translation_settings)
 
-        n_sent = 0
-        outputs = [None]*n_batches
-        for i, samples in enumerate(self._retrieve_jobs(n_batches, translation_settings.request_id)):
-            outputs[i] = list(samples)
-            n_sent += len(samples)
-            logging.info('Translated {} sents'.format(n_sent))
+        beams = [None] * len(source_segments)
+        keys = None
+        if self._cache is not None:
+            keys = [self._cache.key(segment, translation_settings.beam_size,
+                                    translation_settings.normalization_alpha)
+                    for segment in source_segments]
+            beams = [self._cache.get(key) for key in keys]
+        misses = [i for i, beam in enumerate(beams) if beam is None]
+
+        # Map the segments to IDs, sorted by length; the scheduler merges
+        # them with other requests' segments into batches.
+        try:
+            batches, idxs = util.read_all_lines(
+                self._options[0], [source_segments[i] for i in misses],
+                max(1, len(misses)))
+        except exception.Error as x:
+            # Only this request fails; the workers keep serving the others.
+            logging.error(x.msg)
+            raise
+        sentences = [ids for batch in batches for ids in batch]
+        request = self._scheduler.submit(
+            sentences, translation_settings.beam_size,
+            translation_settings.normalization_alpha, loop)
+        positions = [misses[i] for i in idxs]
+        return beams, keys, request, positions
+
+    def _merge(self, beams, keys, positions, outputs):
+        """
+        Puts the translated beams into place and adds them to the cache.
+        """
+        for pos, beam in zip(positions, outputs):
+            beams[pos] = beam
+            if self._cache is not None:
+                self._cache.put(keys[pos], beam)
 
-        outputs = [beam for batch in outputs for beam in batch]
-        outputs = numpy.array(outputs, dtype=numpy.object)
-        outputs = outputs[idxs.argsort()]
+    def _make_translations(self, source_segments, translation_settings,
+                           beams, start_time):
+        """
+        Maps @param beams (in input order) to Translation objects.
+        """
+        n_sent = len(beams)
 
         translations = []
-        for i, beam in enumerate(outputs):
+        for i, beam in enumerate(beams):
             if translation_settings.n_best is True:
                 n_best_list = []
                 for j, (sent, cost) in enumerate(beam):
-                    target_words = util.seq2words(sent, self._num_to_target,
-                                                  join=False)
+                    target_words = self._target_vocab.decode(sent, join=False)
                     translation = Translation(sentence_id=i,
                                               source_words=source_segments[i],
                                               target_words=target_words,
@@ -292,8 +356,8 @@ class Translator(object):
                 translations.append(n_best_list)
             else:
                 best_hypo, cost = beam[0]
-                target_words = util.seq2words(best_hypo, self._num_to_target,
-                                              join=False)
+                target_words = self._target_vocab.decode(best_hypo,
+                                                         join=False)
                 translation = Translation(sentence_id=i,
                                             source_words=source_segments[i],
                                             target_words=target_words,
@@ -9,6 +9,39 @@ import uuid
 import logging
 from abc import ABCMeta
 
+# ModuleNotFoundError is new in 3.6; older versions will throw SystemError
+if sys.version_info < (3, 6):
+    ModuleNotFoundError = SystemError
+
+try:
+    from . import exception
+    from .streaming_reader import StreamingReader, is_compressed
+except (ModuleNotFoundError, ImportError) as e:
+    import exception
+    from streaming_reader import StreamingReader, is_compressed
+
+
+def input_file(path):
+    """argparse type for input files that may be compressed (.gz, .xz, .zst).
+    """
+    if not is_compressed(path):
+        return argparse.FileType('r')(path)
+    try:
+        return StreamingReader(path)
+    except OSError as e:
+        raise argparse.ArgumentTypeError(
+            "can't open '{0}': {1}".format(path, e))
+    except exception.Error as e:
+        raise argparse.ArgumentTypeError(e.msg)
+
+def worker_ids(ids):
+    """argparse type for a comma-separated list of worker process IDs."""
+    try:
+        return [int(i) for i in ids.split(',')]
+    except ValueError:
+        raise argparse.ArgumentTypeError(
+            "invalid list of worker IDs: '{0}'".format(ids))
+
 class BaseSettings(object, metaclass=ABCMeta):
     """
     All modes (abstract base class)
@@ -74,9 +107,10 @@ class TranslationSettings(BaseSettings):
         if self._from_console_arguments:
             # don't open files if no console arguments are parsed
             self._parser.add_argument(
-                '-i', '--input', type=argparse.FileType('r'),
+                '-i', '--input', type=input_file,
                 default=sys.stdin, metavar='PATH',
-                help="input file (default: standard input)")
+                help="input file, optionally compressed with gzip, xz or "
+                     "zstd (default: standard input)")
 
             self._parser.add_argument(
                 '-o', '--output', type=argparse.FileType('w'),
@@ -108,6 +142,13 @@ class TranslationSettings(BaseSettings):
             help="size of maxibatch (number of minibatches that are sorted " \
                  "by length) (default: %(default)s)")
 
+        self._parser.add_argument(
+            '--token_batch_size', type=int, default=0, metavar='INT',
+            help="minibatch size in source tokens times beam size; the "
+                 "number of sentences per minibatch is dynamic. If this is "
+                 "enabled, minibatch_size only affects sorting by length "
+                 "(default: %(default)s)")
+
         self._parser.add_argument(
             '--sampling_temperature', type=float, default=1.0, nargs="?",
             const=1.0, metavar="FLOAT",
@@ -119,6 +160,41 @@ class TranslationSettings(BaseSettings):
             help='Maximum length of translation output sentence (default: '
                  '%(default)s)')
 
+        self._parser.add_argument(
+            '--compact_batch', action="store_true",
+            help="with beam search, remove each sentence from the batch as "
+                 "soon as its search has finished (Transformer only)")
+
+        self._parser.add_argument(
+            '--preallocate_kv_cache', action="store_true",
+            help="decode Transformer models with self-attention memories "
+                 "preallocated to the maximum translation length, which "
+                 "are not copied when the beam is reordered")
+
+        self._parser.add_argument(
+            '--stack_ensemble', action="store_true",
+            help="with beam search, run the decoding steps of ensembled "
+                 "Transformers with the same decoder structure as one, with "
+                 "their weights stacked")
+
+        self._parser.add_argument(
+            '--shortlist', type=str, default=None, metavar='PATH',
+            help="with beam search, restrict the output vocabulary of each "
+                 "batch to the candidates in a lexical shortlist (see "
+                 "data/build_shortlist.py)")
+
+        self._parser.add_argument(
+            '--workers', type=int, default=1, metavar='INT',
+            help="number of worker processes; the input is split into "
+                 "maxibatches, which are translated in parallel by separate "
+                 "processes that each load the models (default: "
+                 "%(default)s)")
+
+        self._parser.add_argument(
+            '--threads_per_worker', type=int, default=0, metavar='INT',
+            help="number of TensorFlow threads per worker process (default: "
+                 "0, let TensorFlow decide)")
+
         self._parser.add_argument(
             '--translation_strategy', type=str, choices=['beam_search', 'sampling'], default="beam_search",
             help="translation_strategy, either beam_search or sampling (default: %(default)s)")
@@ -154,10 +230,62 @@ class ServerSettings(BaseSettings):
             '--threads', type=int, default=4, metavar='INT',
             help='number of threads (default: %(default)s)')
 
+        self._parser.add_argument(
+            '--asyncio', action='store_true',
+            help='serve requests from a single asyncio event loop, instead '
+                 'of blocking one of --threads handler threads per request')
+
         self._parser.add_argument(
             '-p', '--num_processes', type=int, default=1, metavar='INT',
             help="number of processes (default: %(default)s)")
 
+        self._parser.add_argument(
+            '--token_batch_size', type=int, default=0, metavar='INT',
+            help="maximum batch size in source tokens times beam size; if "
+                 "this is enabled, minibatch_size is ignored (default: "
+                 "%(default)s)")
+
+        self._parser.add_argument(
+            '--max_batch_wait', type=float, default=5.0, metavar='MS',
+            help="maximum time (in milliseconds) that a sentence waits for "
+                 "sentences from other requests to fill its batch (default: "
+                 "%(default)s)")
+
+        self._parser.add_argument(
+            '--cache_size', type=int, default=0, metavar='INT',
+            help="number of translated segments to keep in an LRU cache; "
+                 "repeated segments are not decoded again (default: "
+                 "%(default)s, no cache)")
+
+        self._parser.add_argument(
+            '--cache_path', type=str, default=None, metavar='PATH',
+            help="with --cache_size, also store cached translations in a "
+                 "persistent database at PATH")
+
+        self._parser.add_argument(
+            '--shared_memory', action='store_true',
+            help="pass batches and translations to and from the worker "
+                 "processes through shared memory instead of pickling them "
+                 "(requires Python 3.8)")
+
+        self._parser.add_argument(
+            '--length_classes', type=int, nargs=2, default=[16, 64],
+            metavar=('SHORT', 'MEDIUM'),
+            help="maximum source length (in tokens) of short and medium "
+                 "sentences; longer sentences are long. Short sentences are "
+                 "sent to the workers first (default: %(default)s)")
+
+        self._parser.add_argument(
+            '--class_workers', type=worker_ids, nargs=3, default=None,
+            metavar=('SHORT', 'MEDIUM', 'LONG'),
+            help="comma-separated IDs (from 0) of the worker processes that "
+                 "translate short, medium and long sentences, e.g. "
+                 "'0 0,1 1,2' (default: all workers translate all sentences)")
+
+    def _set_additional_vars(self):
+        if self.cache_path is not None and self.cache_size <= 0:
+            self._parser.error('--cache_path requires --cache_size')
+
 
 class ScorerBaseSettings(BaseSettings, metaclass=ABCMeta):
     """
@@ -0,0 +1,209 @@
+"""Shared-memory transport for batches between the server and its workers.
+
+Instead of pickling lists of source IDs and beams through a
+multiprocessing.Queue, the server packs each batch's source IDs into a block
+of shared memory, which also has room for the beams. Only a small
+descriptor (a tuple of the block name and the array sizes) is put on the
+queues: the worker reads the source IDs from the block, writes the beams
+into it and sends back the batch ID, and the server reads the beams.
+
+Blocks are created by the server's BlockPool and reused for later batches;
+workers keep the blocks that they have seen mapped (in a BlockCache), so
+that a batch costs no system calls. Requires Python 3.8 or later.
+
+Block layout (all arrays are 4-byte types, so no padding is needed):
+
+    x_ids        int32    [num_tokens, factors]  source IDs
+    x_lengths    int32    [num_sents]            source sentence lengths
+    beam_sizes   int32    [num_sents]            hypotheses per sentence
+    hyp_lengths  int32    [num_sents*beam_size]  hypothesis lengths
+    hyp_ids      int32    [num_sents*beam_size, max_translation_len]
+    scores       float32  [num_sents*beam_size]
+"""
+
+from multiprocessing import resource_tracker, shared_memory
+import sys
+import threading
+
+import numpy
+
+
+def _layout(num_sents, num_tokens, factors, beam_size, max_translation_len):
+    num_hyps = num_sents * beam_size
+    arrays = [('x_ids', numpy.int32, (num_tokens, factors)),
+              ('x_lengths', numpy.int32, (num_sents,)),
+              ('beam_sizes', numpy.int32, (num_sents,)),
+              ('hyp_lengths', numpy.int32, (num_hyps,)),
+              ('hyp_ids', numpy.int32, (num_hyps, max_translation_len)),
+              ('scores', numpy.float32, (num_hyps,))]
+    layout = {}
+    offset = 0
+    for name, dtype, shape in arrays:
+        layout[name] = (dtype, shape, offset)
+        size = 4  # bytes per element
+        for dim in shape:
+            size *= dim
+        offset += size
+    return layout, offset
+
+
+class BlockPool(object):
+    """Creates shared memory blocks and reuses them (server side)."""
+
+    def __init__(self):
+        self._blocks = []
+        self._free = []
+        self._lock = threading.Lock()
+
+    def acquire(self, size):
+        """Returns a free block of at least size bytes."""
+        with self._lock:
+            for i, shm in enumerate(self._free):
+                if shm.size >= size:
+                    return self._free.pop(i)
+            # Sizes are rounded up to a power of two (of at least one page),
+            # so that a block can be reused for somewhat larger batches.
+            shm = shared_memory.SharedMemory(
+                create=True, size=1 << max(12, (size - 1).bit_length()))
+            self._blocks.append(shm)
+            return shm
+
+    def release(self, shm):
+        with self._lock:
+            self._free.append(shm)
+
+    def close(self):
+        """Frees all blocks; none may be in use."""
+        with self._lock:
+            for shm in self._blocks:
+                shm.close()
+                shm.unlink()
+            self._blocks = []
+            self._free = []
+
+
+class BlockCache(object):
+    """Keeps the blocks that a worker has attached to mapped."""
+
+    def __init__(self):
+        self._blocks = {}
+
+    def get(self, name):
+        shm = self._blocks.get(name)
+        if shm is None:
+            shm = _attach(name)
+            self._blocks[name] = shm
+        return shm
+
+
+def _attach(name):
+    """Opens an existing block without registering it with the resource
+    tracker. Before Python 3.13, attaching registers the block, so that the
+    tracker unlinks it when the worker exits or, if the tracker is shared
+    with the server (after a fork), drops the server's registration. The
+    server owns the block."""
+    if sys.version_info >= (3, 13):
+        return shared_memory.SharedMemory(name=name, track=False)
+    register = resource_tracker.register
+    resource_tracker.register = lambda name, rtype: None
+    try:
+        return shared_memory.SharedMemory(name=name)
+    finally:
+        resource_tracker.register = register
+
+
+class SharedBatch(object):
+    """A batch of source sentences, and its beams, in shared memory."""
+
+    def __init__(self, shm, descriptor, pool=None):
+        self._shm = shm
+        self._pool = pool
+        self.descriptor = descriptor
+        _, num_sents, num_tokens, factors, beam_size, max_len = descriptor
+        self.beam_size = beam_size
+        layout, _ = _layout(num_sents, num_tokens, factors, beam_size,
+                            max_len)
+        self.arrays = {}
+        for name, (dtype, shape, offset) in layout.items():
+            self.arrays[name] = numpy.ndarray(shape, dtype=dtype,
+                                              buffer=shm.buf, offset=offset)
+
+    @classmethod
+    def create(cls, pool, sentences, factors, beam_size,
+               max_translation_len):
+        """Packs sentences (lists of tokens, each a list of factor IDs, as
+        returned by util.read_all_lines()) into a block from pool. Called by
+        the server."""
+        lengths = [len(s) for s in sentences]
+        num_tokens = sum(lengths)
+        _, size = _layout(len(sentences), num_tokens, factors, beam_size,
+                          max_translation_len)
+        shm = pool.acquire(size)
+        descriptor = (shm.name, len(sentences), num_tokens, factors,
+                      beam_size, max_translation_len)
+        batch = cls(shm, descriptor, pool)
+        if num_tokens > 0:
+            batch.arrays['x_ids'][...] = [token for s in sentences
+                                          for token in s]
+        batch.arrays['x_lengths'][...] = lengths
+        return batch
+
+    @classmethod
+    def attach(cls, cache, descriptor):
+        """Opens a batch created by create(), using a BlockCache. Called by
+        the worker."""
+        return cls(cache.get(descriptor[0]), descriptor)
+
+    def sentences(self):
+        """Returns the source IDs as flat arrays (x_ids, x_lengths), in the
+        format of util.flatten_sequences()."""
+        return self.arrays['x_ids'], self.arrays['x_lengths']
+
+    def write_beams(self, beams):
+        """Writes the beams returned by translate_utils.translate_batch()."""
+        beam_sizes = numpy.array([len(beam) for beam in beams],
+                                 dtype=numpy.int32)
+        self.arrays['beam_sizes'][:len(beams)] = beam_sizes
+        if beam_sizes.sum() == 0:
+            return
+        # The hypotheses of a batch are rows of the same padded array.
+        ids = numpy.array([hyp for beam in beams for hyp, _ in beam])
+        scores = [score for beam in beams for _, score in beam]
+        starts = numpy.arange(len(beams)) * self.beam_size
+        rows = (numpy.repeat(starts, beam_sizes)
+                + numpy.arange(len(ids))
+                - numpy.repeat(numpy.cumsum(beam_sizes) - beam_sizes,
+                               beam_sizes))
+        # Hypotheses are padded with <EOS> (0), so only the IDs up to and
+        # including the first <EOS> are needed.
+        is_eos = (ids == 0)
+        lengths = numpy.where(is_eos.any(axis=1), is_eos.argmax(axis=1) + 1,
+                              ids.shape[1])
+        self.arrays['hyp_ids'][rows, :ids.shape[1]] = ids
+        self.arrays['hyp_lengths'][rows] = lengths
+        self.arrays['scores'][rows] = scores
+
+    def read_beams(self):
+        """Returns the beams written by write_beams() (copied out of the
+        block)."""
+        beam_sizes = self.arrays['beam_sizes'].tolist()
+        # Rows of unused hypotheses contain stale data from earlier batches.
+        rows = [range(i * self.beam_size, i * self.beam_size + beam_size)
+                for i, beam_size in enumerate(beam_sizes)]
+        hyp_lengths = self.arrays['hyp_lengths'].tolist()
+        scores = self.arrays['scores'].tolist()
+        max_len = max([hyp_lengths[row] for r in rows for row in r],
+                      default=0)
+        # Copy the used part of hyp_ids in one go; hypotheses are views.
+        hyp_ids = self.arrays['hyp_ids'][:, :max_len].copy()
+        return [[(hyp_ids[row, :hyp_lengths[row]], scores[row]) for row in r]
+                for r in rows]
+
+    def close(self):
+        """Releases the batch's views of the block (worker side)."""
+        self.arrays = None
+
+    def release(self):
+        """Returns the block to the pool (server side)."""
+        self.arrays = None
+        self._pool.release(self._shm)
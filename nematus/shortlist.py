@@ -0,0 +1,66 @@
+"""Lexical shortlists for restricting the output vocabulary during decoding.
+
+A shortlist file (JSON, as written by data/build_shortlist.py) lists the
+target words that are always candidates ("frequent") and, for each source
+word, the target words that are likely translations of it ("candidates").
+When translating a batch, the output layer is only evaluated for the union of
+the candidates of the batch's source words.
+"""
+
+import json
+
+import numpy
+
+
+class Shortlist(object):
+    """Maps batches of source IDs to sorted arrays of candidate target IDs."""
+
+    def __init__(self, frequent, candidates, source_vocab, target_vocab):
+        """Initializes the shortlist.
+
+        Args:
+            frequent: list of target words that are always candidates.
+            candidates: dictionary mapping source words to lists of target
+                words.
+            source_vocab: Vocabulary for the first source factor.
+            target_vocab: Vocabulary for the target side.
+        """
+        # The special symbols (<EOS>, <GO> and <UNK>) are always candidates.
+        special_ids = [i for i in target_vocab.id_to_token if i <= 2]
+        self._frequent = numpy.union1d(
+            special_ids, self._target_ids(frequent, target_vocab))
+        self._candidates = {}
+        for source_word, target_words in candidates.items():
+            source_id = source_vocab.token_to_id.get(source_word)
+            if source_id is None:
+                continue
+            ids = self._target_ids(target_words, target_vocab)
+            if len(ids) > 0:
+                self._candidates[source_id] = ids
+
+    @staticmethod
+    def _target_ids(words, target_vocab):
+        get = target_vocab.token_to_id.get
+        ids = [get(w) for w in words]
+        return numpy.array([i for i in ids if i is not None], dtype=numpy.int32)
+
+    @classmethod
+    def load(cls, path, source_vocab, target_vocab):
+        """Loads a shortlist file written by build_shortlist.py."""
+        with open(path, 'r', encoding='utf-8') as f:
+            data = json.load(f)
+        return cls(data['frequent'], data['candidates'], source_vocab,
+                   target_vocab)
+
+    def candidates(self, source_ids):
+        """Returns the sorted int32 array of candidate target IDs.
+
+        Args:
+            source_ids: array of source IDs (first factor) of any shape;
+                padding positions can be included.
+        """
+        ids = [self._candidates[i]
+               for i in numpy.unique(source_ids).tolist()
+               if i in self._candidates]
+        return numpy.unique(numpy.concatenate([self._frequent] + ids)) \
+            .astype(numpy.int32)
@@ -0,0 +1,209 @@
+"""Line reader for large, possibly compressed, text files.
+
+Decompression (and UTF-8 decoding) is done by a background thread in large
+blocks, which are split into lines in bulk. Since zlib, lzma and zstandard
+release the GIL while decompressing, this runs in parallel with the consumer.
+"""
+
+import gzip
+import queue
+import sys
+import threading
+import weakref
+
+try:
+    import lzma
+except ImportError:
+    lzma = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# ModuleNotFoundError is new in 3.6; older versions will throw SystemError
+if sys.version_info < (3, 6):
+    ModuleNotFoundError = SystemError
+
+try:
+    from . import exception
+except (ModuleNotFoundError, ImportError) as e:
+    import exception
+
+
+COMPRESSED_SUFFIXES = ('.gz', '.xz', '.zst')
+
+
+def is_compressed(path):
+    return path.endswith(COMPRESSED_SUFFIXES)
+
+
+def open_binary(path):
+    """Opens a file for reading, decompressing it according to its suffix.
+
+    Raises:
+        exception.Error: if the codec module is not available.
+    """
+    if path.endswith('.gz'):
+        return gzip.open(path, 'rb')
+    if path.endswith('.xz'):
+        if lzma is None:
+            raise exception.Error('Reading {} requires the lzma '
+                                  'module'.format(path))
+        return lzma.open(path, 'rb')
+    if path.endswith('.zst'):
+        if zstandard is None:
+            raise exception.Error('Reading {} requires the zstandard '
+                                  'module'.format(path))
+        return zstandard.ZstdDecompressor().stream_reader(open(path, 'rb'),
+                                                          closefd=True)
+    return open(path, 'rb')
+
+
+# Characters other than '\n' that str.splitlines() treats as line boundaries.
+_OTHER_LINE_BOUNDARIES = ('\r', '\x0b', '\x0c', '\x1c', '\x1d', '\x1e', '\x85',
+                          '\u2028', '\u2029')
+
+
+def _split_lines(text):
+    # Splits text into lines (including the '\n'), translating '\r\n' and
+    # '\r' to '\n' like a file opened in text mode (universal newlines).
+    # (Searching for each character separately is much faster than a regular
+    # expression.)
+    if '\r' in text:
+        text = text.replace('\r\n', '\n').replace('\r', '\n')
+    if not any(c in text for c in _OTHER_LINE_BOUNDARIES):
+        # Fast path.
+        return text.splitlines(keepends=True)
+    lines = text.split('\n')
+    # The final element is the text after the last newline (if any).
+    last = [lines[-1]] if lines[-1] else []
+    return [line + '\n' for line in lines[:-1]] + last
+
+
+class _ProducerError(object):
+    def __init__(self, exc_info):
+        self.exc_info = exc_info
+
+
+class StreamingReader(object):
+    """Read-only text file object that decodes in a background thread.
+
+    Supports iteration, readline(), readlines(), seek(0) and close(), which
+    is what TextIterator and translate_utils.translate_file need. Newlines
+    are handled as in text mode ('\\r\\n' and '\\r' are read as '\\n') and
+    lines include the line terminator. Calls to readline() should not be
+    interleaved with an ongoing iteration.
+    """
+
+    # Size of the decompressed blocks passed from the background thread.
+    BLOCK_SIZE = 2**22
+    # Maximum number of blocks that are read ahead.
+    QUEUE_SIZE = 8
+
+    def __init__(self, path, encoding='UTF-8'):
+        self.name = path
+        self.encoding = encoding
+        self._start()
+
+    def _start(self):
+        # The file is opened here so that errors are raised to the caller.
+        f = open_binary(self.name)
+        self._lines = []
+        self._pos = 0
+        self._eof = False
+        self._queue = queue.Queue(maxsize=self.QUEUE_SIZE)
+        self._stop = threading.Event()
+        # The thread must not hold a reference to self, so that a reader that
+        # is dropped without calling close() still stops its thread.
+        self._finalizer = weakref.finalize(self, self._stop.set)
+        thread = threading.Thread(target=self._produce,
+                                  args=(f, self._queue, self._stop,
+                                        self.BLOCK_SIZE, self.encoding),
+                                  daemon=True)
+        thread.start()
+
+    @staticmethod
+    def _produce(f, out_queue, stop, block_size, encoding):
+        def put(item):
+            while not stop.is_set():
+                try:
+                    out_queue.put(item, timeout=0.1)
+                    return
+                except queue.Full:
+                    pass
+
+        try:
+            with f:
+                leftover = b''
+                while not stop.is_set():
+                    block = f.read(block_size)
+                    if not block:
+                        if leftover:
+                            put(_split_lines(leftover.decode(encoding)))
+                        break
+                    block = leftover + block
+                    end = block.rfind(b'\n') + 1
+                    leftover = block[end:]
+                    if end == 0:
+                        continue
+                    put(_split_lines(block[:end].decode(encoding)))
+            put(None)
+        except:
+            put(_ProducerError(sys.exc_info()))
+
+    def _fill(self):
+        # Makes sure that there is an unread line in self._lines, unless the
+        # end of the file has been reached. Returns False at the end.
+        while self._pos >= len(self._lines):
+            if self._eof:
+                return False
+            item = self._queue.get()
+            if item is None:
+                self._eof = True
+            elif isinstance(item, _ProducerError):
+                self._eof = True
+                _, value, traceback = item.exc_info
+                raise value.with_traceback(traceback)
+            else:
+                self._lines = item
+                self._pos = 0
+        return True
+
+    def __iter__(self):
+        # A generator is much faster than calling __next__() for every line.
+        while self._fill():
+            lines = self._lines
+            for i in range(self._pos, len(lines)):
+                self._pos = i + 1
+                yield lines[i]
+
+    def __next__(self):
+        if not self._fill():
+            raise StopIteration
+        self._pos += 1
+        return self._lines[self._pos-1]
+
+    def readline(self):
+        try:
+            return next(self)
+        except StopIteration:
+            return ''
+
+    def readlines(self):
+        return list(self)
+
+    def seek(self, pos):
+        assert pos == 0
+        self.close()
+        self._start()
+
+    def close(self):
+        # The background thread stops (and closes the file) at its next step.
+        self._finalizer()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
@@ -25,9 +25,11 @@ if sys.version_info < (3, 6):
     ModuleNotFoundError = SystemError
 
 try:
+    from .batch_prefetcher import BatchPrefetcher
     from .beam_search_sampler import BeamSearchSampler
     from .config import read_config_from_cmdline, write_config_to_json_file
-    from .data_iterator import TextIterator
+    from .data_iterator import TextIterator, fopen
+    from . import exception
     from .exponential_smoothing import ExponentialSmoothing
     from . import learning_schedule
     from . import model_loader
@@ -39,9 +41,11 @@ try:
     from . import translate_utils
     from . import util
 except (ModuleNotFoundError, ImportError) as e:
+    from batch_prefetcher import BatchPrefetcher
     from beam_search_sampler import BeamSearchSampler
     from config import read_config_from_cmdline, write_config_to_json_file
-    from data_iterator import TextIterator
+    from data_iterator import TextIterator, fopen
+    import exception
     from exponential_smoothing import ExponentialSmoothing
     import learning_schedule
     import model_loader
@@ -74,7 +78,11 @@ def load_data(config):
                         maxibatch_size=config.maxibatch_size,
                         token_batch_size=config.token_batch_size,
                         keep_data_in_memory=config.keep_train_set_in_memory,
-                        preprocess_script=config.preprocess_script)
+                        preprocess_script=config.preprocess_script,
+                        binarized=config.binarized_data,
+                        indexed=config.indexed_train_set,
+                        length_bucketing=config.length_bucketing,
+                        num_workers=config.data_workers)
 
     if config.valid_freq and config.valid_source_dataset and config.valid_target_dataset:
         valid_text_iterator = TextIterator(
@@ -198,9 +206,12 @@ def train(config, sess):
     write_config_to_json_file(config, config.saveto)
 
     text_iterator, valid_text_iterator = load_data(config)
+    batches = BatchPrefetcher(text_iterator, config.factors,
+                              config.prefetch_batches)
     _, _, num_to_source, num_to_target = util.load_dictionaries(config)
     total_loss = 0.
     n_sents, n_words = 0, 0
+    n_tokens, n_padded_tokens = 0, 0
     last_time = time.time()
     logging.info("Initial uidx={}".format(progress.uidx))
     # set epoch = 1 if print per-token-probability
@@ -208,15 +219,7 @@ def train(config, sess):
         config.max_epochs = progress.eidx+1
     for progress.eidx in range(progress.eidx, config.max_epochs):
         logging.info('Starting epoch {0}'.format(progress.eidx))
-        for source_sents, target_sents in text_iterator:
-            if len(source_sents[0][0]) != config.factors:
-                logging.error('Mismatch between number of factors in settings ({0}), and number in training corpus ({1})\n'.format(config.factors, len(source_sents[0][0])))
-                sys.exit(1)
-            x_in, x_mask_in, y_in, y_mask_in = util.prepare_data(
-                source_sents, target_sents, config.factors, maxlen=None)
-            if x_in is None:
-                logging.info('Minibatch with zero sample under length {0}'.format(config.maxlen))
-                continue
+        for x_in, x_mask_in, y_in, y_mask_in in batches:
             write_summary_for_this_batch = config.summary_freq and ((progress.uidx % config.summary_freq == 0) or (config.finish_after and progress.uidx % config.finish_after == 0))
             (factors, seqLen, batch_size) = x_in.shape
 
@@ -236,6 +239,8 @@ def train(config, sess):
 
             n_sents += batch_size
             n_words += int(numpy.sum(y_mask_in))
+            n_tokens += int(numpy.sum(x_mask_in)) + int(numpy.sum(y_mask_in))
+            n_padded_tokens += x_mask_in.size + y_mask_in.size
             progress.uidx += 1
 
             # Update the smoothed version of the model variables.
@@ -247,11 +252,16 @@ def train(config, sess):
             if config.disp_freq and progress.uidx % config.disp_freq == 0:
                 duration = time.time() - last_time
                 disp_time = datetime.now().strftime('[%Y-%m-%d %H:%M:%S]')
-                logging.info('{0} Epoch: {1} Update: {2} Loss/word: {3} Words/sec: {4} Sents/sec: {5}'.format(disp_time, progress.eidx, progress.uidx, total_loss/n_words, n_words/duration, n_sents/duration))
+                logging.info('{0} Epoch: {1} Update: {2} Loss/word: {3} Words/sec: {4} Sents/sec: {5} Real/padded tokens: {6:.3f}'.format(disp_time, progress.eidx, progress.uidx, total_loss/n_words, n_words/duration, n_sents/duration, n_tokens/n_padded_tokens))
+                if config.prefetch_batches:
+                    logging.info('{0} Updates stalled waiting for data: {1} ({2:.2f} sec)'.format(disp_time, batches.num_stalls, batches.stall_time))
+                    batches.reset_stats()
                 last_time = time.time()
                 total_loss = 0.
                 n_sents = 0
                 n_words = 0
+                n_tokens = 0
+                n_padded_tokens = 0
 
             if config.sample_freq and progress.uidx % config.sample_freq == 0:
                 x_small = x_in[:, :, :10]
@@ -353,6 +363,7 @@ def train(config, sess):
                 break
         if progress.estop:
             break
+    text_iterator.close()
 
 
 def save_non_checkpoint(session, saver, save_path):
@@ -411,7 +422,7 @@ def validate_with_script(session, beam_search_sampler):
     logging.info('Starting external validation.')
     out = tempfile.NamedTemporaryFile(mode='w')
     translate_utils.translate_file(
-        input_file=open(config.valid_bleu_source_dataset, encoding="UTF-8"),
+        input_file=fopen(config.valid_bleu_source_dataset),
         output_file=out,
         session=session,
         sampler=beam_search_sampler,
@@ -519,4 +530,8 @@ if __name__ == "__main__":
 
     # Train.
     with tf.compat.v1.Session(config=tf_config) as sess:
-        train(config, sess)
+        try:
+            train(config, sess)
+        except exception.Error as x:
+            logging.error(x.msg)
+            sys.exit(1)
@@ -164,6 +164,38 @@ class MultiHeadAttentionLayer(object):
                                 false_fn=lambda: attn_mask)
             attn_logits += attn_mask
 
+        # Calculate attention weights
+        attn_weights = self._attn_weights(attn_logits)
+        # Weigh attention values
+        weighted_memories = tf.matmul(attn_weights, values)
+        return weighted_memories
+
+    def _cached_dot_product_attn(self, queries, keys, values, attn_mask):
+        """ Dot-product attention over keys and values computed by compute_memory_keys_values(); these are shared
+        by all decoding beams, so they are broadcast rather than tiled. """
+        # queries have shape = [batch_size * num_beams, time_steps, num_heads, num_features], in beam-major order
+        # keys have shape = [batch_size, num_heads, num_features, key_length]
+        # values have shape = [batch_size, num_heads, key_length, num_features]
+        batch_size = get_shape_list(keys)[0]
+        queries = tf.transpose(a=queries, perm=[0, 2, 1, 3])
+        queries_dims = get_shape_list(queries)
+        queries = tf.reshape(queries, [-1, batch_size] + queries_dims[1:])
+        attn_logits = tf.matmul(queries, keys)
+        # Scale attention_logits by key dimensions to prevent softmax saturation
+        normalizer = tf.sqrt(tf.cast(queries_dims[-1], self.float_dtype))
+        attn_logits /= normalizer
+        # attention mask has shape=[batch, 1, 1, key_length]
+        if attn_mask is not None:
+            attn_logits += attn_mask
+        logits_dims = get_shape_list(attn_logits)
+        attn_logits = tf.reshape(attn_logits, [-1] + logits_dims[2:])
+        attn_weights = self._attn_weights(attn_logits)
+        attn_weights = tf.reshape(attn_weights, logits_dims)
+        weighted_memories = tf.matmul(attn_weights, values)
+        return tf.reshape(weighted_memories, [-1] + get_shape_list(weighted_memories)[2:])
+
+    def _attn_weights(self, attn_logits):
+        """ Normalizes attention logits with shape=[batch, num_heads, query_length, key_length]. """
         # Calculate attention weights
         attn_weights = tf.nn.softmax(attn_logits)
         # Optionally apply dropout:
@@ -172,12 +204,48 @@ class MultiHeadAttentionLayer(object):
         # Optionally apply DropHead:
         if self.drophead is not None:
             attn_weights = self.drophead(attn_weights, training=self.training)
-        # Weigh attention values
-        weighted_memories = tf.matmul(attn_weights, values)
-        return weighted_memories
+        return attn_weights
+
+    def compute_memory_keys_values(self, memory_context):
+        """ Computes the keys and values for a fixed memory context (such as the encoder output), so that they can
+        be passed to forward() at every decoding step instead of being recomputed. """
+        keys = self._split_among_heads(self.keys_projection.forward(memory_context))
+        values = self._split_among_heads(self.values_projection.forward(memory_context))
+        # Transpose to the layouts used by the attention matmuls
+        return {'keys': tf.transpose(a=keys, perm=[0, 2, 3, 1]),
+                'values': tf.transpose(a=values, perm=[0, 2, 1, 3])}
+
+    def _update_preallocated_memories(self, keys, values, layer_memories, memory_indices):
+        """ Writes the keys and values of a single decoding step into preallocated memories with
+        shape=[max_length, memory_rows, depth] and gathers the keys and values that each query attends to.
+        memory_indices has shape=[batch_size, time_steps, 2] and holds the (position, row) coordinates of the
+        memories for each time-step so far, ending with those of the current one. """
+        # keys and values have shape = [batch_size, 1, depth] and fill the first batch_size rows at the current
+        # position. Nothing reads that position before it is written, so the memories are updated in place
+        # rather than copied.
+        position = tf.shape(input=memory_indices)[1] - 1
+        num_rows = get_shape_list(layer_memories['keys'])[1]
+        paddings = [[0, num_rows - get_shape_list(keys)[0]], [0, 0]]
+        for name, step_inputs in (('keys', keys), ('values', values)):
+            update = tf.expand_dims(tf.pad(tensor=step_inputs[:, 0, :], paddings=paddings), 0)
+            layer_memories[name] = tf.raw_ops.InplaceUpdate(x=layer_memories[name], i=[position], v=update)
+        return tf.gather_nd(layer_memories['keys'], memory_indices), \
+            tf.gather_nd(layer_memories['values'], memory_indices)
+
+    def forward(self, query_context, memory_context, attn_mask, layer_memories, memory_keys_values=None,
+                memory_indices=None):
+        """ Propagates the input information through the attention layer. If memory_indices is given,
+        layer_memories are preallocated (see _update_preallocated_memories()). """
+        if memory_keys_values is not None:
+            # Attend to precomputed keys and values (see compute_memory_keys_values())
+            queries = self.queries_projection.forward(query_context)
+            split_queries = self._split_among_heads(queries)
+            split_weighted_memories = self._cached_dot_product_attn(split_queries, memory_keys_values['keys'],
+                                                                    memory_keys_values['values'], attn_mask)
+            weighted_memories = self._merge_from_heads(split_weighted_memories)
+            projected_memories = self.context_projection.forward(weighted_memories)
+            return projected_memories, layer_memories
 
-    def forward(self, query_context, memory_context, attn_mask, layer_memories):
-        """ Propagates the input information through the attention layer. """
         # The context for the query and the referenced memory is identical in case of self-attention
         if memory_context is None:
             memory_context = query_context
@@ -186,7 +254,9 @@ class MultiHeadAttentionLayer(object):
         queries, keys, values = self._compute_attn_inputs(query_context, memory_context)
 
         # Recall and update memories (analogous to the RNN state) - decoder only
-        if layer_memories is not None:
+        if layer_memories is not None and memory_indices is not None:
+            keys, values = self._update_preallocated_memories(keys, values, layer_memories, memory_indices)
+        elif layer_memories is not None:
             keys = tf.concat([layer_memories['keys'], keys], axis=1)
             values = tf.concat([layer_memories['values'], values], axis=1)
             layer_memories['keys'] = keys
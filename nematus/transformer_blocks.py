@@ -81,13 +81,15 @@ class AttentionBlock(object):
                                          training=training,
                                          name='post_{:s}_sublayer'.format(attn_name))
 
-    def forward(self, inputs, memory_context, attn_mask, layer_memories=None):
+    def forward(self, inputs, memory_context, attn_mask, layer_memories=None, memory_keys_values=None,
+                memory_indices=None):
         """ Propagates input data through the block. """
         if not self.self_attention:
-            assert (memory_context is not None), \
+            assert (memory_context is not None or memory_keys_values is not None), \
                 'Encoder memories have to be provided for encoder-decoder attention computation.'
         attn_inputs = self.pre_attn.forward(inputs)
-        attn_outputs, layer_memories = self.attn.forward(attn_inputs, memory_context, attn_mask, layer_memories)
+        attn_outputs, layer_memories = self.attn.forward(attn_inputs, memory_context, attn_mask, layer_memories,
+                                                         memory_keys_values, memory_indices)
         block_out = self.post_attn.forward(attn_outputs, residual_inputs=inputs)
         return block_out, layer_memories
 
@@ -1,5 +1,6 @@
 """Adapted from Nematode: https://github.com/demelin/nematode """
 
+import collections
 import sys
 import tensorflow as tf
 
@@ -10,17 +11,20 @@ if sys.version_info < (3, 6):
 try:
     from . import tf_utils
     from .transformer import INT_DTYPE, FLOAT_DTYPE
-    from .transformer_layers import get_positional_signal
+    from .transformer_layers import get_positional_signal, RMSNormLayer
 except (ModuleNotFoundError, ImportError) as e:
     import tf_utils
     from transformer import INT_DTYPE, FLOAT_DTYPE
-    from transformer_layers import get_positional_signal
+    from transformer_layers import get_positional_signal, RMSNormLayer
 
 
-class EncoderOutput:
-    def __init__(self, enc_output, cross_attn_mask):
-        self.enc_output = enc_output
-        self.cross_attn_mask = cross_attn_mask
+# cross_attn_keys_values is a dictionary mapping decoder layer IDs to the keys
+# and values of the cross-attention (see MultiHeadAttentionLayer.
+# compute_memory_keys_values()). All tensors have the input sentences in the
+# first dimension, so that the structure can be compacted with tf.nest (see
+# BeamSearchSampler).
+EncoderOutput = collections.namedtuple(
+    'EncoderOutput', ['enc_output', 'cross_attn_mask', 'cross_attn_keys_values'])
 
 
 class ModelAdapter:
@@ -36,6 +40,9 @@ class ModelAdapter:
         self._model = model
         self._config = config
         self._scope = scope
+        # The number of models whose memories are held in this adapter's
+        # memories (see EnsembleModelAdapter).
+        self._num_models = 1
 
     @property
     def model(self):
@@ -57,9 +64,24 @@ class ModelAdapter:
         with tf.compat.v1.name_scope(self._scope):
             enc_output, cross_attn_mask = self._model.enc.encode(
                 self._model.source_ids, self._model.source_mask)
-            return EncoderOutput(enc_output, cross_attn_mask)
-
-    def generate_decoding_function(self, encoder_output):
+            # The cross-attention keys and values only depend on the encoder
+            # output, so compute them once here rather than at every decoding
+            # step. They are not tiled to the beam size.
+            decoder = self._model.dec
+            cross_attn_keys_values = {}
+            for layer_id in range(1, self.config.transformer_dec_depth+1):
+                attn = decoder.decoder_stack[layer_id]['cross_attn'].attn
+                cross_attn_keys_values[layer_id] = \
+                    attn.compute_memory_keys_values(enc_output)
+            return EncoderOutput(enc_output, cross_attn_mask,
+                                 cross_attn_keys_values)
+
+    def generate_decoding_function(self, encoder_output, output_ids=None):
+        """Returns a single-step decoding function.
+
+        If output_ids (a 1-D Tensor of target vocabulary IDs) is given, the
+        decoding function only returns the logits for those IDs.
+        """
 
         with tf.compat.v1.name_scope(self._scope):
             # Generate a positional signal for the longest possible output.
@@ -75,13 +97,16 @@ class ModelAdapter:
         else:
             dropout = None
 
-        def _decoding_function(step_target_ids, current_time_step, memories):
+        def _decoding_function(step_target_ids, current_time_step, memories,
+                               encoder_output=encoder_output):
             """Single-step decoding function.
 
             Args:
                 step_target_ids: Tensor with shape (batch_size)
                 current_time_step: scalar Tensor.
                 memories: dictionary (see top-level class description)
+                encoder_output: EncoderOutput for the sentences in the batch
+                    (defaults to the output of encode()).
 
             Returns:
             """
@@ -103,37 +128,92 @@ class ModelAdapter:
                 # NOTE: No self-attention mask is applied at decoding, as
                 #       future information is unavailable.
                 layer_output = target_embeddings
+                if self.config.preallocate_kv_cache:
+                    memory_indices = self._update_memory_rows(
+                        memories, current_time_step)
+                else:
+                    memory_indices = None
                 for layer_id in range(1, self.config.transformer_dec_depth+1):
                     layer = decoder.decoder_stack[layer_id]
                     mem_key = 'layer_{:d}'.format(layer_id)
                     layer_output, memories[mem_key] = \
                         layer['self_attn'].forward(
-                            layer_output, None, None, memories[mem_key])
+                            layer_output, None, None, memories[mem_key],
+                            memory_indices=memory_indices)
                     layer_output, _ = layer['cross_attn'].forward(
-                        layer_output, encoder_output.enc_output,
-                        encoder_output.cross_attn_mask)
+                        layer_output, None, encoder_output.cross_attn_mask,
+                        memory_keys_values=
+                            encoder_output.cross_attn_keys_values[layer_id])
                     layer_output = layer['ffn'].forward(layer_output)
                 # Return prediction at the final time-step to be consistent
                 # with the inference pipeline.
                 dec_output = layer_output[:, -1, :]
                 # Project decoder stack outputs and apply the soft-max
                 # non-linearity.
-                step_logits = \
-                    decoder.softmax_projection_layer.project(dec_output)
+                step_logits = decoder.softmax_projection_layer.project(
+                    dec_output, output_ids=output_ids)
                 return step_logits, memories
 
         return _decoding_function
 
-    def generate_initial_memories(self, batch_size, beam_size):
+    def _update_memory_rows(self, memories, current_time_step):
+        """Adds the current time-step to preallocated memories.
+
+        This time-step's keys and values are written to the first rows of the
+        memories, one per hypothesis and model (see
+        generate_initial_memories()).
+
+        Returns:
+            The (position, row) coordinates of the keys and values that each
+            hypothesis attends to, as a Tensor with shape
+            (batch_size * num_models, time_steps, 2). They are shared by all
+            decoder layers.
+        """
+        rows = memories['memory_rows']
+        num_rows = tf.shape(input=rows)[0]
+        rows = tf.concat([rows, tf.expand_dims(tf.range(num_rows), 1)], axis=1)
+        memories['memory_rows'] = rows
+        # Each hypothesis has one row per model, ordered by hypothesis first.
+        rows = (tf.expand_dims(rows * self._num_models, 1)
+                + tf.reshape(tf.range(self._num_models), [1, -1, 1]))
+        rows = tf.reshape(rows, [num_rows * self._num_models, -1])
+        positions = tf.tile(tf.expand_dims(tf.range(current_time_step), 0),
+                            [num_rows * self._num_models, 1])
+        return tf.stack([positions, rows], axis=2)
+
+    def generate_initial_memories(self, batch_size, beam_size,
+                                  max_translation_len):
         with tf.compat.v1.name_scope(self._scope):
             state_size = self.config.state_size
             memories = {}
+            if self.config.preallocate_kv_cache:
+                # Each layer's keys and values are written into buffers that
+                # cover the longest output of this run, one position at a
+                # time. They are never copied: beam reordering (and batch
+                # compaction) only gathers memory_rows, which holds, for each
+                # hypothesis, the row of its ancestor's keys and values at
+                # every previous position. As the buffers are updated in
+                # place, each is created by its own (stateful) Empty op;
+                # identical tf.zeros() ops could be merged by the optimizer.
+                num_rows = batch_size * beam_size
+                shape = [max_translation_len, num_rows * self._num_models,
+                         state_size]
+                for layer_id in range(1, self.config.transformer_dec_depth + 1):
+                    memories['layer_{:d}'.format(layer_id)] = {
+                        'keys': tf.raw_ops.Empty(shape=shape,
+                                                 dtype=FLOAT_DTYPE, init=True),
+                        'values': tf.raw_ops.Empty(shape=shape,
+                                                   dtype=FLOAT_DTYPE, init=True)
+                    }
+                memories['memory_rows'] = tf.zeros([num_rows, 0],
+                                                   dtype=INT_DTYPE)
+                return memories
             for layer_id in range(1, self.config.transformer_dec_depth + 1):
                 memories['layer_{:d}'.format(layer_id)] = { \
                     'keys': tf.tile(tf.zeros([batch_size, 0, state_size]),
-                                    [beam_size, 1, 1]),
+                                    [beam_size * self._num_models, 1, 1]),
                     'values': tf.tile(tf.zeros([batch_size, 0, state_size]),
-                                      [beam_size, 1, 1])
+                                      [beam_size * self._num_models, 1, 1])
                 }
             return memories
 
@@ -148,6 +228,12 @@ class ModelAdapter:
         """
         with tf.compat.v1.name_scope(self._scope):
             invariants = dict()
+            if self.config.preallocate_kv_cache:
+                # The preallocated buffers keep their shape throughout.
+                invariants = tf.nest.map_structure(lambda mem: mem.get_shape(),
+                                                   memories)
+                invariants['memory_rows'] = tf.TensorShape([None, None])
+                return invariants
             for layer_id in memories.keys():
                 layer_mems = memories[layer_id]
                 invariants[layer_id] = {
@@ -173,30 +259,292 @@ class ModelAdapter:
             tf_utils.assert_shapes(shapes)
 
             coords_shape = tf.shape(input=gather_coordinates)
-            batch_size_x, beam_size = coords_shape[0], coords_shape[1]
-
-            def gather_attn(attn):
-                # TODO Specify second and third?
-                shapes = { attn: ('batch_size', None, None) }
-                tf_utils.assert_shapes(shapes)
-                attn_dims = tf_utils.get_shape_list(attn)
-                new_shape = [beam_size, batch_size_x] + attn_dims[1:]
-                tmp = tf.reshape(attn, new_shape)
-                flat_tensor = tf.transpose(a=tmp, perm=[1, 0, 2, 3])
-                tmp = tf.gather_nd(flat_tensor, gather_coordinates)
-                tmp = tf.transpose(a=tmp, perm=[1, 0, 2, 3])
-                gathered_values = tf.reshape(tmp, attn_dims)
-                return gathered_values
-
-            gathered_memories = dict()
-
-            for layer_key in memories.keys():
-                layer_dict = memories[layer_key]
-                gathered_memories[layer_key] = dict()
-
-                for attn_key in layer_dict.keys():
-                    attn_tensor = layer_dict[attn_key]
-                    gathered_memories[layer_key][attn_key] = \
-                        gather_attn(attn_tensor)
-
-            return gathered_memories
+            beam_size = coords_shape[1]
+
+            # The memories may cover more sentences than are gathered (if the
+            # batch is being compacted), so the number of sentences that they
+            # cover is read from the memories themselves.
+            if self.config.preallocate_kv_cache:
+                mem_batch_size_x = \
+                    tf.shape(input=memories['memory_rows'])[0] // beam_size
+            else:
+                mem_batch_size_x = \
+                    tf.shape(input=memories['layer_1']['keys'])[0] \
+                    // (beam_size * self._num_models)
+
+            # Memories are laid out beam-major, i.e. the entry for beam j of
+            # sentence i is at row j*mem_batch_size_x+i, so a single gather
+            # along the first axis reorders them.
+            flat_indices = (gather_coordinates[:, :, 1] * mem_batch_size_x
+                            + gather_coordinates[:, :, 0])
+            flat_indices = tf.reshape(tf.transpose(a=flat_indices), [-1])
+            if self.config.preallocate_kv_cache:
+                # The buffers are left in place (see
+                # generate_initial_memories()).
+                gathered_memories = dict(memories)
+                gathered_memories['memory_rows'] = tf.gather(
+                    memories['memory_rows'], flat_indices)
+                return gathered_memories
+            if self._num_models > 1:
+                # Each hypothesis has one row per model.
+                flat_indices = tf.reshape(
+                    tf.expand_dims(flat_indices * self._num_models, 1)
+                    + tf.range(self._num_models), [-1])
+            return tf.nest.map_structure(
+                lambda mem: tf.gather(mem, flat_indices), memories)
+
+
+def decoder_structure(config):
+    """Returns the config values that determine a Transformer decoder's
+    weight shapes and computation.
+
+    The decoders of models with equal values can be stacked by
+    EnsembleModelAdapter.
+    """
+    return (config.state_size, config.embedding_size, config.target_vocab_size,
+            config.transformer_dec_depth, config.transformer_num_heads,
+            config.transformer_ffn_hidden_size,
+            config.layer_normalization_type)
+
+
+class EnsembleModelAdapter(ModelAdapter):
+    """Runs the decoding steps of several Transformers as one.
+
+    The models must have the same decoder_structure(). Their decoder weights
+    are stacked along a leading model axis, so that each projection in a
+    decoding step is a single batched matmul over all models. The decoding
+    function returns the logits of all models, with shape (num_models,
+    batch_size, vocab_size), so the sampler can normalize and combine them
+    with a single log-softmax. The models share one set of memories, in which
+    each hypothesis has one row per model (ordered by hypothesis first), so
+    that gather_memories() reorders the memories of all models at once.
+
+    The encoders are run separately, as the models' source vocabularies and
+    encoder depths may differ. The stacked layers do not apply dropout, so the
+    adapter must only be used for translation.
+    """
+    def __init__(self, adapters, scope):
+        super().__init__(adapters[0].model, adapters[0].config, scope)
+        self._adapters = adapters
+        self._num_models = len(adapters)
+
+    @property
+    def num_models(self):
+        return self._num_models
+
+    def encode(self):
+        encoder_outputs = [adapter.encode() for adapter in self._adapters]
+        with tf.compat.v1.name_scope(self._scope):
+            # The models' outputs are stacked along the second axis, as the
+            # first one is the input sentences (see EncoderOutput). All models
+            # have the same source mask.
+            return EncoderOutput(
+                tf.stack([out.enc_output for out in encoder_outputs], axis=1),
+                encoder_outputs[0].cross_attn_mask,
+                tf.nest.map_structure(
+                    lambda *tensors: tf.stack(tensors, axis=1),
+                    *[out.cross_attn_keys_values for out in encoder_outputs]))
+
+    def generate_decoding_function(self, encoder_output, output_ids=None):
+        """Returns a single-step decoding function for all models.
+
+        If output_ids (a 1-D Tensor of target vocabulary IDs) is given, the
+        decoding function only returns the logits for those IDs.
+        """
+
+        num_models = self._num_models
+        decoders = [adapter.model.dec for adapter in self._adapters]
+        # The attention functions do not depend on the models' weights.
+        first_stack = decoders[0].decoder_stack
+        state_size = self.config.state_size
+
+        with tf.compat.v1.name_scope(self._scope):
+            positional_signal = get_positional_signal(
+                max(adapter.config.translation_maxlen
+                    for adapter in self._adapters),
+                self.config.embedding_size,
+                FLOAT_DTYPE)
+
+            # The stacked weights are computed once per run, outside of the
+            # decoding loop.
+            def stack(get_weights):
+                return tf.stack([get_weights(decoder) for decoder in decoders])
+
+            # Shape (num_models, embedding_size, vocab_size).
+            projection_matrices = stack(
+                lambda dec: dec.softmax_projection_layer.get_projection_matrix())
+            if output_ids is not None:
+                projection_matrices = tf.gather(projection_matrices,
+                                                output_ids, axis=2)
+            layers = {}
+            for layer_id in range(1, self.config.transformer_dec_depth+1):
+                layers[layer_id] = _StackedDecoderLayer(
+                    [dec.decoder_stack[layer_id] for dec in decoders])
+
+        def to_rows(inputs):
+            """[num_models, batch_size, depth] -> [batch_size * num_models, 1,
+            depth], with the rows ordered by hypothesis first."""
+            depth = inputs.shape[-1]
+            inputs = tf.transpose(a=inputs, perm=[1, 0, 2])
+            return tf.reshape(inputs, [-1, 1, depth])
+
+        def from_rows(inputs):
+            """Inverts to_rows()."""
+            inputs = tf.reshape(inputs, [-1, num_models, state_size])
+            return tf.transpose(a=inputs, perm=[1, 0, 2])
+
+        def _decoding_function(step_target_ids, current_time_step, memories,
+                               encoder_output=encoder_output):
+            """Single-step decoding function.
+
+            Args:
+                step_target_ids: Tensor with shape (batch_size)
+                current_time_step: scalar Tensor.
+                memories: dictionary (see top-level class description)
+                encoder_output: EncoderOutput for the sentences in the batch
+                    (defaults to the output of encode()).
+
+            Returns:
+                A pair (logits, memories), where logits has shape
+                (num_models, batch_size, vocab_size).
+            """
+            with tf.compat.v1.name_scope(self._scope):
+                # Look up embeddings for target IDs and add positional signal.
+                # layer_output has shape (num_models, batch_size, depth).
+                layer_output = tf.stack(
+                    [dec._embed(step_target_ids) for dec in decoders])
+                layer_output += positional_signal[
+                    :, current_time_step-1, :]
+                if self.config.preallocate_kv_cache:
+                    memory_indices = self._update_memory_rows(
+                        memories, current_time_step)
+                else:
+                    memory_indices = None
+                # The cross-attention of the models is computed as if the
+                # models were separate input sentences.
+                cross_attn_mask = tf.repeat(encoder_output.cross_attn_mask,
+                                            num_models, axis=0)
+                for layer_id in range(1, self.config.transformer_dec_depth+1):
+                    layer = layers[layer_id]
+                    self_attn = first_stack[layer_id]['self_attn'].attn
+                    cross_attn = first_stack[layer_id]['cross_attn'].attn
+                    mem_key = 'layer_{:d}'.format(layer_id)
+
+                    # Self-attention.
+                    queries, keys, values = tf.split(
+                        to_rows(tf.matmul(layer.self_attn_norm(layer_output),
+                                          layer.self_attn_qkv)),
+                        3, axis=-1)
+                    layer_memories = memories[mem_key]
+                    if memory_indices is not None:
+                        keys, values = self_attn._update_preallocated_memories(
+                            keys, values, layer_memories, memory_indices)
+                    else:
+                        keys = tf.concat([layer_memories['keys'], keys], axis=1)
+                        values = tf.concat([layer_memories['values'], values],
+                                           axis=1)
+                        layer_memories['keys'] = keys
+                        layer_memories['values'] = values
+                    attn_output = self_attn._merge_from_heads(
+                        self_attn._dot_product_attn(
+                            self_attn._split_among_heads(queries),
+                            self_attn._split_among_heads(keys),
+                            self_attn._split_among_heads(values),
+                            None, scaling_on=True))
+                    layer_output += tf.matmul(from_rows(attn_output),
+                                              layer.self_attn_context)
+
+                    # Cross-attention.
+                    keys_values = \
+                        encoder_output.cross_attn_keys_values[layer_id]
+                    queries = tf.matmul(layer.cross_attn_norm(layer_output),
+                                        layer.cross_attn_queries)
+                    attn_output = cross_attn._merge_from_heads(
+                        cross_attn._cached_dot_product_attn(
+                            cross_attn._split_among_heads(to_rows(queries)),
+                            _merge_first_dims(keys_values['keys']),
+                            _merge_first_dims(keys_values['values']),
+                            cross_attn_mask))
+                    layer_output += tf.matmul(from_rows(attn_output),
+                                              layer.cross_attn_context)
+
+                    # Feed-forward network.
+                    ffn_output = tf.nn.relu(
+                        tf.matmul(layer.ffn_norm(layer_output),
+                                  layer.ffn_weights[0])
+                        + layer.ffn_biases[0])
+                    layer_output += (tf.matmul(ffn_output, layer.ffn_weights[1])
+                                     + layer.ffn_biases[1])
+                    if layer.final_norm is not None:
+                        layer_output = layer.final_norm(layer_output)
+
+                step_logits = tf.matmul(layer_output, projection_matrices)
+                return step_logits, memories
+
+        return _decoding_function
+
+
+def _merge_first_dims(tensor):
+    """Merges the first two dimensions of tensor."""
+    shape = tf_utils.get_shape_list(tensor)
+    return tf.reshape(tensor, [-1] + shape[2:])
+
+
+def _stack_norm(norm_layers):
+    """Returns a function that applies the LayerNormLayer or RMSNormLayer
+    of each model to its slice of a stacked Tensor."""
+    # Parameters have shape (num_models, 1, depth).
+    scale = tf.expand_dims(tf.stack([layer.scale for layer in norm_layers]), 1)
+    eps = norm_layers[0].eps
+    if isinstance(norm_layers[0], RMSNormLayer):
+        def rms_norm(inputs):
+            meansquare = tf.reduce_mean(inputs**2, axis=-1, keepdims=True)
+            return scale * inputs * tf.math.rsqrt(meansquare + eps)
+        return rms_norm
+    offset = tf.expand_dims(
+        tf.stack([layer.offset for layer in norm_layers]), 1)
+    def layer_norm(inputs):
+        mean, variance = tf.nn.moments(x=inputs, axes=-1, keepdims=True)
+        return scale * (inputs - mean) / tf.sqrt(variance + eps) + offset
+    return layer_norm
+
+
+class _StackedDecoderLayer:
+    """Holds the weights of one decoder layer of several models, stacked
+    along a leading model axis (see EnsembleModelAdapter)."""
+    def __init__(self, layers):
+        def stack(get_weights):
+            return tf.stack([get_weights(layer) for layer in layers])
+
+        self.self_attn_norm = _stack_norm(
+            [layer['self_attn'].pre_attn.layer_norm for layer in layers])
+        # The query, key and value projections are computed with one matmul.
+        self.self_attn_qkv = stack(lambda layer: tf.concat(
+            [layer['self_attn'].attn.queries_projection.weights,
+             layer['self_attn'].attn.keys_projection.weights,
+             layer['self_attn'].attn.values_projection.weights], axis=1))
+        self.self_attn_context = stack(
+            lambda layer: layer['self_attn'].attn.context_projection.weights)
+
+        self.cross_attn_norm = _stack_norm(
+            [layer['cross_attn'].pre_attn.layer_norm for layer in layers])
+        self.cross_attn_queries = stack(
+            lambda layer: layer['cross_attn'].attn.queries_projection.weights)
+        self.cross_attn_context = stack(
+            lambda layer: layer['cross_attn'].attn.context_projection.weights)
+
+        self.ffn_norm = _stack_norm(
+            [layer['ffn'].pre_ffn.layer_norm for layer in layers])
+        self.ffn_weights = [
+            stack(lambda layer: layer['ffn'].ffn.layers[i].weights)
+            for i in range(2)]
+        # Biases have shape (num_models, 1, depth).
+        self.ffn_biases = [
+            tf.expand_dims(
+                stack(lambda layer: layer['ffn'].ffn.layers[i].biases), 1)
+            for i in range(2)]
+        if layers[0]['ffn'].is_final:
+            self.final_norm = _stack_norm(
+                [layer['ffn'].pre_final.layer_norm for layer in layers])
+        else:
+            self.final_norm = None
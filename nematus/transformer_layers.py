@@ -97,9 +97,13 @@ class EmbeddingLayer(object):
         embeddings *= tf.sqrt(tf.cast(self.hidden_size, self.float_dtype))
         return embeddings
 
-    def project(self, dec_out):
-        """ Projects the transformer decoder's output into the vocabulary space. """
-        projections = matmul_nd(dec_out, self.projection_matrix)
+    def project(self, dec_out, output_ids=None):
+        """ Projects the transformer decoder's output into the vocabulary space; if output_ids is given, only into
+        the subspace of those vocabulary entries. """
+        projection_matrix = self.projection_matrix
+        if output_ids is not None:
+            projection_matrix = tf.gather(projection_matrix, output_ids, axis=1)
+        projections = matmul_nd(dec_out, projection_matrix)
         return projections
 
     def get_embedding_table(self):
@@ -14,6 +14,9 @@ if __name__ == '__main__':
     logging.basicConfig(level=level, format='%(levelname)s: %(message)s')
 
 import argparse
+import io
+import multiprocessing
+import queue
 
 import tensorflow as tf
 
@@ -25,22 +28,30 @@ try:
     from .beam_search_sampler import BeamSearchSampler
     from .config import load_config_from_json_file
     from .exponential_smoothing import ExponentialSmoothing
+    from .greedy_sampler import GreedySampler
     from . import model_loader
     from .random_sampler import RandomSampler
     from . import rnn_model
     from .sampling_utils import SamplingUtils
+    from .shortlist import Shortlist
     from .transformer import Transformer as TransformerModel
     from . import translate_utils
+    from . import util
+    from . import vocab
 except (ModuleNotFoundError, ImportError) as e:
     from beam_search_sampler import BeamSearchSampler
     from config import load_config_from_json_file
     from exponential_smoothing import ExponentialSmoothing
+    from greedy_sampler import GreedySampler
     import model_loader
     from random_sampler import RandomSampler
     import rnn_model
     from sampling_utils import SamplingUtils
+    from shortlist import Shortlist
     from transformer import Transformer as TransformerModel
     import translate_utils
+    import util
+    import vocab
 
 
 def main(settings):
@@ -48,77 +59,230 @@ def main(settings):
     Translates a source language file (or STDIN) into a target language file
     (or STDOUT).
     """
+    if settings.workers > 1:
+        _translate_with_workers(settings)
+        return
+
     # Create the TensorFlow session.
     g = tf.Graph()
     with g.as_default():
-        tf_config = tf.compat.v1.ConfigProto()
-        tf_config.allow_soft_placement = True
-        session = tf.compat.v1.Session(config=tf_config)
-
-        # Load config file for each model.
-        configs = []
-        for model in settings.models:
-            config = load_config_from_json_file(model)
-            setattr(config, 'reload', model)
-            configs.append(config)
-
-        # Create the model graphs.
-        logging.debug("Loading models\n")
-        models = []
-        for i, config in enumerate(configs):
-            with tf.compat.v1.variable_scope("model%d" % i) as scope:
-                if config.model_type == "transformer":
-                    model = TransformerModel(config)
-                else:
-                    model = rnn_model.RNNModel(config)
-                model.sampling_utils = SamplingUtils(settings)
-                models.append(model)
-
-        # Add smoothing variables (if the models were trained with smoothing).
-        #FIXME Assumes either all models were trained with smoothing or none were.
-        if configs[0].exponential_smoothing > 0.0:
-            smoothing = ExponentialSmoothing(configs[0].exponential_smoothing)
-
-        # Restore the model variables.
-        for i, config in enumerate(configs):
-            with tf.compat.v1.variable_scope("model%d" % i) as scope:
-                _ = model_loader.init_or_restore_variables(config, session,
-                                                       ensemble_scope=scope)
-
-        # Swap-in the smoothed versions of the variables.
-        if configs[0].exponential_smoothing > 0.0:
-            session.run(fetches=smoothing.swap_ops)
-
-        max_translation_len = settings.translation_maxlen
-
-        # Create a BeamSearchSampler / RandomSampler.
-        if settings.translation_strategy == 'beam_search':
-            sampler = BeamSearchSampler(models, configs, settings.beam_size)
-        else:
-            assert settings.translation_strategy == 'sampling'
-            sampler = RandomSampler(models, configs, settings.beam_size)
+        session = _create_session(settings)
+        configs, sampler = _load_sampler(settings, session)
 
-        # Warn about the change from neg log probs to log probs for the RNN.
         if settings.n_best:
-            model_types = [config.model_type for config in configs]
-            if 'rnn' in model_types:
-                logging.warn('n-best scores for RNN models have changed from '
-                             'positive to negative (as of commit 95793196...). '
-                             'If you are using the scores for reranking etc, then '
-                             'you may need to update your scripts.')
+            _warn_about_nbest_scores(configs)
 
         # Translate the source file.
-        translate_utils.translate_file(
-            input_file=settings.input,
-            output_file=settings.output,
-            session=session,
-            sampler=sampler,
-            config=configs[0],
-            max_translation_len=max_translation_len,
-            normalization_alpha=settings.normalization_alpha,
-            nbest=settings.n_best,
-            minibatch_size=settings.minibatch_size,
-            maxibatch_size=settings.maxibatch_size)
+        _translate(settings, session, sampler, configs, settings.input,
+                   settings.output)
+
+
+def _warn_about_nbest_scores(configs):
+    # Warn about the change from neg log probs to log probs for the RNN.
+    model_types = [config.model_type for config in configs]
+    if 'rnn' in model_types:
+        logging.warn('n-best scores for RNN models have changed from '
+                     'positive to negative (as of commit 95793196...). '
+                     'If you are using the scores for reranking etc, then '
+                     'you may need to update your scripts.')
+
+
+def _create_session(settings):
+    tf_config = tf.compat.v1.ConfigProto()
+    tf_config.allow_soft_placement = True
+    if settings.threads_per_worker > 0:
+        tf_config.intra_op_parallelism_threads = settings.threads_per_worker
+        tf_config.inter_op_parallelism_threads = settings.threads_per_worker
+    return tf.compat.v1.Session(config=tf_config)
+
+
+def _load_sampler(settings, session):
+    """Loads the models into session and creates the sampler.
+
+    Returns:
+        A pair (configs, sampler).
+    """
+    # Load config file for each model.
+    configs = []
+    for model in settings.models:
+        config = load_config_from_json_file(model)
+        setattr(config, 'reload', model)
+        setattr(config, 'preallocate_kv_cache', settings.preallocate_kv_cache)
+        configs.append(config)
+
+    # Create the model graphs.
+    logging.debug("Loading models\n")
+    models = []
+    for i, config in enumerate(configs):
+        with tf.compat.v1.variable_scope("model%d" % i) as scope:
+            if config.model_type == "transformer":
+                model = TransformerModel(config)
+            else:
+                model = rnn_model.RNNModel(config)
+            model.sampling_utils = SamplingUtils(settings)
+            models.append(model)
+
+    # Add smoothing variables (if the models were trained with smoothing).
+    #FIXME Assumes either all models were trained with smoothing or none were.
+    if configs[0].exponential_smoothing > 0.0:
+        smoothing = ExponentialSmoothing(configs[0].exponential_smoothing)
+
+    # Restore the model variables.
+    for i, config in enumerate(configs):
+        with tf.compat.v1.variable_scope("model%d" % i) as scope:
+            _ = model_loader.init_or_restore_variables(config, session,
+                                                   ensemble_scope=scope)
+
+    # Swap-in the smoothed versions of the variables.
+    if configs[0].exponential_smoothing > 0.0:
+        session.run(fetches=smoothing.swap_ops)
+
+    # Create a BeamSearchSampler / GreedySampler / RandomSampler.
+    if settings.translation_strategy == 'beam_search':
+        shortlist = None
+        if settings.shortlist is not None:
+            shortlist = Shortlist.load(
+                settings.shortlist,
+                util.load_source_vocabularies(configs[0])[0],
+                vocab.load_vocabulary(configs[0].target_dict,
+                                      configs[0].model_type,
+                                      configs[0].target_vocab_size))
+        if settings.beam_size == 1:
+            sampler = GreedySampler(models, configs, shortlist)
+        else:
+            sampler = BeamSearchSampler(models, configs,
+                                        settings.beam_size,
+                                        settings.compact_batch, shortlist,
+                                        settings.stack_ensemble)
+    else:
+        assert settings.translation_strategy == 'sampling'
+        sampler = RandomSampler(models, configs, settings.beam_size)
+
+    return configs, sampler
+
+
+def _translate(settings, session, sampler, configs, input_file, output_file,
+               first_sentence_id=0, log_length_cap=True):
+    translate_utils.translate_file(
+        input_file=input_file,
+        output_file=output_file,
+        session=session,
+        sampler=sampler,
+        config=configs[0],
+        max_translation_len=settings.translation_maxlen,
+        normalization_alpha=settings.normalization_alpha,
+        nbest=settings.n_best,
+        minibatch_size=settings.minibatch_size,
+        maxibatch_size=settings.maxibatch_size,
+        token_batch_size=settings.token_batch_size,
+        first_sentence_id=first_sentence_id,
+        log_length_cap=log_length_cap)
+
+
+def _translate_with_workers(settings, timeout=5):
+    """Translates the input with settings.workers worker processes.
+
+    The input is split into maxibatches, which are sent to the workers
+    through a bounded queue; each worker loads the models once and returns
+    the translated text of each maxibatch. The parent process writes the
+    results in input order.
+    """
+    if settings.n_best:
+        _warn_about_nbest_scores(
+            [load_config_from_json_file(model) for model in settings.models])
+    translate_utils.log_translation_maxlen(settings.translation_maxlen)
+
+    # The workers only get the picklable settings (not the input and output
+    # files or the argument parser), so that this also works when processes
+    # are started with 'spawn' rather than 'fork'.
+    worker_settings = argparse.Namespace(**{
+        key: value for key, value in vars(settings).items()
+        if key not in ('input', 'output') and not key.startswith('_')})
+    input_queue = multiprocessing.Queue(maxsize=2*settings.workers)
+    output_queue = multiprocessing.Queue()
+    processes = []
+    for process_id in range(settings.workers):
+        process = multiprocessing.Process(
+            target=_start_worker,
+            args=(process_id, worker_settings, input_queue, output_queue))
+        process.start()
+        processes.append(process)
+
+    results = {}
+    num_written = 0
+
+    def collect(block):
+        """Writes the finished results that are next in input order."""
+        nonlocal num_written
+        while True:
+            try:
+                idx, output = output_queue.get(block, timeout)
+            except queue.Empty:
+                # If nothing arrived, check that the workers are still alive.
+                for process in processes:
+                    if not process.is_alive() and process.exitcode != 0:
+                        input_queue.cancel_join_thread()
+                        output_queue.cancel_join_thread()
+                        for p in processes:
+                            p.terminate()
+                        logging.error("Translate worker process {0} crashed "
+                                      "with exitcode {1}".format(
+                                          process.pid, process.exitcode))
+                        sys.exit(1)
+                if not block:
+                    return
+                continue
+            results[idx] = output
+            while num_written in results:
+                settings.output.write(results.pop(num_written))
+                num_written += 1
+            if block:
+                return
+
+    num_sent = 0
+    first_sentence_id = 0
+    for lines in translate_utils.read_maxibatches(
+            settings.input, settings.maxibatch_size * settings.minibatch_size):
+        item = (num_sent, first_sentence_id, lines)
+        while True:
+            try:
+                input_queue.put(item, True, timeout)
+                break
+            except queue.Full:
+                collect(block=False)
+        collect(block=False)
+        num_sent += 1
+        first_sentence_id += len(lines)
+
+    for process in processes:
+        input_queue.put(None)
+    while num_written < num_sent:
+        collect(block=True)
+    for process in processes:
+        process.join()
+
+
+def _start_worker(process_id, settings, input_queue, output_queue):
+    """
+    Function executed by each worker once started. Do not execute in
+    the parent process.
+    """
+    g = tf.Graph()
+    with g.as_default():
+        session = _create_session(settings)
+        configs, sampler = _load_sampler(settings, session)
+        while True:
+            item = input_queue.get()
+            if item is None:
+                break
+            idx, first_sentence_id, lines = item
+            output_file = io.StringIO()
+            _translate(settings, session, sampler, configs,
+                       io.StringIO(''.join(lines)), output_file,
+                       first_sentence_id, log_length_cap=False)
+            logging.info("Process '{}' - Translated maxibatch {}".format(
+                process_id, idx))
+            output_queue.put((idx, output_file.getvalue()))
 
 
 if __name__ == "__main__":
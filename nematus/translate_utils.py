@@ -1,5 +1,7 @@
 import logging
+import queue
 import sys
+import threading
 import time
 
 import numpy
@@ -18,7 +20,7 @@ except (ModuleNotFoundError, ImportError) as e:
 
 
 def translate_batch(session, sampler, x, x_mask, max_translation_len,
-                    normalization_alpha):
+                    normalization_alpha, beam_size=None):
     """Translate a batch using a RandomSampler or BeamSearchSampler.
 
     Args:
@@ -29,6 +31,8 @@ def translate_batch(session, sampler, x, x_mask, max_translation_len,
         max_translation_len: integer specifying maximum translation length.
         normalization_alpha: float specifying alpha parameter for length
             normalization.
+        beam_size: integer specifying the beam width (defaults to the
+            sampler's beam size).
 
     Returns:
         A list of lists of (translation, score) pairs. The outer list contains
@@ -37,8 +41,11 @@ def translate_batch(session, sampler, x, x_mask, max_translation_len,
         order.
     """
 
-    x_tiled = numpy.tile(x, reps=[1, 1, sampler.beam_size])
-    x_mask_tiled = numpy.tile(x_mask, reps=[1, sampler.beam_size])
+    if beam_size is None:
+        beam_size = sampler.beam_size
+
+    x_tiled = numpy.tile(x, reps=[1, 1, beam_size])
+    x_mask_tiled = numpy.tile(x_mask, reps=[1, beam_size])
 
     feed_dict = {}
 
@@ -58,6 +65,9 @@ def translate_batch(session, sampler, x, x_mask, max_translation_len,
 
     # Feed inputs to the sampler.
     feed_dict[sampler.inputs.batch_size_x] = x.shape[-1]
+    feed_dict[sampler.inputs.beam_size] = beam_size
+    if sampler.shortlist is not None:
+        feed_dict[sampler.inputs.shortlist] = sampler.shortlist.candidates(x[0])
     feed_dict[sampler.inputs.max_translation_len] = max_translation_len
     feed_dict[sampler.inputs.normalization_alpha] = normalization_alpha
 
@@ -79,9 +89,17 @@ def translate_batch(session, sampler, x, x_mask, max_translation_len,
 
 def translate_file(input_file, output_file, session, sampler, config,
                    max_translation_len, normalization_alpha, nbest=False,
-                   minibatch_size=80, maxibatch_size=20):
+                   minibatch_size=80, maxibatch_size=20, token_batch_size=0,
+                   first_sentence_id=0, log_length_cap=True):
     """Translates a source file using a RandomSampler or BeamSearchSampler.
 
+    The file is translated by a pipeline of three stages that are connected
+    by bounded queues: a reader thread splits each maxibatch into padded,
+    length-sorted minibatches, the calling thread runs the sampler on them,
+    and a writer thread restores the input order and writes the
+    translations. session.run() releases the GIL, so reading and writing
+    overlap with decoding.
+
     Args:
         input_file: file object from which source sentences will be read.
         output_file: file object to which translations will be written.
@@ -94,78 +112,192 @@ def translate_file(input_file, output_file, session, sampler, config,
         nbest: if True, produce n-best output with scores; otherwise 1-best.
         minibatch_size: minibatch size in sentences.
         maxibatch_size: number of minibatches to read and sort, pre-translation.
+        token_batch_size: if non-zero, minibatch size in source tokens times
+            beam size; minibatch_size then only affects the maxibatch size.
+        first_sentence_id: number of the first input sentence in n-best
+            output (for translating a file in several parts).
+        log_length_cap: if True, log the maximum translation length (callers
+            that translate a file in several parts log it once themselves).
     """
 
-    def translate_maxibatch(maxibatch, num_to_target, num_prev_translated):
-        """Translates an individual maxibatch.
-
-        Args:
-            maxibatch: a list of sentences.
-            num_to_target: dictionary mapping target vocabulary IDs to strings.
-            num_prev_translated: the number of previously translated sentences.
-        """
+    def read():
+        """Reader stage: puts (maxibatch, x, x_mask) items on input_queue."""
+        try:
+            first_line = first_sentence_id
+            start = time.time()
+            for lines in read_maxibatches(input_file,
+                                           maxibatch_size * minibatch_size):
+                # Sort the maxibatch by length and split into minibatches.
+                minibatches, idxs = util.read_all_lines(
+                    config, lines, minibatch_size,
+                    token_batch_size=token_batch_size,
+                    beam_size=sampler.beam_size)
+                maxibatch = _Maxibatch(first_line, idxs, len(minibatches))
+                items = []
+                for x in minibatches:
+                    y_dummy = numpy.zeros(shape=(len(x),1))
+                    x, x_mask, _, _ = util.prepare_data(x, y_dummy,
+                                                        config.factors,
+                                                        maxlen=None)
+                    items.append((maxibatch, x, x_mask))
+                reader_stats.add(len(lines), time.time() - start)
+                for item in items:
+                    input_queue.put(item)
+                first_line += len(lines)
+                start = time.time()
+            input_queue.put(_END_OF_INPUT)
+        except:
+            input_queue.put(_StageError(sys.exc_info()))
 
-        # Sort the maxibatch by length and split into minibatches.
+    def write():
+        """Writer stage: takes (maxibatch, beams) items from output_queue."""
         try:
-            minibatches, idxs = util.read_all_lines(config, maxibatch,
-                                                    minibatch_size)
-        except exception.Error as x:
-            logging.error(x.msg)
-            sys.exit(1)
-
-        # Translate the minibatches and store the resulting beam (i.e.
-        # translations and scores) for each sentence.
-        beams = []
-        for x in minibatches:
-            y_dummy = numpy.zeros(shape=(len(x),1))
-            x, x_mask, _, _ = util.prepare_data(x, y_dummy, config.factors,
-                                                maxlen=None)
+            while True:
+                item = output_queue.get()
+                if item is _END_OF_INPUT:
+                    return
+                maxibatch, beams = item
+                maxibatch.beams.extend(beams)
+                maxibatch.num_translated += 1
+                if maxibatch.num_translated < maxibatch.num_minibatches:
+                    continue
+                start = time.time()
+                _write_maxibatch(maxibatch, output_file, target_vocab, nbest)
+                writer_stats.add(len(maxibatch.beams), time.time() - start)
+        except:
+            writer_errors.append(sys.exc_info())
+            # Keep draining the queue so that the decoder does not block.
+            while output_queue.get() is not _END_OF_INPUT:
+                pass
+
+    target_vocab = util.load_target_vocabulary(config)
+
+    if log_length_cap:
+        log_translation_maxlen(max_translation_len)
+
+    start_time = time.time()
+
+    # Each queue holds up to about one maxibatch of minibatches.
+    input_queue = queue.Queue(maxsize=maxibatch_size)
+    output_queue = queue.Queue(maxsize=maxibatch_size)
+    reader_stats = _StageStats('Reading')
+    decoder_stats = _StageStats('Decoding')
+    writer_stats = _StageStats('Writing')
+    writer_errors = []
+
+    reader = threading.Thread(target=read, daemon=True)
+    writer = threading.Thread(target=write, daemon=True)
+    reader.start()
+    writer.start()
+
+    try:
+        while True:
+            item = input_queue.get()
+            if item is _END_OF_INPUT:
+                break
+            if isinstance(item, _StageError):
+                _, value, traceback = item.exc_info
+                raise value.with_traceback(traceback)
+            maxibatch, x, x_mask = item
+            start = time.time()
             sample = translate_batch(session, sampler, x, x_mask,
                                      max_translation_len, normalization_alpha)
-            beams.extend(sample)
-            num_translated = num_prev_translated + len(beams)
-            logging.info('Translated {} sents'.format(num_translated))
-
-        # Put beams into the same order as the input maxibatch.
-        tmp = numpy.array(beams, dtype=numpy.object)
-        ordered_beams = tmp[idxs.argsort()]
-
-        # Write the translations to the output file.
-        for i, beam in enumerate(ordered_beams):
-            if nbest:
-                num = num_prev_translated + i
-                for sent, cost in beam:
-                    translation = util.seq2words(sent, num_to_target)
-                    line = "{} ||| {} ||| {}\n".format(num, translation,
-                                                       str(cost))
-                    output_file.write(line)
-            else:
-                best_hypo, cost = beam[0]
-                line = util.seq2words(best_hypo, num_to_target) + '\n'
-                output_file.write(line)
+            decoder_stats.add(len(sample), time.time() - start)
+            logging.info('Translated {} sents'.format(decoder_stats.num_sents))
+            output_queue.put((maxibatch, sample))
+    except exception.Error as x:
+        logging.error(x.msg)
+        sys.exit(1)
+    finally:
+        output_queue.put(_END_OF_INPUT)
+        writer.join()
 
-    _, _, _, num_to_target = util.load_dictionaries(config)
+    if writer_errors:
+        _, value, traceback = writer_errors[0]
+        raise value.with_traceback(traceback)
 
+    num_translated = decoder_stats.num_sents
+    duration = time.time() - start_time
+    logging.info('Translated {} sents in {} sec. Speed {} sents/sec'.format(
+        num_translated, duration, num_translated/duration))
+    for stats in [reader_stats, decoder_stats, writer_stats]:
+        stats.log()
+
+
+def log_translation_maxlen(max_translation_len):
     logging.info("NOTE: Length of translations is capped to {}".format(
         max_translation_len))
 
-    start_time = time.time()
 
-    num_translated = 0
+# Queue item that marks the end of a pipeline stage's output.
+_END_OF_INPUT = 'end_of_input'
+
+
+class _StageError(object):
+    def __init__(self, exc_info):
+        self.exc_info = exc_info
+
+
+class _Maxibatch(object):
+    """Collects the translations of a maxibatch's minibatches."""
+
+    def __init__(self, first_line, idxs, num_minibatches):
+        self.first_line = first_line
+        self.idxs = idxs
+        self.num_minibatches = num_minibatches
+        self.num_translated = 0
+        self.beams = []
+
+
+class _StageStats(object):
+    """Counts the sentences handled by a pipeline stage and the time it spent
+    working on them (i.e. excluding the time spent waiting on its queues)."""
+
+    def __init__(self, name):
+        self.name = name
+        self.num_sents = 0
+        self.busy_time = 0.0
+
+    def add(self, num_sents, duration):
+        self.num_sents += num_sents
+        self.busy_time += duration
+
+    def log(self):
+        speed = self.num_sents / self.busy_time if self.busy_time > 0 else 0.0
+        logging.info('{}: {} sents in {:.2f} sec. Speed {:.2f} sents/sec'
+                     .format(self.name, self.num_sents, self.busy_time, speed))
+
+
+def read_maxibatches(input_file, maxibatch_len):
+    """Yields lists of up to maxibatch_len lines from input_file."""
     maxibatch = []
     while True:
         line = input_file.readline()
         if line == "":
-            if len(maxibatch) > 0:
-                translate_maxibatch(maxibatch, num_to_target, num_translated)
-                num_translated += len(maxibatch)
             break
         maxibatch.append(line)
-        if len(maxibatch) == (maxibatch_size * minibatch_size):
-            translate_maxibatch(maxibatch, num_to_target, num_translated)
-            num_translated += len(maxibatch)
+        if len(maxibatch) == maxibatch_len:
+            yield maxibatch
             maxibatch = []
+    if len(maxibatch) > 0:
+        yield maxibatch
 
-    duration = time.time() - start_time
-    logging.info('Translated {} sents in {} sec. Speed {} sents/sec'.format(
-        num_translated, duration, num_translated/duration))
+
+def _write_maxibatch(maxibatch, output_file, target_vocab, nbest):
+    """Writes the translations of a maxibatch in input order."""
+
+    # Put beams into the same order as the input maxibatch.
+    ordered_beams = [maxibatch.beams[i] for i in maxibatch.idxs.argsort()]
+
+    for i, beam in enumerate(ordered_beams):
+        if nbest:
+            num = maxibatch.first_line + i
+            for sent, cost in beam:
+                translation = target_vocab.decode(sent)
+                line = "{} ||| {} ||| {}\n".format(num, translation,
+                                                   str(cost))
+                output_file.write(line)
+        else:
+            best_hypo, cost = beam[0]
+            line = target_vocab.decode(best_hypo) + '\n'
+            output_file.write(line)
@@ -0,0 +1,89 @@
+"""Segment-level cache of translations for the server.
+
+Beams are cached per (source segment, model set, beam size, normalization
+alpha). Source segments are normalized by collapsing whitespace. The n-best
+setting is not part of the key, since 1-best and n-best output are both read
+from the same beam.
+
+The in-memory tier holds at most max_entries beams and evicts the least
+recently used one. If a path is given, beams are also written to a
+persistent tier (a shelve database), which is consulted on in-memory
+misses and survives server restarts.
+"""
+
+import collections
+import shelve
+import threading
+
+
+class TranslationCache(object):
+    """Thread-safe LRU cache of beams, with an optional on-disk tier."""
+
+    def __init__(self, models, max_entries, path=None):
+        """Initializes the cache.
+
+        Args:
+            models: list of model paths (part of every key).
+            max_entries: maximum number of beams in memory.
+            path: path of the persistent tier, or None.
+        """
+        self._models = tuple(models)
+        self._max_entries = max_entries
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self._shelf = None if path is None else shelve.open(path)
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+
+    def key(self, segment, beam_size, normalization_alpha):
+        return repr((' '.join(segment.split()), self._models, beam_size,
+                     float(normalization_alpha)))
+
+    def get(self, key):
+        """Returns the cached beam for key, or None."""
+        with self._lock:
+            beam = self._entries.get(key)
+            if beam is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return beam
+            if self._shelf is not None:
+                beam = self._shelf.get(key)
+                if beam is not None:
+                    self._insert(key, beam)
+                    self.disk_hits += 1
+                    return beam
+            self.misses += 1
+            return None
+
+    def put(self, key, beam):
+        with self._lock:
+            self._insert(key, beam)
+            if self._shelf is not None:
+                self._shelf[key] = beam
+
+    def _insert(self, key, beam):
+        self._entries[key] = beam
+        self._entries.move_to_end(key)
+        while len(self._entries) > self._max_entries:
+            self._entries.popitem(last=False)
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.disk_hits + self.misses
+            return {
+                'entries': len(self._entries),
+                'max_entries': self._max_entries,
+                'hits': self.hits,
+                'disk_hits': self.disk_hits,
+                'misses': self.misses,
+                'hit_rate': ((self.hits + self.disk_hits) / lookups
+                             if lookups else 0.0),
+            }
+
+    def close(self):
+        with self._lock:
+            if self._shelf is not None:
+                self._shelf.close()
+                self._shelf = None
@@ -1,5 +1,6 @@
 """Utility functions."""
 
+import itertools
 import pickle as pkl
 import json
 import logging
@@ -12,8 +13,10 @@ if sys.version_info < (3, 6):
 
 try:
     from . import exception
+    from . import vocab
 except (ModuleNotFoundError, ImportError) as e:
     import exception
+    import vocab
 
 # batch preparation
 def prepare_data(seqs_x, seqs_y, n_factors, maxlen=None):
@@ -57,27 +60,132 @@ def prepare_data(seqs_x, seqs_y, n_factors, maxlen=None):
     return x, x_mask, y, y_mask
 
 
+def flatten_sequences(seqs_x, seqs_y, n_factors):
+    """Converts a minibatch in TextIterator format to flat token arrays.
+
+    Args:
+        seqs_x: list of source sentences, each a list of tokens, each a list
+            of n_factors IDs.
+        seqs_y: list of target sentences, each a list of IDs.
+        n_factors: number of source factors.
+
+    Returns:
+        A tuple (x_ids, x_lengths, y_ids, y_lengths) where x_ids has shape
+        (total_source_tokens, n_factors), y_ids has shape
+        (total_target_tokens,), and the lengths are per-sentence token counts.
+    """
+    x_lengths = numpy.fromiter(map(len, seqs_x), dtype=numpy.int64,
+                               count=len(seqs_x))
+    y_lengths = numpy.fromiter(map(len, seqs_y), dtype=numpy.int64,
+                               count=len(seqs_y))
+    chain = itertools.chain.from_iterable
+    x_ids = numpy.fromiter(chain(chain(seqs_x)), dtype=numpy.int64,
+                           count=int(x_lengths.sum()) * n_factors)
+    x_ids = x_ids.reshape([-1, n_factors])
+    y_ids = numpy.fromiter(chain(seqs_y), dtype=numpy.int64,
+                           count=int(y_lengths.sum()))
+    return x_ids, x_lengths, y_ids, y_lengths
+
+
+class BatchBuilder(object):
+    """Vectorized alternative to prepare_data().
+
+    Builds the padded (x, x_mask, y, y_mask) arrays from flat token arrays
+    and sentence lengths without a Python loop over sentences. The arrays are
+    views into preallocated buffers that are reused (and grown if needed)
+    across calls: the result of a call stays valid until num_buffers further
+    calls have been made.
+    """
+
+    def __init__(self, n_factors, id_dtype=numpy.int32,
+                 mask_dtype=numpy.float32, num_buffers=1):
+        """Initializes the builder.
+
+        Args:
+            n_factors: number of source factors.
+            id_dtype: dtype of x and y (prepare_data() uses int64, but the
+                model placeholders are int32).
+            mask_dtype: dtype of x_mask and y_mask (e.g. float32, bool or
+                uint8).
+            num_buffers: number of buffer sets used in rotation.
+        """
+        self.n_factors = n_factors
+        self.id_dtype = numpy.dtype(id_dtype)
+        self.mask_dtype = numpy.dtype(mask_dtype)
+        self._buffers = [{} for _ in range(num_buffers)]
+        self._next_buffer = 0
+
+    def __call__(self, x_ids, x_lengths, y_ids, y_lengths):
+        """Builds a padded minibatch (see flatten_sequences() for args).
+
+        Returns:
+            A tuple (x, x_mask, y, y_mask) with the same layout as the
+            result of prepare_data().
+        """
+        buffers = self._buffers[self._next_buffer]
+        self._next_buffer = (self._next_buffer + 1) % len(self._buffers)
+        x_lengths = numpy.asarray(x_lengths)
+        y_lengths = numpy.asarray(y_lengths)
+        n_samples = len(x_lengths)
+        maxlen_x = int(x_lengths.max()) + 1
+        maxlen_y = int(y_lengths.max()) + 1
+
+        x = self._get_buffer(buffers, 'x',
+                             (self.n_factors, maxlen_x, n_samples),
+                             self.id_dtype)
+        positions, samples = self._token_coordinates(x_lengths)
+        x[:, positions, samples] = numpy.asarray(x_ids).T
+        y = self._get_buffer(buffers, 'y', (maxlen_y, n_samples),
+                             self.id_dtype)
+        positions, samples = self._token_coordinates(y_lengths)
+        y[positions, samples] = y_ids
+
+        x_mask = self._get_mask(buffers, 'x_mask', x_lengths, maxlen_x)
+        y_mask = self._get_mask(buffers, 'y_mask', y_lengths, maxlen_y)
+        return x, x_mask, y, y_mask
+
+    def from_lists(self, seqs_x, seqs_y):
+        """Builds a padded minibatch from a TextIterator minibatch."""
+        return self(*flatten_sequences(seqs_x, seqs_y, self.n_factors))
+
+    @staticmethod
+    def _token_coordinates(lengths):
+        # For each token of the flattened batch, its position in the sentence
+        # and the index of the sentence.
+        samples = numpy.repeat(numpy.arange(len(lengths)), lengths)
+        starts = numpy.cumsum(lengths) - lengths
+        positions = numpy.arange(len(samples)) - numpy.repeat(starts, lengths)
+        return positions, samples
+
+    def _get_mask(self, buffers, name, lengths, maxlen):
+        # Masks cover the sentence plus the final <EOS> position.
+        mask = self._get_buffer(buffers, name, (maxlen, len(lengths)),
+                                self.mask_dtype, zero=False)
+        mask[...] = (numpy.arange(maxlen)[:, numpy.newaxis]
+                     <= lengths[numpy.newaxis, :])
+        return mask
+
+    @staticmethod
+    def _get_buffer(buffers, name, shape, dtype, zero=True):
+        # Returns a contiguous array of the given shape that is backed by a
+        # reusable flat buffer.
+        size = int(numpy.prod(shape))
+        flat = buffers.get(name)
+        if flat is None or len(flat) < size:
+            flat = numpy.empty(max(size, int(size * 1.5)), dtype=dtype)
+            buffers[name] = flat
+        array = flat[:size].reshape(shape)
+        if zero:
+            array.fill(0)
+        return array
+
+
 def load_dict(filename, model_type):
-    try:
-        # build_dictionary.py writes JSON files as UTF-8 so assume that here.
-        with open(filename, 'r', encoding='utf-8') as f:
-            d = json.load(f)
-    except:
-        # FIXME Should we be assuming UTF-8?
-        with open(filename, 'r', encoding='utf-8') as f:
-            d = pkl.load(f)
-
-    # The transformer model requires vocab dictionaries to use the new style
-    # special symbols. If the dictionary looks like an old one then tell the
-    # user to update it.
-    if model_type == 'transformer' and ("<GO>" not in d or d["<GO>"] != 1):
-        logging.error('you must update \'{}\' for use with the '
-                      '\'transformer\' model type. Please re-run '
-                      'build_dictionary.py to generate a new vocabulary '
-                      'dictionary.'.format(filename))
-        sys.exit(1)
-
-    return d
+    """Returns a (modifiable) token-to-ID dictionary for a vocabulary file.
+
+    The file itself is only parsed once per process (see vocab.py).
+    """
+    return dict(vocab.load_vocabulary(filename, model_type).token_to_id)
 
 
 def seq2words(seq, inverse_dictionary, join=True):
@@ -121,48 +229,86 @@ def reverse_dict(dictt):
 
 def load_dictionaries(config):
     model_type = config.model_type
-    source_to_num = [load_dict(d, model_type) for d in config.source_dicts]
-    target_to_num = load_dict(config.target_dict, model_type)
-    num_to_source = [reverse_dict(d) for d in source_to_num]
-    num_to_target = reverse_dict(target_to_num)
+    source_vocabs = [vocab.load_vocabulary(d, model_type)
+                     for d in config.source_dicts]
+    target_vocab = vocab.load_vocabulary(config.target_dict, model_type)
+    source_to_num = [dict(v.token_to_id) for v in source_vocabs]
+    target_to_num = dict(target_vocab.token_to_id)
+    # The reverse dictionaries are shared and must not be modified.
+    num_to_source = [v.id_to_token for v in source_vocabs]
+    num_to_target = target_vocab.id_to_token
     return source_to_num, target_to_num, num_to_source, num_to_target
 
 
-def read_all_lines(config, sentences, batch_size):
-    source_to_num, _, _, _ = load_dictionaries(config)
+def load_source_vocabularies(config):
+    """Returns the (shared) source Vocabulary objects, one per factor, with
+    the vocabulary sizes of the config applied."""
+    sizes = config.source_vocab_sizes or [None] * len(config.source_dicts)
+    assert len(sizes) == len(config.source_dicts)
+    return [vocab.load_vocabulary(d, config.model_type, size)
+            for d, size in zip(config.source_dicts, sizes)]
 
-    if config.source_vocab_sizes != None:
-        assert len(config.source_vocab_sizes) == len(source_to_num)
-        for d, vocab_size in zip(source_to_num, config.source_vocab_sizes):
-            if vocab_size != None and vocab_size > 0:
-                for key, idx in list(d.items()):
-                    if idx >= vocab_size:
-                        del d[key]
 
-    lines = []
-    for sent in sentences:
-        line = []
-        for w in sent.strip().split():
-            if config.factors == 1:
-                w = [source_to_num[0][w] if w in source_to_num[0] else 2]
-            else:
-                w = [source_to_num[i][f] if f in source_to_num[i] else 2
-                                         for (i,f) in enumerate(w.split('|'))]
+def load_target_vocabulary(config):
+    """Returns the (shared) target Vocabulary object."""
+    return vocab.load_vocabulary(config.target_dict, config.model_type)
+
+
+def read_all_lines(config, sentences, batch_size, token_batch_size=0,
+                   beam_size=1):
+    """Maps sentences to IDs, sorts them by length and splits them into
+    batches.
+
+    If token_batch_size is non-zero, the batches are not cut at batch_size
+    sentences, but are made as large as possible without the estimated
+    decoding cost (sentences * padded source length * beam_size) exceeding
+    token_batch_size. A sentence that is too long for the budget on its own
+    is put in a batch by itself.
+
+    Returns the batches and the indices that sorted the sentences.
+    """
+    source_vocabs = load_source_vocabularies(config)
+
+    # Unknown words are mapped to ID 2 (<UNK> in current vocabularies).
+    if config.factors == 1:
+        ids, lengths = source_vocabs[0].encode(sentences, unk_id=2)
+        ids = ids.reshape([-1, 1]).tolist()
+        ends = numpy.cumsum(lengths)
+        lines = [ids[end-length:end] for end, length in zip(ends, lengths)]
+    else:
+        lines = []
+        for sent in sentences:
+            words = [w.split('|') for w in sent.split()]
+            for w in words:
                 if len(w) != config.factors:
                     raise exception.Error(
                         'Expected {0} factors, but input word has {1}\n'.format(
                             config.factors, len(w)))
-            line.append(w)
-        lines.append(line)
-    lines = numpy.array(lines)
+            factor_ids = [v.lookup([w[i] for w in words], unk_id=2)
+                          for i, v in enumerate(source_vocabs)]
+            lines.append(numpy.stack(factor_ids, axis=1).tolist()
+                         if words else [])
     lengths = numpy.array([len(l) for l in lines])
     idxs = lengths.argsort()
-    lines = lines[idxs]
+    lines = [lines[i] for i in idxs]
 
     #merge into batches
     batches = []
-    for i in range(0, len(lines), batch_size):
-        batch = lines[i:i+batch_size]
-        batches.append(batch)
+    if token_batch_size:
+        # Lines are sorted, so the last line of a batch is the longest. The
+        # padded length includes the <EOS> that prepare_data() appends.
+        batch = []
+        for line in lines:
+            cost = (len(batch)+1) * (len(line)+1) * beam_size
+            if batch and cost > token_batch_size:
+                batches.append(batch)
+                batch = []
+            batch.append(line)
+        if batch:
+            batches.append(batch)
+    else:
+        for i in range(0, len(lines), batch_size):
+            batch = lines[i:i+batch_size]
+            batches.append(batch)
 
     return batches, idxs
@@ -0,0 +1,220 @@
+"""Compiled vocabularies.
+
+A vocabulary file (JSON or pickle, as written by build_dictionary.py) is
+parsed at most once per process: load_vocabulary() keeps the resulting
+Vocabulary objects in a cache that is shared by all callers. The first time a
+vocabulary file is parsed, a compiled copy is saved next to it (in
+FILE.vocab.npz), from which later processes can load it more quickly. If the
+directory is not writable, the vocabulary is only kept in memory.
+"""
+
+import json
+import logging
+import os
+import pickle as pkl
+import sys
+import tempfile
+
+import numpy
+
+# ModuleNotFoundError is new in 3.6; older versions will throw SystemError
+if sys.version_info < (3, 6):
+    ModuleNotFoundError = SystemError
+
+try:
+    from . import exception
+except (ModuleNotFoundError, ImportError) as e:
+    import exception
+
+
+COMPILED_SUFFIX = '.vocab.npz'
+
+# Separator of the tokens in the compiled file.
+_SEPARATOR = '\0'
+
+
+class Vocabulary(object):
+    """Maps tokens to IDs and back.
+
+    token_to_id and id_to_token are plain dictionaries and must not be
+    modified (use load_vocabulary()'s size argument to restrict the
+    vocabulary size).
+    """
+
+    def __init__(self, tokens, ids):
+        """Initializes the vocabulary.
+
+        Args:
+            tokens: list of strings.
+            ids: list or array of the corresponding (unique) integer IDs.
+        """
+        ids = numpy.asarray(ids, dtype=numpy.int64)
+        self.tokens = list(tokens)
+        self.ids = ids
+        self.token_to_id = dict(zip(self.tokens, ids.tolist()))
+        self.id_to_token = dict(zip(ids.tolist(), self.tokens))
+        # For decode(): an array mapping IDs to tokens, with 'UNK' for IDs
+        # that are not in the vocabulary.
+        table_size = int(ids.max()) + 1 if len(ids) > 0 else 0
+        self._id_table = numpy.full(table_size, 'UNK', dtype=object)
+        self._id_table[ids] = self.tokens
+        # The UNK value depends on which version of build_dictionary.py was
+        # used.
+        self.unk_id = 2 if self.token_to_id.get('<UNK>') == 2 else 1
+
+    def __len__(self):
+        return len(self.tokens)
+
+    def truncated(self, size):
+        """Returns a copy without the entries with IDs >= size."""
+        keep = self.ids < size
+        tokens = [t for t, k in zip(self.tokens, keep) if k]
+        return Vocabulary(tokens, self.ids[keep])
+
+    def lookup(self, tokens, unk_id=None):
+        """Maps a sequence of tokens to an int64 array of IDs."""
+        unk_id = self.unk_id if unk_id is None else unk_id
+        get = self.token_to_id.get
+        return numpy.fromiter((get(t, unk_id) for t in tokens),
+                              dtype=numpy.int64, count=len(tokens))
+
+    def encode(self, lines, unk_id=None):
+        """Maps a list of sentences to a flat array of IDs.
+
+        Args:
+            lines: list of strings (which are split at whitespace) or of
+                lists of tokens.
+            unk_id: ID for unknown tokens (default: self.unk_id).
+
+        Returns:
+            A pair (ids, lengths) of int64 arrays; the IDs of sentence i are
+            ids[sum(lengths[:i]):sum(lengths[:i+1])].
+        """
+        lines = [l.split() if isinstance(l, str) else l for l in lines]
+        lengths = numpy.fromiter(map(len, lines), dtype=numpy.int64,
+                                 count=len(lines))
+        tokens = [t for l in lines for t in l]
+        return self.lookup(tokens, unk_id), lengths
+
+    def decode(self, ids, join=True):
+        """Maps a sequence of IDs to tokens, stopping at the first 0 (<EOS>).
+
+        IDs that are not in the vocabulary are mapped to 'UNK'. This is
+        equivalent to util.seq2words().
+        """
+        ids = numpy.asarray(ids, dtype=numpy.int64)
+        eos = numpy.flatnonzero(ids == 0)
+        if len(eos) > 0:
+            ids = ids[:eos[0]]
+        known = (ids >= 0) & (ids < len(self._id_table))
+        words = numpy.full(len(ids), 'UNK', dtype=object)
+        words[known] = self._id_table[ids[known]]
+        words = words.tolist()
+        if len(eos) > 0:
+            # Like seq2words(), represent <EOS> by an empty word.
+            words.append('')
+        return ' '.join(words) if join else words
+
+    def save(self, path):
+        """Saves the vocabulary in compiled form."""
+        if any(_SEPARATOR in t for t in self.tokens):
+            raise ValueError('token contains the separator character')
+        blob = _SEPARATOR.join(self.tokens).encode('utf-8')
+        numpy.savez(path, tokens=numpy.frombuffer(blob, dtype=numpy.uint8),
+                    ids=self.ids)
+
+    @classmethod
+    def load(cls, path):
+        """Loads a vocabulary saved by save()."""
+        with numpy.load(path) as data:
+            blob = data['tokens'].tobytes().decode('utf-8')
+            ids = data['ids']
+        tokens = blob.split(_SEPARATOR) if len(ids) > 0 else []
+        return cls(tokens, ids)
+
+
+def _read_dict(filename):
+    try:
+        # build_dictionary.py writes JSON files as UTF-8 so assume that here.
+        with open(filename, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except:
+        # FIXME Should we be assuming UTF-8?
+        with open(filename, 'r', encoding='utf-8') as f:
+            return pkl.load(f)
+
+
+def _compile(filename):
+    # Loads the compiled form of a vocabulary file, if it is up to date, and
+    # creates it otherwise.
+    compiled_path = filename + COMPILED_SUFFIX
+    try:
+        if os.path.getmtime(compiled_path) >= os.path.getmtime(filename):
+            return Vocabulary.load(compiled_path)
+    except (OSError, ValueError, KeyError):
+        pass
+    d = _read_dict(filename)
+    vocab = Vocabulary(list(d.keys()), list(d.values()))
+    # Write to a temporary file first, so that concurrent processes never
+    # see a partially written file.
+    dirname = os.path.dirname(os.path.abspath(compiled_path))
+    tmp_path = None
+    try:
+        with tempfile.NamedTemporaryFile(dir=dirname, suffix='.npz',
+                                         delete=False) as f:
+            tmp_path = f.name
+            vocab.save(f)
+        os.replace(tmp_path, compiled_path)
+    except (OSError, ValueError) as e:
+        logging.info('Could not save compiled vocabulary {0}: {1}'.format(
+            compiled_path, e))
+        if tmp_path is not None:
+            try:
+                os.remove(tmp_path)
+            except OSError:
+                pass
+    return vocab
+
+
+# Cache of loaded vocabularies, keyed by (path, modification time, size).
+_vocabularies = {}
+
+
+def load_vocabulary(filename, model_type, size=None):
+    """Returns the (shared) Vocabulary for a vocabulary file.
+
+    Args:
+        filename: path of a vocabulary file written by build_dictionary.py.
+        model_type: 'rnn' or 'transformer'.
+        size: if not None and > 0, drop entries with IDs >= size.
+
+    Returns:
+        A Vocabulary object.
+
+    Raises:
+        exception.Error: if a transformer model is given an old-style
+            vocabulary.
+    """
+    if size is not None and size <= 0:
+        size = None
+    path = os.path.realpath(filename)
+    mtime = os.path.getmtime(path)
+    key = (path, mtime, size)
+    if key not in _vocabularies:
+        if size is None:
+            _vocabularies[key] = _compile(path)
+        else:
+            full = load_vocabulary(filename, model_type)
+            _vocabularies[key] = full.truncated(size)
+    vocab = _vocabularies[key]
+
+    # The transformer model requires vocab dictionaries to use the new style
+    # special symbols. If the dictionary looks like an old one then tell the
+    # user to update it.
+    if model_type == 'transformer' and vocab.token_to_id.get("<GO>") != 1:
+        raise exception.Error('you must update \'{}\' for use with the '
+                              '\'transformer\' model type. Please re-run '
+                              'build_dictionary.py to generate a new '
+                              'vocabulary dictionary.'.format(filename))
+
+    return vocab
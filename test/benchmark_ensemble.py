@@ -0,0 +1,98 @@
+#!/usr/bin/env python3
+
+"""Measures Transformer beam search latency for ensembles of increasing
+size, with the models' decoding steps run one after another and with
+structurally identical models stacked into one decoding step (translate.py
+--stack_ensemble; see transformer_inference.EnsembleModelAdapter).
+
+The models are randomly initialised, so translations rarely contain <EOS> and
+decoding usually runs to the maximum translation length."""
+
+import argparse
+import sys
+import os
+import time
+
+import numpy
+import tensorflow as tf
+
+sys.path.append(os.path.abspath('../nematus'))
+from beam_search_sampler import BeamSearchSampler
+from config import ConfigSpecification
+from transformer import Transformer
+import translate_utils
+
+
+def default_config(args):
+    spec = ConfigSpecification()
+    config = argparse.Namespace()
+    for group_name in spec.group_names:
+        for param in spec.params_by_group(group_name):
+            setattr(config, param.name, param.default)
+    config.model_type = 'transformer'
+    config.embedding_size = config.state_size = args.state_size
+    config.dim_per_factor = [args.state_size]
+    config.target_embedding_size = args.state_size
+    config.source_vocab_sizes = [args.vocab_size]
+    config.target_vocab_size = args.vocab_size
+    config.transformer_ffn_hidden_size = 4 * args.state_size
+    config.translation_maxlen = args.max_len
+    return config
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--ensemble_sizes', type=int, nargs='+',
+                        default=[1, 2, 4])
+    parser.add_argument('--batch_size', type=int, default=10)
+    parser.add_argument('--beam_size', type=int, default=5)
+    parser.add_argument('--source_len', type=int, default=30)
+    parser.add_argument('--max_len', type=int, default=50)
+    parser.add_argument('--state_size', type=int, default=256)
+    parser.add_argument('--vocab_size', type=int, default=8000)
+    parser.add_argument('--num_batches', type=int, default=5)
+    args = parser.parse_args()
+
+    tf.compat.v1.disable_eager_execution()
+    config = default_config(args)
+    models = []
+    for i in range(max(args.ensemble_sizes)):
+        with tf.compat.v1.variable_scope('model{}'.format(i)):
+            models.append(Transformer(config))
+    samplers = []
+    for size in args.ensemble_sizes:
+        for name, stack_models in [('separate steps', False),
+                                   ('stacked steps', True)]:
+            sampler = BeamSearchSampler(models[:size], [config] * size,
+                                        args.beam_size,
+                                        stack_models=stack_models)
+            samplers.append((size, name, sampler))
+
+    rng = numpy.random.RandomState(1234)
+    x = rng.randint(1, args.vocab_size,
+                    size=(1, args.source_len, args.batch_size))
+    x_mask = numpy.ones((args.source_len, args.batch_size), dtype=numpy.float32)
+
+    with tf.compat.v1.Session() as session:
+        session.run(tf.compat.v1.global_variables_initializer())
+        translations = {}
+        for size, name, sampler in samplers:
+            # Warm up.
+            translate_utils.translate_batch(session, sampler, x, x_mask,
+                                            args.max_len, 0.0)
+            start = time.time()
+            for _ in range(args.num_batches):
+                beams = translate_utils.translate_batch(
+                    session, sampler, x, x_mask, args.max_len, 0.0)
+            elapsed = time.time() - start
+            print('models {0:2d}  {1:15} {2:8.3f} sec/batch'.format(
+                size, name, elapsed / args.num_batches))
+            translations.setdefault(size, []).append(
+                [beam[0][0].tolist() for beam in beams])
+        for size, (separate, stacked) in sorted(translations.items()):
+            if separate != stacked:
+                print('models {0:2d}  translations differ'.format(size))
+
+
+if __name__ == '__main__':
+    main()
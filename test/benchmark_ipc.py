@@ -0,0 +1,117 @@
+#!/usr/bin/env python3
+
+"""Measures the per-batch IPC overhead between the server and a worker
+process, with pickled batches and beams (multiprocessing.Queue) and with the
+shared-memory transport (shm_transport.py).
+
+The worker does no translation: it returns random beams of beam_size
+hypotheses per sentence, so the measured time is the round trip of one
+batch."""
+
+import argparse
+import multiprocessing
+import os
+import sys
+import time
+
+import numpy
+
+sys.path.append(os.path.abspath('../nematus'))
+from shm_transport import BlockCache, BlockPool, SharedBatch
+
+
+def make_beams(num_sents, beam_size, hyp_len, rng):
+    beams = []
+    for _ in range(num_sents):
+        beam = []
+        for _ in range(beam_size):
+            ids = rng.randint(1, 30000, size=hyp_len).astype(numpy.int32)
+            ids[-1] = 0
+            beam.append((ids, float(rng.randn())))
+        beams.append(beam)
+    return beams
+
+
+def pickle_worker(input_queue, output_queue, beams):
+    while True:
+        item = input_queue.get()
+        if item is None:
+            return
+        idx, batch = item
+        output_queue.put((idx, beams[:len(batch)]))
+
+
+def shm_worker(input_queue, output_queue, beams):
+    cache = BlockCache()
+    while True:
+        item = input_queue.get()
+        if item is None:
+            return
+        idx, descriptor = item
+        shared_batch = SharedBatch.attach(cache, descriptor)
+        x_ids, x_lengths = shared_batch.sentences()
+        num_sents = len(x_lengths)
+        del x_ids, x_lengths
+        shared_batch.write_beams(beams[:num_sents])
+        shared_batch.close()
+        output_queue.put((idx, None))
+
+
+def run(transport, batch, beams, args):
+    input_queue = multiprocessing.Queue()
+    output_queue = multiprocessing.Queue()
+    target = pickle_worker if transport == 'pickle' else shm_worker
+    process = multiprocessing.Process(target=target,
+                                      args=(input_queue, output_queue, beams))
+    process.start()
+    pool = BlockPool()
+    times = []
+    for i in range(args.num_batches + 1):
+        start = time.time()
+        if transport == 'pickle':
+            input_queue.put((i, batch))
+            _, received = output_queue.get()
+        else:
+            shared_batch = SharedBatch.create(pool, batch, 1, args.beam_size,
+                                              args.max_translation_len)
+            input_queue.put((i, shared_batch.descriptor))
+            output_queue.get()
+            received = shared_batch.read_beams()
+            shared_batch.release()
+        assert len(received) == len(batch)
+        if i > 0: # skip warm-up
+            times.append(time.time() - start)
+    input_queue.put(None)
+    process.join()
+    pool.close()
+    return numpy.mean(times) * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--batch_sizes', type=int, nargs='+',
+                        default=[1, 10, 80])
+    parser.add_argument('--beam_size', type=int, default=12)
+    parser.add_argument('--source_len', type=int, default=30)
+    parser.add_argument('--hyp_len', type=int, default=35)
+    parser.add_argument('--max_translation_len', type=int, default=200)
+    parser.add_argument('--num_batches', type=int, default=200)
+    args = parser.parse_args()
+
+    rng = numpy.random.RandomState(1234)
+    beams = make_beams(max(args.batch_sizes), args.beam_size, args.hyp_len,
+                       rng)
+    for batch_size in args.batch_sizes:
+        # Sentences in util.read_all_lines() format (one factor).
+        batch = [[[int(i)] for i in rng.randint(1, 30000,
+                                                 size=args.source_len)]
+                 for _ in range(batch_size)]
+        for transport in ['pickle', 'shared_memory']:
+            ms = run(transport, batch, beams, args)
+            print('batch size {0:3d}  beam size {1:3d}  {2:15} '
+                  '{3:8.3f} ms/batch'.format(batch_size, args.beam_size,
+                                             transport, ms))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,103 @@
+#!/usr/bin/env python3
+
+"""Compares Transformer beam search throughput with growing (tf.concat)
+self-attention memories and with memories preallocated to the maximum
+translation length (translate.py --preallocate_kv_cache), at several output
+lengths.
+
+The model is randomly initialised, so translations rarely contain <EOS> and
+decoding usually runs to the maximum translation length."""
+
+import argparse
+import copy
+import sys
+import os
+import time
+
+import numpy
+import tensorflow as tf
+
+sys.path.append(os.path.abspath('../nematus'))
+from beam_search_sampler import BeamSearchSampler
+from config import ConfigSpecification
+from transformer import Transformer
+import translate_utils
+
+
+def default_config(args):
+    spec = ConfigSpecification()
+    config = argparse.Namespace()
+    for group_name in spec.group_names:
+        for param in spec.params_by_group(group_name):
+            setattr(config, param.name, param.default)
+    config.model_type = 'transformer'
+    config.embedding_size = config.state_size = args.state_size
+    config.dim_per_factor = [args.state_size]
+    config.target_embedding_size = args.state_size
+    config.source_vocab_sizes = [args.vocab_size]
+    config.target_vocab_size = args.vocab_size
+    config.transformer_ffn_hidden_size = 4 * args.state_size
+    config.translation_maxlen = max(args.output_lengths)
+    return config
+
+
+def build_sampler(model, config, preallocate_kv_cache, beam_size):
+    config = copy.copy(config)
+    config.preallocate_kv_cache = preallocate_kv_cache
+    return BeamSearchSampler([model], [config], beam_size)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--batch_size', type=int, default=10)
+    parser.add_argument('--beam_size', type=int, default=5)
+    parser.add_argument('--source_len', type=int, default=30)
+    parser.add_argument('--output_lengths', type=int, nargs='+',
+                        default=[25, 50, 100, 200])
+    parser.add_argument('--state_size', type=int, default=256)
+    parser.add_argument('--vocab_size', type=int, default=8000)
+    parser.add_argument('--num_batches', type=int, default=5)
+    args = parser.parse_args()
+
+    tf.compat.v1.disable_eager_execution()
+    config = default_config(args)
+    with tf.compat.v1.variable_scope('model0'):
+        model = Transformer(config)
+    samplers = [
+        ('tf.concat memories',
+         build_sampler(model, config, False, args.beam_size)),
+        ('preallocated memories',
+         build_sampler(model, config, True, args.beam_size)),
+    ]
+
+    rng = numpy.random.RandomState(1234)
+    x = rng.randint(1, args.vocab_size,
+                    size=(1, args.source_len, args.batch_size))
+    x_mask = numpy.ones((args.source_len, args.batch_size), dtype=numpy.float32)
+
+    with tf.compat.v1.Session() as session:
+        session.run(tf.compat.v1.global_variables_initializer())
+        for max_len in args.output_lengths:
+            translations = []
+            for name, sampler in samplers:
+                # Warm up.
+                translate_utils.translate_batch(session, sampler, x, x_mask,
+                                                max_len, 0.0)
+                start = time.time()
+                for _ in range(args.num_batches):
+                    beams = translate_utils.translate_batch(
+                        session, sampler, x, x_mask, max_len, 0.0)
+                elapsed = time.time() - start
+                mean_len = numpy.mean([len(beam[0][0]) for beam in beams])
+                print('max_len {0:4d}  {1:25} {2:8.2f} sents/sec '
+                      '(mean output length {3:.1f})'.format(
+                          max_len, name,
+                          args.num_batches * args.batch_size / elapsed,
+                          mean_len))
+                translations.append([beam[0][0].tolist() for beam in beams])
+            if translations[0] != translations[1]:
+                print('max_len {0:4d}  translations differ'.format(max_len))
+
+
+if __name__ == '__main__':
+    main()
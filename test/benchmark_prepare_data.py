@@ -0,0 +1,66 @@
+#!/usr/bin/env python3
+
+"""Compares the speed of util.prepare_data and util.BatchBuilder on random
+minibatches."""
+
+import argparse
+import sys
+import os
+import timeit
+
+import numpy
+
+sys.path.append(os.path.abspath('../nematus'))
+from util import prepare_data, flatten_sequences, BatchBuilder
+
+
+def random_batch(rng, batch_size, maxlen, factors, vocab_size):
+    seqs_x = [rng.randint(vocab_size, size=(rng.randint(1, maxlen), factors))
+              .tolist() for _ in range(batch_size)]
+    seqs_y = [rng.randint(vocab_size, size=rng.randint(1, maxlen)).tolist()
+              for _ in range(batch_size)]
+    return seqs_x, seqs_y
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--batch_size', type=int, default=80)
+    parser.add_argument('--maxlen', type=int, default=100)
+    parser.add_argument('--factors', type=int, default=1)
+    parser.add_argument('--num_batches', type=int, default=50)
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    rng = numpy.random.RandomState(1234)
+    batches = [random_batch(rng, args.batch_size, args.maxlen, args.factors,
+                            30000) for _ in range(args.num_batches)]
+    flat_batches = [flatten_sequences(x, y, args.factors)
+                    for x, y in batches]
+
+    builder = BatchBuilder(args.factors)
+    bool_builder = BatchBuilder(args.factors, mask_dtype=numpy.bool_)
+    for seqs_x, seqs_y in batches[:5]:
+        expected = prepare_data(seqs_x, seqs_y, args.factors)
+        for actual in (builder.from_lists(seqs_x, seqs_y),
+                       bool_builder.from_lists(seqs_x, seqs_y)):
+            for a, b in zip(expected, actual):
+                assert numpy.array_equal(a, b)
+
+    candidates = [
+        ('prepare_data',
+         lambda: [prepare_data(x, y, args.factors) for x, y in batches]),
+        ('BatchBuilder.from_lists (int32, float32 mask)',
+         lambda: [builder.from_lists(x, y) for x, y in batches]),
+        ('BatchBuilder, flat input (int32, float32 mask)',
+         lambda: [builder(*b) for b in flat_batches]),
+        ('BatchBuilder, flat input (int32, bool mask)',
+         lambda: [bool_builder(*b) for b in flat_batches]),
+    ]
+    for name, fn in candidates:
+        best = min(timeit.repeat(fn, number=1, repeat=args.repeat))
+        print('{0:50} {1:8.3f} ms/batch'.format(
+            name, 1000 * best / args.num_batches))
+
+
+if __name__ == '__main__':
+    main()
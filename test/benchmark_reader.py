@@ -0,0 +1,91 @@
+#!/usr/bin/env python3
+
+"""Compares the read throughput of the built-in text mode readers (gzip.open,
+lzma.open) with StreamingReader on a synthetic compressed corpus."""
+
+import argparse
+import gzip
+import lzma
+import sys
+import os
+import random
+import tempfile
+import time
+
+sys.path.append(os.path.abspath('../nematus'))
+from streaming_reader import StreamingReader, zstandard
+
+
+def write_corpus(path, num_lines):
+    rng = random.Random(1234)
+    with open(path, 'w', encoding='UTF-8') as f:
+        for _ in range(num_lines):
+            length = rng.randint(1, 50)
+            f.write(' '.join('w{}'.format(rng.randint(0, 30000))
+                             for _ in range(length)) + '\n')
+
+
+def compress(path, suffix):
+    with open(path, 'rb') as f:
+        data = f.read()
+    if suffix == '.gz':
+        data = gzip.compress(data)
+    elif suffix == '.xz':
+        data = lzma.compress(data)
+    else:
+        data = zstandard.ZstdCompressor().compress(data)
+    with open(path + suffix, 'wb') as f:
+        f.write(data)
+    return path + suffix
+
+
+def time_reader(open_fn, size, tokenize):
+    # Iterates over the lines and optionally splits them into tokens (like
+    # TextIterator does).
+    start = time.time()
+    num_lines = 0
+    with open_fn() as f:
+        for line in f:
+            if tokenize:
+                line.split()
+            num_lines += 1
+    duration = time.time() - start
+    return num_lines, size / 1024**2 / duration
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--num_lines', type=int, default=500000)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        path = os.path.join(tmp_dir, 'corpus')
+        write_corpus(path, args.num_lines)
+        size = os.path.getsize(path)
+        print('corpus: {0} lines, {1:.1f} MB'.format(args.num_lines,
+                                                    size / 1024**2))
+        suffixes = ['.gz', '.xz'] + (['.zst'] if zstandard else [])
+        for suffix in suffixes:
+            compressed = compress(path, suffix)
+            readers = [('StreamingReader',
+                        lambda: StreamingReader(compressed))]
+            if suffix == '.gz':
+                readers.insert(0, ('gzip.open',
+                    lambda: gzip.open(compressed, 'rt', encoding='UTF-8')))
+            elif suffix == '.xz':
+                readers.insert(0, ('lzma.open',
+                    lambda: lzma.open(compressed, 'rt', encoding='UTF-8')))
+            for name, open_fn in readers:
+                for tokenize in (False, True):
+                    num_lines, throughput = time_reader(open_fn, size,
+                                                        tokenize)
+                    assert num_lines == args.num_lines
+                    print('{0:4} {1:16} {2:15} {3:8.1f} MB/s '
+                          '(uncompressed)'.format(
+                              suffix, name,
+                              'read+split' if tokenize else 'read',
+                              throughput))
+
+
+if __name__ == '__main__':
+    main()
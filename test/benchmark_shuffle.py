@@ -0,0 +1,60 @@
+#!/usr/bin/env python3
+
+"""Measures time and peak (Python heap) memory of
+shuffle.jointly_shuffle_files on synthetic parallel corpora of increasing
+size. With a fixed bucket size, the time should grow linearly with the
+number of lines and the peak memory should stay roughly constant."""
+
+import argparse
+import sys
+import os
+import random
+import tempfile
+import time
+import tracemalloc
+
+sys.path.append(os.path.abspath('../nematus'))
+import shuffle
+
+
+def write_corpus(path, num_lines, rng):
+    with open(path, 'w', encoding='UTF-8') as f:
+        for i in range(num_lines):
+            length = rng.randint(1, 50)
+            f.write(' '.join('w{}'.format(rng.randint(0, 30000))
+                             for _ in range(length)) + '\n')
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--sizes', type=int, nargs='+',
+                        default=[100000, 200000, 400000, 800000])
+    parser.add_argument('--chunk_size', type=int, default=50000,
+                        help='expected number of lines per bucket')
+    args = parser.parse_args()
+
+    shuffle.CHUNK_SIZE = args.chunk_size
+    rng = random.Random(1234)
+    print('{0:>10} {1:>10} {2:>12} {3:>16}'.format(
+        'lines', 'seconds', 'usec/line', 'peak memory MB'))
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for num_lines in args.sizes:
+            paths = [os.path.join(tmp_dir, 'corpus.{}'.format(side))
+                     for side in ('src', 'trg')]
+            for path in paths:
+                write_corpus(path, num_lines, rng)
+            tracemalloc.start()
+            start = time.time()
+            out_files = shuffle.jointly_shuffle_files(paths, temporary=True)
+            duration = time.time() - start
+            _, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            for f in out_files:
+                f.close()
+            print('{0:>10} {1:>10.2f} {2:>12.2f} {3:>16.1f}'.format(
+                num_lines, duration, 1e6 * duration / num_lines,
+                peak / 1024**2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,60 @@
+#!/usr/bin/env python3
+
+"""Compares CPU translation throughput of a single translate.py process with
+that of several worker processes (--workers) on the same number of cores.
+
+Uses the English-German WMT16 model of test_translate.py; the input is
+en-de/in, repeated --repeat times."""
+
+import argparse
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+from test_utils import load_wmt16_model
+
+
+def run(input_path, workers, threads_per_worker, beam_size):
+    args = [sys.executable, '../../../nematus/translate.py',
+            '-m', 'model.npz',
+            '-i', input_path,
+            '-o', os.devnull,
+            '-k', str(beam_size),
+            '--workers', str(workers),
+            '--threads_per_worker', str(threads_per_worker)]
+    env = dict(os.environ, CUDA_VISIBLE_DEVICES='')
+    start = time.time()
+    subprocess.run(args, cwd='models/en-de', env=env, check=True,
+                   stderr=subprocess.DEVNULL)
+    return time.time() - start
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--cores', type=int, default=os.cpu_count())
+    parser.add_argument('--workers', type=int, nargs='+', default=[2, 4])
+    parser.add_argument('--beam_size', type=int, default=5)
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    load_wmt16_model('en', 'de')
+    with open('en-de/in', 'r', encoding='utf-8') as f:
+        lines = f.readlines()
+    with tempfile.NamedTemporaryFile('w', encoding='utf-8',
+                                     suffix='.txt') as input_file:
+        input_file.write(''.join(lines * args.repeat))
+        input_file.flush()
+        num_sents = len(lines) * args.repeat
+        # The times include model loading, which is done once per worker.
+        for workers in [1] + args.workers:
+            threads = max(1, args.cores // workers)
+            elapsed = run(os.path.abspath(input_file.name), workers, threads,
+                          args.beam_size)
+            print('{0:2d} worker(s) x {1:3d} thread(s) {2:8.2f} sents/sec'
+                  .format(workers, threads, num_sents / elapsed))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,166 @@
+#!/usr/bin/env python3
+
+"""Measures the latency of Nematus Server under concurrent load.
+
+Starts server.py (with handler threads, or with --asyncio) and sends
+requests of one or two sentences from --clients concurrent clients, then
+reports the p50 and p99 latency and the throughput. With --bulk_clients,
+further clients keep sending documents of long sentences meanwhile (only
+the short requests are measured); options such as -p or --class_workers
+can be passed to the server with --server_args.
+
+Unless --model is given, the server runs a stand-in model: a tiny
+Transformer trained for a few updates on the toy corpus in data/. Its
+translations are meaningless, but it exercises the full decoding path."""
+
+import argparse
+import concurrent.futures
+import json
+import os
+import signal
+import subprocess
+import sys
+import threading
+import time
+import urllib.request
+
+import numpy
+
+STAND_IN_UPDATES = 10
+
+
+def build_stand_in_model(path):
+    """Trains the stand-in model unless it exists; returns its path."""
+    model = '{0}-{1}'.format(path, STAND_IN_UPDATES)
+    if os.path.exists(model + '.json'):
+        return model
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    subprocess.run([sys.executable, '../nematus/train.py',
+                    '--model', path,
+                    '--datasets', 'data/corpus.en', 'data/corpus.de',
+                    '--dictionaries', 'data/vocab.json', 'data/vocab.json',
+                    '--n_words_src', '10000',
+                    '--n_words', '10000',
+                    '--model_type', 'transformer',
+                    '--embedding_size', '64',
+                    '--state_size', '64',
+                    '--tie_encoder_decoder_embeddings',
+                    '--tie_decoder_embeddings',
+                    '--transformer_enc_depth', '1',
+                    '--transformer_dec_depth', '1',
+                    '--transformer_ffn_hidden_size', '128',
+                    '--maxlen', '50',
+                    '--batch_size', '10',
+                    '--translation_maxlen', '50',
+                    '--finish_after', str(STAND_IN_UPDATES)],
+                   check=True)
+    return model
+
+
+def wait_for_server(url, timeout=600):
+    start = time.time()
+    while time.time() - start < timeout:
+        try:
+            with urllib.request.urlopen(url + '/status') as f:
+                if json.loads(f.read().decode('utf-8'))['status'] == 'ok':
+                    return
+        except OSError:
+            pass
+        time.sleep(1)
+    raise RuntimeError('server did not start')
+
+
+def send_request(url, segments, beam_size):
+    body = json.dumps({'segments': segments, 'beam_width': beam_size})
+    request = urllib.request.Request(
+        url + '/translate', data=body.encode('utf-8'),
+        headers={'Content-Type': 'application/json'})
+    start = time.time()
+    with urllib.request.urlopen(request) as f:
+        f.read()
+    return time.time() - start
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--model', default=None,
+                        help='model to serve (default: stand-in model)')
+    parser.add_argument('--asyncio', action='store_true',
+                        help='run the server with --asyncio')
+    parser.add_argument('--threads', type=int, default=4,
+                        help='server handler threads')
+    parser.add_argument('--clients', type=int, default=32)
+    parser.add_argument('--requests', type=int, default=500)
+    parser.add_argument('--beam_size', type=int, default=5)
+    parser.add_argument('--port', type=int, default=8089)
+    parser.add_argument('--bulk_clients', type=int, default=0,
+                        help='clients sending long documents meanwhile')
+    parser.add_argument('--bulk_size', type=int, default=50,
+                        help='sentences per long document')
+    parser.add_argument('--server_args', default='',
+                        help='further server options, e.g. '
+                             '"-p 2 --class_workers 0 0,1 1"')
+    args = parser.parse_args()
+
+    model = args.model
+    if model is None:
+        model = os.path.abspath(build_stand_in_model('models/standin/model.npz'))
+
+    with open('data/corpus.en', 'r', encoding='utf-8') as f:
+        sentences = [line.split() for _, line in zip(range(1000), f)]
+    rng = numpy.random.RandomState(1234)
+    workload = []
+    for _ in range(args.requests):
+        n = rng.randint(1, 3)
+        workload.append([sentences[i] for i in
+                         rng.randint(len(sentences), size=n)])
+    longest = sorted(sentences, key=len)[-args.bulk_size:]
+
+    command = [sys.executable, 'server.py', '-m', model,
+               '--host', '127.0.0.1', '--port', str(args.port),
+               '--threads', str(args.threads)]
+    if args.asyncio:
+        command.append('--asyncio')
+    command += args.server_args.split()
+    server = subprocess.Popen(command, cwd='../nematus',
+                              stderr=subprocess.DEVNULL)
+    url = 'http://127.0.0.1:{0}'.format(args.port)
+    try:
+        wait_for_server(url)
+        done = threading.Event()
+        def send_bulk():
+            while not done.is_set():
+                send_request(url, longest, args.beam_size)
+        bulk_clients = [threading.Thread(target=send_bulk)
+                        for _ in range(args.bulk_clients)]
+        for client in bulk_clients:
+            client.start()
+        start = time.time()
+        with concurrent.futures.ThreadPoolExecutor(args.clients) as pool:
+            latencies = list(pool.map(
+                lambda segments: send_request(url, segments, args.beam_size),
+                workload))
+        elapsed = time.time() - start
+        done.set()
+        for client in bulk_clients:
+            client.join()
+    finally:
+        # The server shuts its worker processes down on SIGINT.
+        server.send_signal(signal.SIGINT)
+        server.wait()
+
+    latencies = numpy.array(latencies) * 1000
+    print('{0} requests from {1} clients ({2}{3}): p50 {4:.1f} ms, '
+          'p99 {5:.1f} ms, {6:.1f} requests/sec'.format(
+              args.requests, args.clients,
+              'asyncio' if args.asyncio else
+              '{0} threads'.format(args.threads),
+              ', {0} bulk clients'.format(args.bulk_clients)
+              if args.bulk_clients else '',
+              numpy.percentile(latencies, 50),
+              numpy.percentile(latencies, 99),
+              args.requests / elapsed))
+
+
+if __name__ == '__main__':
+    main()
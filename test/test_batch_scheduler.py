@@ -0,0 +1,139 @@
+#!/usr/bin/env python3
+
+import sys
+import os
+import queue
+import threading
+import time
+import unittest
+
+sys.path.append(os.path.abspath('../nematus'))
+from batch_scheduler import BatchScheduler, assign_workers
+import exception
+
+
+class FakeQueue(queue.Queue):
+
+    def cancel_join_thread(self):
+        pass
+
+
+class FakeProcess(object):
+
+    def __init__(self, pid):
+        self.pid = pid
+        self.exitcode = None
+
+    def is_alive(self):
+        return self.exitcode is None
+
+
+class TestBatchScheduler(unittest.TestCase):
+    """
+    Checks routing by length class, worker affinity and priority, with
+    worker threads that return each source sentence as its translation
+    """
+
+    def setUp(self):
+        self.received = [] # (worker, source lengths)
+        self.output_queue = queue.Queue()
+        self.release = threading.Event()
+        self.release.set()
+
+    def start(self, num_workers, class_workers=None):
+        input_queues = [FakeQueue() for _ in range(num_workers)]
+        for worker, input_queue in enumerate(input_queues):
+            threading.Thread(target=self.work,
+                             args=(worker, input_queue),
+                             daemon=True).start()
+        self.processes = [FakeProcess(pid) for pid in range(num_workers)]
+        return BatchScheduler(input_queues, self.output_queue,
+                              self.processes, batch_size=80,
+                              token_batch_size=0, max_wait=0,
+                              length_limits=[2, 4],
+                              class_workers=class_workers, timeout=0.01)
+
+    def work(self, worker, input_queue):
+        while True:
+            item = input_queue.get()
+            self.received.append((worker, [len(x) for x in item.batch]))
+            self.release.wait()
+            beams = [[(x, 0.0)] for x in item.batch]
+            self.output_queue.put((item.idx, beams))
+
+    def test_length_classes(self):
+        scheduler = self.start(1)
+        sentences = [[1], [1, 2, 3], [1, 2, 3, 4, 5, 6], [1, 2]]
+        beams = scheduler.submit(sentences, 5, 1.0).wait()
+        self.assertEqual([beam[0][0] for beam in beams], sentences)
+        stats = scheduler.stats()
+        self.assertEqual(stats['short']['sentences'], 2)
+        self.assertEqual(stats['medium']['sentences'], 1)
+        self.assertEqual(stats['long']['sentences'], 1)
+        self.assertEqual(stats['long']['queued_sentences'], 0)
+        # each batch contains sentences of a single class
+        classes = lambda lengths: set((n > 2) + (n > 4) for n in lengths)
+        for _, lengths in self.received:
+            self.assertEqual(len(classes(lengths)), 1)
+
+    def test_affinity(self):
+        scheduler = self.start(2, class_workers=[[0], [0], [1]])
+        sentences = [[1] * n for n in range(1, 8)] * 3
+        scheduler.submit(sentences, 5, 1.0).wait()
+        for worker, lengths in self.received:
+            self.assertEqual(worker, int(max(lengths) > 4))
+
+    def test_short_first(self):
+        scheduler = self.start(1)
+        self.release.clear()
+        first = scheduler.submit([[1] * 6], 5, 1.0)
+        while not self.received:
+            time.sleep(0.001)
+        # the worker is busy, but there is room for a second batch
+        second = scheduler.submit([[1] * 6], 5, 1.0)
+        time.sleep(0.01)
+        self.assertEqual(scheduler.stats()['long']['in_flight_batches'], 2)
+        # now both requests wait in the scheduler
+        long = scheduler.submit([[1] * 6], 5, 1.0)
+        short = scheduler.submit([[1]], 5, 1.0)
+        time.sleep(0.01)
+        stats = scheduler.stats()
+        self.assertEqual(stats['long']['in_flight_batches'], 2)
+        self.assertEqual(stats['long']['queued_sentences'], 1)
+        self.assertEqual(stats['short']['queued_sentences'], 1)
+        self.release.set()
+        for request in [first, second, long, short]:
+            request.wait()
+        self.assertEqual([lengths for _, lengths in self.received],
+                         [[6], [6], [1], [6]])
+
+    def test_dead_worker(self):
+        scheduler = self.start(2, class_workers=[[0], [0, 1], [1]])
+        self.release.clear()
+        first = scheduler.submit([[1] * 6], 5, 1.0)
+        while not self.received:
+            time.sleep(0.001)
+        self.processes[1].exitcode = 1
+        with self.assertRaises(exception.Error):
+            first.wait()
+        # no worker is left for long sentences; medium ones go to worker 0
+        with self.assertRaises(exception.Error):
+            scheduler.submit([[1] * 6], 5, 1.0).wait()
+        self.release.set()
+        sentences = [[1], [1, 2, 3]]
+        beams = scheduler.submit(sentences, 5, 1.0).wait()
+        self.assertEqual([beam[0][0] for beam in beams], sentences)
+        self.assertEqual([worker for worker, _ in self.received[1:]], [0, 0])
+
+    def test_assign_workers(self):
+        self.assertEqual(assign_workers(None, 2), [[0, 1], [0, 1], [0, 1]])
+        self.assertEqual(assign_workers([[1, 0], [0], [1]], 2),
+                         [[0, 1], [0], [1]])
+        with self.assertRaises(exception.Error):
+            assign_workers([[0], [1], [2]], 2)
+        with self.assertRaises(exception.Error):
+            assign_workers([[0], [], [1]], 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,169 @@
+#!/usr/bin/env python3
+
+import sys
+import os
+import gzip
+import shutil
+import tempfile
+import unittest
+
+import numpy
+
+sys.path.append(os.path.abspath('../nematus'))
+from binarize import binarize_corpus
+from data_iterator import TextIterator
+import exception
+from streaming_reader import StreamingReader
+
+
+class TestTextIterator(unittest.TestCase):
+    """
+    Checks that the different corpus readers produce identical minibatches
+    """
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.source = os.path.join(self.tmp_dir, 'corpus.en')
+        self.target = os.path.join(self.tmp_dir, 'corpus.de')
+        shutil.copyfile('data/corpus.en', self.source)
+        shutil.copyfile('data/corpus.de', self.target)
+        self.kwargs = dict(source_dicts=['data/vocab.json'],
+                           target_dict='data/vocab.json',
+                           model_type='rnn',
+                           batch_size=40,
+                           maxlen=50,
+                           source_vocab_sizes=[2000],
+                           target_vocab_size=2000,
+                           skip_empty=True,
+                           maxibatch_size=5)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_binarized(self):
+        binarize_corpus(self.source, self.target, ['data/vocab.json'],
+                        'data/vocab.json', 'rnn')
+        text = TextIterator(self.source, self.target, **self.kwargs)
+        binarized = TextIterator(self.source, self.target, binarized=True,
+                                 **self.kwargs)
+        # two epochs, to check that reset() works
+        for _ in range(2):
+            self.assertEqual(list(text), list(binarized))
+
+    def test_indexed(self):
+        text = TextIterator(self.source, self.target, **self.kwargs)
+        for _ in range(2):
+            # The first iteration builds the line index, the second one
+            # loads it from disk.
+            indexed = TextIterator(self.source, self.target, indexed=True,
+                                   **self.kwargs)
+            self.assertEqual(list(text), list(indexed))
+        self.assertTrue(os.path.exists(self.source + '.lineidx.npy'))
+
+        # Shuffling must apply the same permutation to source and target.
+        pairs = set()
+        for _ in range(2):
+            indexed = TextIterator(self.source, self.target, indexed=True,
+                                   shuffle_each_epoch=True,
+                                   source_dicts=['data/vocab.json'],
+                                   target_dict='data/vocab.json',
+                                   model_type='rnn', batch_size=1,
+                                   sort_by_length=False)
+            epoch = set((tuple(map(tuple, x[0])), tuple(y[0]))
+                        for x, y in indexed)
+            if pairs:
+                self.assertEqual(pairs, epoch)
+            pairs = epoch
+        self.assertEqual(len(pairs), len(set(zip(open(self.source),
+                                                 open(self.target)))))
+
+    def test_length_bucketing(self):
+        binarize_corpus(self.source, self.target, ['data/vocab.json'],
+                        'data/vocab.json', 'rnn')
+        kwargs = dict(self.kwargs, token_batch_size=500,
+                      shuffle_each_epoch=True)
+        text = TextIterator(self.source, self.target, **kwargs)
+        expected = sorted(pair for x, y in text
+                          for pair in zip(map(str, x), map(str, y)))
+        for corpus_args in (dict(binarized=True), dict(indexed=True),
+                            dict(keep_data_in_memory=True)):
+            bucketed = TextIterator(self.source, self.target,
+                                    length_bucketing=True, **corpus_args,
+                                    **kwargs)
+            for _ in range(2):
+                pairs = []
+                for x, y in bucketed:
+                    longest = max(max(map(len, x)), max(map(len, y)))
+                    self.assertLessEqual(len(x) * longest, 500)
+                    pairs += zip(map(str, x), map(str, y))
+                self.assertEqual(sorted(pairs), expected)
+
+    def test_parallel(self):
+        text = TextIterator(self.source, self.target, **self.kwargs)
+        parallel = TextIterator(self.source, self.target, num_workers=2,
+                                **self.kwargs)
+        for _ in range(2):
+            self.assertEqual(list(text), list(parallel))
+        parallel.close()
+
+        kwargs = dict(self.kwargs, shuffle_each_epoch=True)
+        epochs = []
+        for num_workers in (0, 2):
+            numpy.random.seed(1234)
+            bucketed = TextIterator(self.source, self.target, indexed=True,
+                                    length_bucketing=True,
+                                    num_workers=num_workers, **kwargs)
+            epochs.append([list(bucketed) for _ in range(2)])
+            bucketed.close()
+        self.assertEqual(epochs[0], epochs[1])
+
+    def test_factor_mismatch(self):
+        with open(self.source, 'w') as f:
+            f.write('a|b c|d\ne\n')
+        with open(self.target, 'w') as f:
+            f.write('a c\ne\n')
+        kwargs = dict(self.kwargs, use_factor=True,
+                      source_dicts=['data/vocab.json'] * 2,
+                      source_vocab_sizes=[2000] * 2)
+        for num_workers in (0, 2):
+            text = TextIterator(self.source, self.target,
+                                num_workers=num_workers, **kwargs)
+            with self.assertRaises(exception.Error):
+                list(text)
+            text.close()
+
+    def test_shuffle_length_mismatch(self):
+        with open(self.target, 'a') as f:
+            f.write('extra line\n')
+        with self.assertRaises(ValueError):
+            TextIterator(self.source, self.target, shuffle_each_epoch=True,
+                         **self.kwargs)
+
+    def test_compressed(self):
+        for path in (self.source, self.target):
+            with open(path, 'rb') as f_in:
+                with gzip.open(path + '.gz', 'wb') as f_out:
+                    shutil.copyfileobj(f_in, f_out)
+        text = TextIterator(self.source, self.target, **self.kwargs)
+        compressed = TextIterator(self.source + '.gz', self.target + '.gz',
+                                  **self.kwargs)
+        for _ in range(2):
+            self.assertEqual(list(text), list(compressed))
+
+    def test_universal_newlines(self):
+        path = self.source + '.gz'
+        with gzip.open(path, 'wb') as f:
+            f.write('a b\r\nc\rd\x85e\n\r\nf\r'.encode('UTF-8') * 100
+                    + b'g')
+        with gzip.open(path, 'rt', encoding='UTF-8') as f:
+            expected = f.readlines()
+        # Small blocks, to check lines that cross block boundaries.
+        reader = StreamingReader(path)
+        reader.BLOCK_SIZE = 7
+        reader.seek(0)
+        self.assertEqual(list(reader), expected)
+        reader.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,44 @@
+#!/usr/bin/env python3
+
+import sys
+import os
+import unittest
+
+import numpy
+
+sys.path.append(os.path.abspath('../nematus'))
+from shortlist import Shortlist
+from vocab import Vocabulary
+
+
+class TestShortlist(unittest.TestCase):
+    """
+    Checks that shortlists map source IDs to the union of their candidates
+    """
+
+    def setUp(self):
+        special = ['<EOS>', '<GO>', '<UNK>']
+        self.source_vocab = Vocabulary(special + ['a', 'b', 'c'], range(6))
+        self.target_vocab = Vocabulary(special + ['x', 'y', 'z', 'w'],
+                                       range(7))
+        self.shortlist = Shortlist(
+            frequent=['w'],
+            candidates={'a': ['x'], 'b': ['y', 'z'], 'unknown': ['x'],
+                        'c': ['not-in-vocab']},
+            source_vocab=self.source_vocab,
+            target_vocab=self.target_vocab)
+
+    def test_candidates(self):
+        candidates = self.shortlist.candidates(numpy.array([[3], [0]]))
+        self.assertEqual(candidates.dtype, numpy.int32)
+        self.assertEqual(candidates.tolist(), [0, 1, 2, 3, 6])
+        candidates = self.shortlist.candidates(numpy.array([[3, 4], [4, 0]]))
+        self.assertEqual(candidates.tolist(), [0, 1, 2, 3, 4, 5, 6])
+
+    def test_no_candidates(self):
+        candidates = self.shortlist.candidates(numpy.array([5, 0]))
+        self.assertEqual(candidates.tolist(), [0, 1, 2, 6])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,60 @@
+#!/usr/bin/env python3
+
+import sys
+import os
+import shutil
+import tempfile
+import unittest
+
+sys.path.append(os.path.abspath('../nematus'))
+from translation_cache import TranslationCache
+
+
+class TestTranslationCache(unittest.TestCase):
+    """
+    Checks LRU eviction, key normalization and the persistent tier
+    """
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.beam = [([4, 5, 0], -1.5)]
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_key(self):
+        cache = TranslationCache(['model.npz'], 10)
+        self.assertEqual(cache.key('a  b\n', 5, 1.0), cache.key('a b', 5, 1))
+        self.assertNotEqual(cache.key('a b', 5, 1.0), cache.key('a b', 4, 1.0))
+        self.assertNotEqual(cache.key('a b', 5, 1.0), cache.key('a b', 5, 0.0))
+        other = TranslationCache(['other.npz'], 10)
+        self.assertNotEqual(cache.key('a b', 5, 1.0), other.key('a b', 5, 1.0))
+
+    def test_lru_eviction(self):
+        cache = TranslationCache(['model.npz'], 2)
+        cache.put('a', self.beam)
+        cache.put('b', self.beam)
+        self.assertEqual(cache.get('a'), self.beam)
+        cache.put('c', self.beam)
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual(cache.get('a'), self.beam)
+        self.assertEqual(cache.get('c'), self.beam)
+        stats = cache.stats()
+        self.assertEqual(stats['entries'], 2)
+        self.assertEqual(stats['hits'], 3)
+        self.assertEqual(stats['misses'], 1)
+
+    def test_persistent_tier(self):
+        path = os.path.join(self.tmp_dir, 'cache')
+        cache = TranslationCache(['model.npz'], 1, path)
+        cache.put('a', self.beam)
+        cache.put('b', self.beam)
+        cache.close()
+        cache = TranslationCache(['model.npz'], 1, path)
+        self.assertEqual(cache.get('a'), self.beam)
+        self.assertEqual(cache.stats()['disk_hits'], 1)
+        cache.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,77 @@
+#!/usr/bin/env python3
+
+import sys
+import os
+import shutil
+import tempfile
+import unittest
+
+sys.path.append(os.path.abspath('../nematus'))
+import exception
+import util
+import vocab
+
+
+class TestVocabulary(unittest.TestCase):
+    """
+    Checks that compiled vocabularies behave like the dictionaries they were
+    compiled from
+    """
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.dict_path = os.path.join(self.tmp_dir, 'vocab.json')
+        shutil.copyfile('data/vocab.json', self.dict_path)
+        self.lines = []
+        with open('data/corpus.en', encoding='UTF-8') as f:
+            for i, line in enumerate(f):
+                if i == 100:
+                    break
+                self.lines.append(line)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+        vocab._vocabularies.clear()
+
+    def test_compiled(self):
+        v = vocab.load_vocabulary(self.dict_path, 'rnn')
+        self.assertTrue(os.path.exists(self.dict_path + vocab.COMPILED_SUFFIX))
+        vocab._vocabularies.clear()
+        compiled = vocab.load_vocabulary(self.dict_path, 'rnn')
+        self.assertEqual(v.token_to_id, compiled.token_to_id)
+        self.assertEqual(v.token_to_id, util.load_dict(self.dict_path, 'rnn'))
+
+    def test_unwritable(self):
+        # The compiled file cannot be written (or read) if a directory is in
+        # its place; the vocabulary is then only kept in memory.
+        os.mkdir(self.dict_path + vocab.COMPILED_SUFFIX)
+        v = vocab.load_vocabulary(self.dict_path, 'rnn')
+        self.assertEqual(v.token_to_id, util.load_dict(self.dict_path, 'rnn'))
+        self.assertEqual(sorted(os.listdir(self.tmp_dir)),
+                         ['vocab.json', 'vocab.json' + vocab.COMPILED_SUFFIX])
+
+    def test_old_style_transformer(self):
+        with open(self.dict_path, 'w', encoding='utf-8') as f:
+            f.write('{"eos": 0, "UNK": 1, "a": 2}')
+        with self.assertRaises(exception.Error):
+            vocab.load_vocabulary(self.dict_path, 'transformer')
+
+    def test_encode_decode(self):
+        v = vocab.load_vocabulary(self.dict_path, 'rnn', size=2000)
+        ids, lengths = v.encode(self.lines)
+        self.assertEqual(sum(lengths), len(ids))
+        start = 0
+        for line, length in zip(self.lines, lengths):
+            seq = ids[start:start+length]
+            start += length
+            expected = [v.token_to_id.get(w, v.unk_id) for w in line.split()]
+            self.assertEqual(seq.tolist(), expected)
+            self.assertEqual(v.decode(seq),
+                             util.seq2words(seq, v.id_to_token))
+            self.assertEqual(v.decode(list(seq) + [0, 0]),
+                             util.seq2words(list(seq) + [0, 0],
+                                            v.id_to_token))
+
+
+if __name__ == '__main__':
+    unittest.main()